@@ -0,0 +1,250 @@
+import hashlib
+
+import orjson
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+
+import bulk_io
+from location_catalog import location_catalog
+from database import logs_read_collection, checklists_received_read_collection
+from queries import fetch_checklists_page, fetch_received_page, checklist_filters, autocomplete_objects
+from registry import server_registry
+from models import ScheduleCreate, ScheduleUpdate
+from scheduler import scheduler, schedule_public
+
+# JSON API для автоматизации и полевых устройств.
+# Ответы сериализуются orjson, поддерживают выбор полей (?fields=a,b) и ETag/If-None-Match;
+# сжатие gzip делает GZipMiddleware приложения.
+router = APIRouter(prefix="/api/v1")
+
+API_MAX_LIMIT = 200
+
+# Сериализованные ответы /locations: (версия каталога, поля) -> (etag, body)
+_locations_responses = {}
+
+
+def parse_fields(fields: str = None):
+    if not fields:
+        return None
+    return {field.strip() for field in fields.split(",") if field.strip()}
+
+
+def project(item: dict, fields: set = None, always: tuple = ("id",)) -> dict:
+    if fields is None:
+        return item
+    return {key: value for key, value in item.items() if key in fields or key in always}
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = {value.strip() for value in header.split(",")}
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def json_response(request: Request, body: bytes, etag: str = None) -> Response:
+    etag = etag or '"%s"' % hashlib.sha1(body).hexdigest()
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+@router.get("/checklists")
+async def api_checklists(
+        request: Request,
+        cursor: str = None,
+        limit: int = Query(50, ge=1, le=API_MAX_LIMIT),
+        fields: str = None,
+        user: str = None,
+        location: str = None,
+        cr_code: str = None,
+        date_from: str = None,
+        date_to: str = None
+):
+    try:
+        filters = checklist_filters(user, location, cr_code, date_from, date_to)
+        checklists, next_cursor = await fetch_checklists_page(cursor, limit, filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    selected = parse_fields(fields)
+    body = orjson.dumps({
+        "items": [project(checklist, selected) for checklist in checklists],
+        "next_cursor": next_cursor,
+    })
+    return json_response(request, body)
+
+
+def location_item(name: str, location_data: dict) -> dict:
+    return {"name": name, **location_data}
+
+
+@router.get("/locations")
+async def api_locations(request: Request, fields: str = None):
+    selected = parse_fields(fields)
+    key = (location_catalog.version, frozenset(selected) if selected else None)
+    cached = _locations_responses.get(key)
+    if cached is None:
+        # Каталог меняется редко: сериализуем его один раз на версию и набор полей.
+        # Объекты в список не входят, их отдаёт /locations/{name}
+        body = orjson.dumps({"items": [
+            project(location_item(name, data), selected, always=("name",))
+            for name, data in location_catalog.by_name.items()
+        ]})
+        cached = ('"%s"' % hashlib.sha1(body).hexdigest(), body)
+        if len(_locations_responses) > 100:
+            _locations_responses.clear()
+        _locations_responses[key] = cached
+    etag, body = cached
+    return json_response(request, body, etag)
+
+
+@router.get("/locations/{name}")
+async def api_location(request: Request, name: str, fields: str = None):
+    location_data = location_catalog.get_location(name)
+    if location_data is None:
+        raise HTTPException(status_code=404, detail="Location not found")
+    item = location_item(name, location_data)
+    selected = parse_fields(fields)
+    if selected is None or "object_list" in selected:
+        item["object_list"] = await location_catalog.get_objects(name)
+    body = orjson.dumps(project(item, selected, always=("name",)))
+    return json_response(request, body)
+
+
+@router.get("/objects")
+async def api_objects(
+        request: Request,
+        prefix: str = "",
+        location: str = None,
+        after: str = None,
+        limit: int = Query(20, ge=1, le=API_MAX_LIMIT)
+):
+    # Автодополнение кода объекта (cr_code) по префиксу, при необходимости в пределах локации
+    loc_id = None
+    if location:
+        location_data = location_catalog.get_location(location)
+        if location_data is None:
+            raise HTTPException(status_code=404, detail="Location not found")
+        loc_id = location_data["loc_id"]
+    objects, next_after = await autocomplete_objects(prefix, loc_id, after, limit)
+    for obj in objects:
+        obj["location"] = location_catalog.by_loc_id.get(obj.pop("loc_id"))
+    return json_response(request, orjson.dumps({"items": objects, "next_after": next_after}))
+
+
+# Принятые от серверов файлы: logs — с полнотекстовым поиском (q), checklists — поиск по префиксу имени
+RECEIVED_COLLECTIONS = {"logs": logs_read_collection, "checklists": checklists_received_read_collection}
+
+
+@router.get("/received/{kind}")
+async def api_received(
+        request: Request,
+        kind: str,
+        q: str = None,
+        date_from: str = None,
+        date_to: str = None,
+        cursor: str = None,
+        limit: int = Query(50, ge=1, le=API_MAX_LIMIT)
+):
+    collection = RECEIVED_COLLECTIONS.get(kind)
+    if collection is None:
+        raise HTTPException(status_code=404, detail="Unknown kind")
+    try:
+        items, next_cursor = await fetch_received_page(collection, q, date_from, date_to, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return json_response(request, orjson.dumps({"items": items, "next_cursor": next_cursor}))
+
+
+@router.get("/servers")
+async def api_servers(request: Request, fields: str = None):
+    selected = parse_fields(fields)
+    body = orjson.dumps({"items": [project(server, selected) for server in server_registry.list_servers()]})
+    return json_response(request, body)
+
+
+# ---- массовый импорт/экспорт в NDJSON (по одной записи на строку) ----
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+@router.get("/export/checklists")
+async def api_export_checklists():
+    return StreamingResponse(bulk_io.export_checklists(), media_type=NDJSON_MEDIA_TYPE)
+
+
+@router.get("/export/locations")
+async def api_export_locations():
+    return StreamingResponse(bulk_io.export_locations(), media_type=NDJSON_MEDIA_TYPE)
+
+
+@router.post("/import/checklists")
+async def api_import_checklists(request: Request):
+    # Тело читается потоком и пишется пачками, целиком в память не загружается
+    try:
+        stats = await bulk_io.import_checklists(bulk_io.iter_ndjson(request.stream()))
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid record: {e}")
+    return Response(content=orjson.dumps(stats), media_type="application/json")
+
+
+@router.post("/import/locations")
+async def api_import_locations(request: Request):
+    try:
+        stats = await bulk_io.import_locations(bulk_io.iter_ndjson(request.stream()))
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid record: {e}")
+    # Этот воркер перечитывает каталог сразу; остальные — по change stream или счётчику версии (mark_changed)
+    await location_catalog.load()
+    return Response(content=orjson.dumps(stats), media_type="application/json")
+
+
+# ---- расписания повторяющихся чеклистов (см. scheduler.py) ----
+
+@router.get("/schedules")
+async def api_schedules(request: Request, user: str = None):
+    schedules = await scheduler.list_schedules(user)
+    return json_response(request, orjson.dumps({"items": [schedule_public(item) for item in schedules]}))
+
+
+@router.post("/schedules", status_code=201)
+async def api_create_schedule(body: ScheduleCreate):
+    try:
+        schedule = await scheduler.create(body.checklist_id, body.user, body.rule, body.server_keys, body.name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return Response(content=orjson.dumps(schedule_public(schedule)), status_code=201, media_type="application/json")
+
+
+@router.patch("/schedules/{schedule_id}")
+async def api_update_schedule(schedule_id: str, body: ScheduleUpdate):
+    try:
+        schedule = await scheduler.set_enabled(schedule_id, body.enabled)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if schedule is None:
+        raise HTTPException(status_code=404, detail="Schedule not found")
+    return Response(content=orjson.dumps(schedule_public(schedule)), media_type="application/json")
+
+
+@router.delete("/schedules/{schedule_id}", status_code=204)
+async def api_delete_schedule(schedule_id: str):
+    try:
+        deleted = await scheduler.delete(schedule_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Schedule not found")
+    return Response(status_code=204)
+
+
+@router.get("/schedules/{schedule_id}/runs")
+async def api_schedule_runs(request: Request, schedule_id: str, limit: int = Query(50, ge=1, le=API_MAX_LIMIT)):
+    try:
+        runs = await scheduler.list_runs(schedule_id, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return json_response(request, orjson.dumps({"items": runs}))
@@ -0,0 +1,386 @@
+"""Нагрузочные замеры главного сервера.
+
+Запускает main.py (uvicorn) на отдельной базе MongoDB (MONGO_DB=checklist_bench по умолчанию;
+нужен локальный mongod, адрес — MONGO_URL), поднимает N имитаций полевых серверов
+(как client.py) и M браузерных подписчиков /ws/servers/updates и меряет:
+
+  checklists — задержку рендеринга /checklists в зависимости от числа чеклистов;
+  fanout     — пропускную способность /send_checklist до подтверждения всеми серверами;
+  ingest     — скорость приёма файлов на /ws/receive до подтверждения записи.
+
+Результаты пишутся в JSON (--output). С --compare сравниваются с прошлым прогоном:
+ухудшение больше --threshold отмечается как регрессия, код выхода 1.
+
+Без доступного MongoDB (или если сервер не запустился) замер не выполняется:
+причина выводится в stderr, код выхода 2.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --output new.json --compare bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import httpx
+import websockets
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BENCH_DB = "checklist_bench"
+STARTUP_TIMEOUT_SECONDS = 30
+MONGO_TIMEOUT_MS = 5000
+
+
+class BenchmarkSetupError(Exception):
+    """Окружение для замера недоступно: нет MongoDB или сервер не запустился."""
+
+
+def percentiles(samples: list) -> dict:
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def pick(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    return {"count": len(samples), "mean_ms": statistics.fmean(samples) * 1000,
+            "p50_ms": pick(0.5) * 1000, "p95_ms": pick(0.95) * 1000, "p99_ms": pick(0.99) * 1000}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+# ---- запуск сервера ----
+
+def start_server(port: int, database: str) -> subprocess.Popen:
+    env = dict(os.environ, MONGO_DB=database, LOG_LEVEL="WARNING")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--ws", "websockets",
+         "--log-level", "warning"],
+        env=env,
+    )
+
+
+async def wait_for_server(base_url: str, server: subprocess.Popen):
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    async with httpx.AsyncClient() as http:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise BenchmarkSetupError(f"Сервер завершился при запуске с кодом {server.returncode}")
+            try:
+                if (await http.get(f"{base_url}/login")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise BenchmarkSetupError(f"Сервер не запустился за {STARTUP_TIMEOUT_SECONDS} с")
+
+
+async def login(base_url: str) -> str:
+    async with httpx.AsyncClient() as http:
+        response = await http.post(f"{base_url}/api/v1/token", data={
+            "username": os.getenv("ADMIN_USERNAME"), "password": os.getenv("ADMIN_PASSWORD")})
+        if response.status_code != 200:
+            raise BenchmarkSetupError(f"Не удалось войти как ADMIN_USERNAME: HTTP {response.status_code}")
+        return response.json()["access_token"]
+
+
+async def drop_database(database: str):
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from pymongo.errors import PyMongoError
+    mongo_url = os.getenv("MONGO_URL", "mongodb://localhost:27017")
+    client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=MONGO_TIMEOUT_MS)
+    try:
+        await client.drop_database(database)
+    except PyMongoError as e:
+        raise BenchmarkSetupError(f"MongoDB недоступна ({mongo_url}): {e}") from e
+    finally:
+        client.close()
+
+
+# ---- данные ----
+
+def make_checklist(n: int) -> list:
+    return [{"location": f"Локация {n % 20}", "objects": [
+        {"name": f"Установка {n}-{i}", "cr_code": f"{n:06d}{i:02d}"} for i in range(5)]}]
+
+
+async def seed_checklists(http: httpx.AsyncClient, start: int, count: int):
+    # Через потоковый импорт /api/v1/import/checklists — так же, как загружаются большие объёмы в работе
+    lines = (json.dumps({"checklist": make_checklist(n), "user": f"user{n % 10}", "password": f"{n:08d}",
+                         "created_at": datetime.now().isoformat()}) + "\n" for n in range(start, start + count))
+    response = await http.post("/api/v1/import/checklists", content="".join(lines).encode(), timeout=300)
+    response.raise_for_status()
+
+
+# ---- имитации клиентов ----
+
+class SimulatedServer:
+    """Полевой сервер: регистрируется, отвечает на ping и подтверждает чеклисты, как client.py."""
+
+    def __init__(self, ws_url: str, index: int):
+        self.ws_url = ws_url
+        self.key = f"bench-{index}"
+        self.name = f"Bench {index}"
+        self.received = 0
+        self.ready = asyncio.Event()
+        self.task = None
+
+    async def run(self):
+        async with websockets.connect(f"{self.ws_url}/ws/servers/register", compression="deflate") as ws:
+            await ws.send(json.dumps({"name": self.name, "key": self.key}))
+            self.ready.set()
+            async for message in ws:
+                payload = json.loads(message)
+                if payload.get("type") == "ping":
+                    await ws.send(json.dumps({"type": "pong", "seq": payload.get("seq")}))
+                elif payload.get("type") == "checklist":
+                    self.received += 1
+                    await ws.send(json.dumps({"type": "ack", "delivery_id": payload["delivery_id"]}))
+
+
+class UpdatesListener:
+    """Браузер на главной странице: подписка на /ws/servers/updates."""
+
+    def __init__(self, ws_url: str):
+        self.ws_url = ws_url
+        self.messages = 0
+        self.task = None
+
+    async def run(self):
+        async with websockets.connect(f"{self.ws_url}/ws/servers/updates") as ws:
+            async for _ in ws:
+                self.messages += 1
+
+
+async def wait_until(predicate, timeout: float):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        await asyncio.sleep(0.01)
+
+
+# ---- сценарии ----
+
+async def bench_checklists(http: httpx.AsyncClient, sizes: list, requests: int) -> list:
+    results = []
+    seeded = 0
+    for size in sizes:
+        await seed_checklists(http, seeded, size - seeded)
+        seeded = size
+        await http.get("/checklists")  # прогрев кэша шаблонов и карточек
+        samples = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            response = await http.get("/checklists")
+            response.raise_for_status()
+            samples.append(time.perf_counter() - started)
+        results.append({"checklists": size, **percentiles(samples)})
+    return results
+
+
+async def bench_fanout(http: httpx.AsyncClient, ws_url: str, servers: int, listeners: int, checklists: int) -> dict:
+    updates = [UpdatesListener(ws_url) for _ in range(listeners)]
+    for listener in updates:
+        listener.task = asyncio.create_task(listener.run())
+    simulated = [SimulatedServer(ws_url, i) for i in range(servers)]
+    started = time.perf_counter()
+    for server in simulated:
+        server.task = asyncio.create_task(server.run())
+    await asyncio.wait_for(asyncio.gather(*(server.ready.wait() for server in simulated)), 30)
+    # Регистрация завершена, когда главный сервер видит все имитации
+    deadline = time.monotonic() + 30
+    while len((await http.get("/api/v1/servers")).json()["items"]) < servers:
+        if time.monotonic() > deadline:
+            raise TimeoutError("Не все серверы зарегистрировались")
+        await asyncio.sleep(0.05)
+    registration_seconds = time.perf_counter() - started
+
+    checklist = {"checklist": make_checklist(0)}
+    total = servers * checklists
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(64)
+
+    async def send(server):
+        async with semaphore:
+            response = await http.post("/send_checklist", json={"checklist": checklist, "server_key": server.key})
+            response.raise_for_status()
+
+    await asyncio.gather(*(send(server) for server in simulated for _ in range(checklists)))
+    enqueued_seconds = time.perf_counter() - started
+    await wait_until(lambda: sum(server.received for server in simulated) >= total, 120)
+    delivered_seconds = time.perf_counter() - started
+
+    for client in simulated + updates:
+        client.task.cancel()
+    await asyncio.gather(*(client.task for client in simulated + updates), return_exceptions=True)
+    return {
+        "servers": servers,
+        "listeners": listeners,
+        "deliveries": total,
+        "registration_seconds": registration_seconds,
+        # snapshot + дельты, полученные подписчиками (дельты схлопываются, поэтому сообщений меньше серверов)
+        "update_messages": sum(listener.messages for listener in updates),
+        "enqueue_per_second": total / enqueued_seconds,
+        "delivered_per_second": total / delivered_seconds,
+    }
+
+
+async def bench_ingest(ws_url: str, connections: int, files: int, size: int) -> dict:
+    content = ("x" * 79 + "\n") * max(1, size // 80)
+    latencies = []
+
+    async def upload(connection: int):
+        async with websockets.connect(f"{ws_url}/ws/receive", compression="deflate") as ws:
+            sent_at = {}
+
+            async def receive_acks():
+                acked = 0
+                while acked < files:
+                    payload = json.loads(await ws.recv())
+                    if payload.get("type") == "ack" and payload.get("seq") in sent_at:
+                        latencies.append(time.perf_counter() - sent_at.pop(payload["seq"]))
+                        acked += 1
+
+            receiver = asyncio.create_task(asyncio.wait_for(receive_acks(), 120))
+            for seq in range(files):
+                sent_at[seq] = time.perf_counter()
+                await ws.send(json.dumps({"filename": f"bench-{connection}-{seq}.txt", "content": content,
+                                          "seq": seq}))
+            await receiver
+
+    started = time.perf_counter()
+    await asyncio.gather(*(upload(connection) for connection in range(connections)))
+    elapsed = time.perf_counter() - started
+    total = connections * files
+    return {"connections": connections, "files": total, "file_bytes": len(content),
+            "files_per_second": total / elapsed, "ack_latency": percentiles(latencies)}
+
+
+# ---- сравнение с прошлым прогоном ----
+
+# Метрика -> True, если больше — лучше
+COMPARED_METRICS = {"p95_ms": False, "mean_ms": False, "enqueue_per_second": True,
+                    "delivered_per_second": True, "files_per_second": True}
+
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + "."))
+        elif isinstance(value, list):
+            for item in value:
+                label = next(iter(item.values()))
+                flat.update(flatten(item, f"{path}[{label}]."))
+        elif isinstance(value, (int, float)) and key in COMPARED_METRICS:
+            flat[path] = (value, COMPARED_METRICS[key])
+    return flat
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    regressions = []
+    old = flatten(baseline["results"])
+    for path, (value, higher_is_better) in flatten(current["results"]).items():
+        if path not in old or not old[path][0]:
+            continue
+        change = (value - old[path][0]) / old[path][0]
+        if (-change if higher_is_better else change) > threshold:
+            regressions.append({"metric": path, "baseline": old[path][0], "current": value, "change": change})
+    return regressions
+
+
+async def run(args) -> dict:
+    base_url = f"http://127.0.0.1:{args.port}"
+    ws_url = f"ws://127.0.0.1:{args.port}"
+    await drop_database(args.database)
+    server = start_server(args.port, args.database)
+    try:
+        await wait_for_server(base_url, server)
+        token = await login(base_url)
+        results = {}
+        async with httpx.AsyncClient(base_url=base_url, headers={"Authorization": f"Bearer {token}"},
+                                     timeout=60) as http:
+            if "checklists" in args.scenarios:
+                results["checklists"] = await bench_checklists(http, args.sizes, args.requests)
+            if "fanout" in args.scenarios:
+                results["fanout"] = await bench_fanout(http, ws_url, args.servers, args.listeners,
+                                                       args.checklists_per_server)
+            if "ingest" in args.scenarios:
+                results["ingest"] = await bench_ingest(ws_url, args.connections, args.files, args.file_size)
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+        if not args.keep_database:
+            await drop_database(args.database)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Нагрузочные замеры главного сервера",
+        epilog="Нужен запущенный MongoDB (MONGO_URL) и ADMIN_USERNAME/ADMIN_PASSWORD в окружении или .env; "
+               "без них программа завершается с кодом 2",
+    )
+    parser.add_argument("--scenarios", nargs="+", default=["checklists", "fanout", "ingest"],
+                        choices=["checklists", "fanout", "ingest"])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--database", default=BENCH_DB)
+    parser.add_argument("--keep-database", action="store_true")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="размеры коллекции чеклистов для /checklists")
+    parser.add_argument("--requests", type=int, default=50, help="запросов /checklists на размер")
+    parser.add_argument("--servers", type=int, default=50, help="имитаций полевых серверов")
+    parser.add_argument("--listeners", type=int, default=20, help="подписчиков /ws/servers/updates")
+    parser.add_argument("--checklists-per-server", type=int, default=20)
+    parser.add_argument("--connections", type=int, default=10, help="соединений /ws/receive")
+    parser.add_argument("--files", type=int, default=500, help="файлов на соединение")
+    parser.add_argument("--file-size", type=int, default=2048)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="JSON прошлого прогона")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое ухудшение (0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    try:
+        results = asyncio.run(run(args))
+    except BenchmarkSetupError as e:
+        print(f"Замер не выполнен: {e}", file=sys.stderr)
+        sys.exit(2)
+    report = {
+        "revision": git_revision(),
+        "started_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": results,
+    }
+    exit_code = 0
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            report["regressions"] = compare(json.load(f), report, args.threshold)
+        exit_code = 1 if report["regressions"] else 0
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import asyncio
+import json
+
+from tasks import spawn
+
+# Сообщения, ожидающие отправки одному браузеру; переполнение означает, что клиент не успевает
+CLIENT_QUEUE_SIZE = 32
+# Сколько ждать отправки одного сообщения, прежде чем считать клиента зависшим
+CLIENT_SEND_TIMEOUT_SECONDS = 5
+# Окно, в котором серия подключений/отключений серверов склеивается в одно обновление
+COALESCE_SECONDS = 0.1
+
+
+class ClientChannel:
+    def __init__(self, ws):
+        self.ws = ws
+        self.queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self.task = None
+
+
+class BroadcastHub:
+    """Рассылка изменений списка серверов браузерам (/ws/servers/updates).
+
+    Новый клиент получает полный снимок {"type": "snapshot", "servers": [...]},
+    дальше — только изменения {"type": "delta", "joined": [...], "left": [...]}.
+    Изменения за COALESCE_SECONDS склеиваются, сообщение сериализуется один раз,
+    а отправка идёт через очередь каждого клиента, так что медленный браузер
+    не задерживает остальных и отключается при переполнении своей очереди.
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self._joined = {}
+        self._left = {}
+        self._flush_handle = None
+
+    def add(self, ws, servers: list):
+        channel = ClientChannel(ws)
+        self.clients[ws] = channel
+        channel.queue.put_nowait(json.dumps({"type": "snapshot", "servers": servers}))
+        channel.task = asyncio.create_task(self._sender(channel))
+
+    async def remove(self, ws):
+        channel = self.clients.pop(ws, None)
+        if channel and channel.task and channel.task is not asyncio.current_task():
+            channel.task.cancel()
+            try:
+                await channel.task
+            except asyncio.CancelledError:
+                pass
+
+    def server_joined(self, server: dict):
+        if self._left.pop(server["id"], None) is None:
+            self._joined[server["id"]] = server
+        self._schedule_flush()
+
+    def server_left(self, server: dict):
+        # Сервер, подключившийся и отключившийся в одном окне, браузерам не показываем
+        if self._joined.pop(server["id"], None) is None:
+            self._left[server["id"]] = server
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(COALESCE_SECONDS, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        if not self._joined and not self._left:
+            return
+        message = json.dumps({
+            "type": "delta",
+            "joined": list(self._joined.values()),
+            "left": [{"id": s["id"]} for s in self._left.values()],
+        })
+        self._joined = {}
+        self._left = {}
+        for channel in list(self.clients.values()):
+            try:
+                channel.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                spawn(self._evict(channel), "broadcast: отключение отстающего клиента")
+
+    async def _evict(self, channel: ClientChannel):
+        await self.remove(channel.ws)
+        try:
+            # 1013 — "try again later": браузер переподключится и получит свежий снимок
+            await channel.ws.close(code=1013)
+        except Exception:
+            pass
+
+    async def _sender(self, channel: ClientChannel):
+        while True:
+            message = await channel.queue.get()
+            try:
+                await asyncio.wait_for(channel.ws.send_text(message), CLIENT_SEND_TIMEOUT_SECONDS)
+            except Exception:
+                self.clients.pop(channel.ws, None)
+                try:
+                    await channel.ws.close(code=1013)
+                except Exception:
+                    pass
+                return
+
+
+broadcast_hub = BroadcastHub()
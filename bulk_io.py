@@ -0,0 +1,286 @@
+import asyncio
+import json
+import secrets
+from datetime import datetime, timedelta
+
+import orjson
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne, ReplaceOne
+
+from database import (checklists_collection, checklists_read_collection, passwords_collection, locations_collection,
+                      location_objects_collection, PASSWORD_TTL_SECONDS)
+from location_catalog import (location_catalog, location_document, object_document, location_from_document,
+                              object_from_document)
+from queries import checklist_search_fields
+from passwords import password_service
+from models import LocationEntries
+from log import get_logger
+
+logger = get_logger("bulk_io")
+
+# Записи импортируются пачками: в памяти одновременно не больше одной пачки
+IMPORT_BATCH_SIZE = 1000
+# Размер порции при чтении файла/тела запроса
+READ_CHUNK_SIZE = 64 * 1024
+
+
+# ---- чтение NDJSON ----
+
+async def iter_ndjson(chunks):
+    # Разбирает поток байтов (async-итератор порций) на записи NDJSON.
+    # Перевод строки ищется только в новой порции, поэтому длинная строка из многих порций разбирается за O(n)
+    buffer = bytearray()
+    async for chunk in chunks:
+        scanned = len(buffer)
+        buffer += chunk
+        start = 0
+        end = buffer.find(b"\n", scanned)
+        while end != -1:
+            line = bytes(buffer[start:end])
+            if line.strip():
+                yield orjson.loads(line)
+            start = end + 1
+            end = buffer.find(b"\n", start)
+        if start:
+            del buffer[:start]
+    if buffer.strip():
+        yield orjson.loads(bytes(buffer))
+
+
+async def iter_file_chunks(path: str):
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_CHUNK_SIZE):
+            yield chunk
+
+
+def iter_legacy_locations(path: str):
+    """Потоково читает data.json (один объект {имя локации: данные}) по одной локации.
+
+    Весь файл в память не загружается: в буфере держится только текущая локация.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = ""
+        position = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, position, eof
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                eof = True
+            buffer = buffer[position:] + chunk
+            position = 0
+
+        def skip(chars: str):
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position] in chars:
+                    position += 1
+                if position < len(buffer) or eof:
+                    return
+                fill()
+
+        def decode():
+            nonlocal position
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                    # Число на границе порции могло быть прочитано не полностью
+                    if end == len(buffer) and not eof and not isinstance(value, (dict, list, str)):
+                        raise json.JSONDecodeError("incomplete", buffer, end)
+                    position = end
+                    return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    fill()
+
+        fill()
+        skip(" \t\r\n")
+        if buffer[position:position + 1] != "{":
+            raise ValueError("Ожидался JSON-объект локаций")
+        position += 1
+        while True:
+            skip(" \t\r\n,")
+            if buffer[position:position + 1] == "}" or (eof and position >= len(buffer)):
+                return
+            name = decode()
+            skip(" \t\r\n:")
+            data = decode()
+            if name != "_id":
+                yield {"name": name, **data}
+
+
+# ---- импорт ----
+
+def checklist_requests(record: dict):
+    """Запросы импорта одной записи: (чеклист, пароль, пользователь для выдачи пароля).
+
+    Upsert по id: повторный импорт того же файла не создаёт дубликатов. Пароль из записи
+    живёт PASSWORD_TTL_SECONDS, как выданный обычным путём; записи с пользователем без пароля
+    пароль выдаётся через PasswordService (третий элемент — (id чеклиста, пользователь)).
+    """
+    try:
+        checklist_id = ObjectId(record["id"]) if record.get("id") else ObjectId()
+    except InvalidId:
+        raise ValueError(f"Invalid checklist id: {record['id']}")
+    created_at = record.get("created_at")
+    if isinstance(created_at, str):
+        created_at = datetime.fromisoformat(created_at)
+    # Позиции проверяются так же, как в мастере; ValidationError — подкласс ValueError
+    checklist = LocationEntries.dump_python(LocationEntries.validate_python(record.get("checklist", [])))
+    checklist_request = UpdateOne(
+        {"_id": checklist_id},
+        {"$set": {"checklist": checklist, "created_at": created_at or datetime.now(),
+                  **checklist_search_fields(checklist, record.get("user", ""))}},
+        upsert=True,
+    )
+    password_request = None
+    reissue = None
+    if record.get("password"):
+        now = datetime.now()
+        password_request = UpdateOne(
+            {"checklist_id": str(checklist_id)},
+            {"$set": {"user": record.get("user", ""), "password": record["password"],
+                      "expires_at": now + timedelta(seconds=PASSWORD_TTL_SECONDS)},
+             "$setOnInsert": {"created_at": now}},
+            upsert=True,
+        )
+    elif record.get("user"):
+        reissue = (str(checklist_id), record["user"])
+    return checklist_request, password_request, reissue
+
+
+async def import_checklists(records) -> dict:
+    stats = {"checklists": 0, "passwords": 0}
+    checklist_batch, password_batch, reissue_batch = [], [], []
+
+    async def flush():
+        if checklist_batch:
+            result = await checklists_collection.bulk_write(checklist_batch, ordered=False)
+            stats["checklists"] += result.upserted_count + result.matched_count
+            checklist_batch.clear()
+        if password_batch:
+            result = await passwords_collection.bulk_write(password_batch, ordered=False)
+            stats["passwords"] += result.upserted_count + result.matched_count
+            password_batch.clear()
+        if reissue_batch:
+            # Действующий пароль сохраняется, истёкший или отсутствующий выдаётся из пула
+            await asyncio.gather(*(password_service.reissue(checklist_id, user)
+                                   for checklist_id, user in reissue_batch))
+            stats["passwords"] += len(reissue_batch)
+            reissue_batch.clear()
+
+    async for record in records:
+        checklist_request, password_request, reissue = checklist_requests(record)
+        checklist_batch.append(checklist_request)
+        if password_request:
+            password_batch.append(password_request)
+        if reissue:
+            reissue_batch.append(reissue)
+        if len(checklist_batch) >= IMPORT_BATCH_SIZE:
+            await flush()
+    await flush()
+    return stats
+
+
+async def import_locations(records) -> dict:
+    # Локация перезаписывается вместе со списком объектов: объекты, которых нет в записи, удаляются.
+    # Каждый импорт помечает свои объекты import_id, всё с другой меткой в этих локациях — устаревшее.
+    import_id = secrets.token_hex(8)
+    stats = {"locations": 0, "objects": 0}
+    location_batch, object_batch, loc_ids = [], [], []
+
+    async def flush():
+        if location_batch:
+            await locations_collection.bulk_write(location_batch, ordered=False)
+            stats["locations"] += len(location_batch)
+        if object_batch:
+            await location_objects_collection.bulk_write(object_batch, ordered=False)
+            stats["objects"] += len(object_batch)
+        if loc_ids:
+            await location_objects_collection.delete_many(
+                {"loc_id": {"$in": loc_ids}, "import_id": {"$ne": import_id}})
+        location_batch.clear()
+        object_batch.clear()
+        loc_ids.clear()
+
+    async for record in records:
+        location, objects = location_document(record)
+        loc_id = location["_id"]
+        location_batch.append(ReplaceOne({"_id": loc_id}, location, upsert=True))
+        loc_ids.append(loc_id)
+        for position, obj in enumerate(objects):
+            document = object_document(loc_id, position, obj)
+            document["import_id"] = import_id
+            object_batch.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+        # Пачка сбрасывается только целыми локациями, иначе удалились бы объекты из следующей пачки
+        if len(location_batch) + len(object_batch) >= IMPORT_BATCH_SIZE:
+            await flush()
+    await flush()
+    await location_catalog.mark_changed()
+    return stats
+
+
+async def migrate_legacy_locations() -> int:
+    # Старая схема — один документ {имя локации: данные}; переносим его в нормализованные коллекции
+    legacy = await locations_collection.find_one({"name": {"$exists": False}})
+    if legacy is None:
+        return 0
+    records = [{"name": name, **data} for name, data in legacy.items()
+               if name != "_id" and isinstance(data, dict)]
+    stats = await import_locations(aiter_sync(records))
+    await locations_collection.delete_one({"_id": legacy["_id"]})
+    logger.info("Каталог локаций перенесён в отдельные документы", extra=stats)
+    return stats["locations"]
+
+
+async def aiter_sync(iterable):
+    for item in iterable:
+        yield item
+
+
+# ---- экспорт ----
+
+async def export_checklists():
+    # NDJSON-строки по одному чеклисту; пароли подтягиваются пачкой на каждую порцию курсора
+    cursor = checklists_read_collection.find({}, {"checklist": 1, "created_at": 1, "user": 1}).sort("_id", 1)
+    cursor.batch_size(IMPORT_BATCH_SIZE)
+    batch = []
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            async for line in _export_checklists_batch(batch):
+                yield line
+            batch = []
+    async for line in _export_checklists_batch(batch):
+        yield line
+
+
+async def _export_checklists_batch(batch: list):
+    if not batch:
+        return
+    ids = [str(document["_id"]) for document in batch]
+    passwords = {}
+    async for password_doc in passwords_collection.find({"checklist_id": {"$in": ids}}):
+        passwords[password_doc["checklist_id"]] = password_doc
+    for document in batch:
+        checklist_id = str(document["_id"])
+        password_doc = passwords.get(checklist_id, {})
+        yield orjson.dumps({
+            "id": checklist_id,
+            "checklist": document.get("checklist", []),
+            "created_at": document.get("created_at"),
+            "user": document.get("user") or password_doc.get("user", ""),
+            "password": password_doc.get("password", ""),
+        }) + b"\n"
+
+
+async def export_locations():
+    async for document in locations_collection.find({"name": {"$exists": True}}).sort("_id", 1):
+        name, location_data = location_from_document(document)
+        cursor = location_objects_collection.find({"loc_id": document["_id"]}).sort("position", 1)
+        location_data["object_list"] = [object_from_document(obj) async for obj in cursor]
+        yield orjson.dumps({"name": name, **location_data}) + b"\n"
@@ -1,37 +1,236 @@
 import asyncio
 import json
+import random
+import sqlite3
+import time
+from datetime import datetime
+
 import websockets
-from fastapi import FastAPI
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+from fastapi import FastAPI, Body
+from pydantic import ValidationError
+
+from log import setup_logging, get_logger
+from models import Checklist
 
+setup_logging()
+logger = get_logger("client")
 app = FastAPI()
 
+# Имя и постоянный ключ сервера: по ключу главный сервер хранит очередь чеклистов для него
+SERVER_NAME = "Server 2"
+SERVER_KEY = "server-2"
+MAIN_WS_URL = "ws://localhost:8000"
+
+# Локальное состояние переживает обрывы связи и перезапуски:
+#  inbox  — полученные чеклисты (seq от главного сервера уникален, повторы отбрасываются);
+#  outbox — файлы для отправки на /ws/receive, удаляются после подтверждения записи.
+STATE_DB_PATH = "client_state.db"
+
+# permessage-deflate с явными параметрами вместо значений websockets по умолчанию.
+# Окно 2**12 байт у обеих сторон и memLevel=5 заметно уменьшают память на соединение,
+# а чеклисты и логи из повторяющихся JSON-ключей сжимаются почти так же хорошо, как с полным окном
+DEFLATE_WINDOW_BITS = 12
+DEFLATE_MEM_LEVEL = 5
+DEFLATE_EXTENSIONS = [
+    ClientPerMessageDeflateFactory(
+        server_max_window_bits=DEFLATE_WINDOW_BITS,
+        client_max_window_bits=DEFLATE_WINDOW_BITS,
+        compress_settings={"memLevel": DEFLATE_MEM_LEVEL},
+    )
+]
+
+state_db = sqlite3.connect(STATE_DB_PATH)
+state_db.execute("PRAGMA journal_mode=WAL")
+state_db.execute("""CREATE TABLE IF NOT EXISTS inbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    seq INTEGER UNIQUE,
+    delivery_id TEXT,
+    checklist TEXT NOT NULL,
+    received_at TEXT NOT NULL
+)""")
+state_db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TEXT NOT NULL
+)""")
+state_db.commit()
+
+# Будит отправку outbox, когда в него добавлен файл
+outbox_event = asyncio.Event()
+
+# Heartbeat: ping каждые HEARTBEAT_INTERVAL секунд; если от главного сервера ничего
+# не приходило IDLE_TIMEOUT секунд, соединение считается мёртвым и переподключаемся
+HEARTBEAT_INTERVAL_SECONDS = 10
+IDLE_TIMEOUT_SECONDS = 30
+# Переподключение с экспоненциальной задержкой и случайным разбросом (full jitter),
+# чтобы после перезапуска главного сервера все серверы не подключались одновременно
+RECONNECT_BASE_SECONDS = 1
+RECONNECT_MAX_SECONDS = 60
+
+# RTT до главного сервера по последнему pong
+connection_stats = {"connected": False, "rtt_ms": None, "reconnects": 0}
+
+
+def reconnect_delay(attempt: int) -> float:
+    return random.uniform(0, min(RECONNECT_MAX_SECONDS, RECONNECT_BASE_SECONDS * 2 ** attempt))
+
+
+async def send_heartbeat(websocket, pings_in_flight: dict):
+    seq = 0
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+        seq += 1
+        pings_in_flight.clear()
+        pings_in_flight[seq] = time.monotonic()
+        await websocket.send(json.dumps({"type": "ping", "seq": seq}))
+
+
+async def handle_message(websocket, message, pings_in_flight: dict):
+    try:
+        payload = json.loads(message)
+    except ValueError:
+        return
+    if not isinstance(payload, dict):
+        return
+    if payload.get("type") == "ping":
+        await websocket.send(json.dumps({"type": "pong", "seq": payload.get("seq")}))
+    elif payload.get("type") == "pong":
+        sent_at = pings_in_flight.pop(payload.get("seq"), None)
+        if sent_at is not None:
+            connection_stats["rtt_ms"] = (time.monotonic() - sent_at) * 1000
+    elif payload.get("type") == "checklist":
+        try:
+            checklist = Checklist.from_wire(payload["checklist"])
+        except (ValidationError, KeyError, TypeError, ValueError) as e:
+            # Повтор не поможет: подтверждаем как rejected, иначе главный сервер будет досылать его бесконечно
+            logger.warning("Некорректный чеклист отклонён", extra={"delivery_id": payload.get("delivery_id"),
+                                                                 "seq": payload.get("seq"), "error": str(e)})
+            await websocket.send(json.dumps({"type": "ack", "delivery_id": payload.get("delivery_id"),
+                                             "status": "rejected", "error": str(e)}))
+            return
+        cursor = state_db.execute(
+            "INSERT OR IGNORE INTO inbox (seq, delivery_id, checklist, received_at) VALUES (?, ?, ?, ?)",
+            (payload.get("seq"), payload["delivery_id"], checklist.model_dump_json(), datetime.now().isoformat())
+        )
+        state_db.commit()
+        if cursor.rowcount:
+            logger.info("Получен чеклист", extra={"delivery_id": payload["delivery_id"], "seq": payload.get("seq")})
+        # Подтверждаем доставку (и повтор тоже), иначе главный сервер будет досылать его снова
+        await websocket.send(json.dumps({"type": "ack", "delivery_id": payload["delivery_id"]}))
+
+
 async def register_with_main():
-    uri = "ws://localhost:8000/ws/servers/register"
+    uri = f"{MAIN_WS_URL}/ws/servers/register"
+    attempt = 0
     while True:
         try:
-            async with websockets.connect(uri) as websocket:
+            # permessage-deflate: чеклисты приходят сжатыми
+            async with websockets.connect(uri, compression=None, extensions=DEFLATE_EXTENSIONS) as websocket:
                 # Отправляем данные для регистрации: имя сервера
-                registration_info = {"name": "Server 2"}
+                registration_info = {"name": SERVER_NAME, "key": SERVER_KEY}
                 await websocket.send(json.dumps(registration_info))
-                # Поддерживаем соединение: отправляем heartbeat каждые 30 секунд
-                while True:
-                    await asyncio.sleep(30)
-                    try:
-                        await websocket.send("ping")
-                    except Exception:
-                        break
+                attempt = 0
+                connection_stats["connected"] = True
+                pings_in_flight = {}
+                heartbeat = asyncio.create_task(send_heartbeat(websocket, pings_in_flight))
+                try:
+                    while True:
+                        message = await asyncio.wait_for(websocket.recv(), IDLE_TIMEOUT_SECONDS)
+                        await handle_message(websocket, message, pings_in_flight)
+                finally:
+                    heartbeat.cancel()
+        except asyncio.TimeoutError:
+            logger.warning("Главный сервер не отвечает, переподключение")
         except Exception as e:
-            print("Ошибка подключения к главному серверу:", e)
-        await asyncio.sleep(5)
+            logger.warning("Ошибка подключения к главному серверу", extra={"error": str(e), "attempt": attempt})
+        connection_stats["connected"] = False
+        connection_stats["reconnects"] += 1
+        await asyncio.sleep(reconnect_delay(attempt))
+        attempt += 1
+
+
+async def send_outbox(websocket):
+    # Отправляем файлы по порядку seq; после переподключения всё неподтверждённое уходит заново
+    last_sent = 0
+    while True:
+        outbox_event.clear()
+        rows = state_db.execute(
+            "SELECT seq, filename, content FROM outbox WHERE seq > ? ORDER BY seq", (last_sent,)
+        ).fetchall()
+        for seq, filename, content in rows:
+            await websocket.send(json.dumps({"filename": filename, "content": content, "seq": seq}))
+            last_sent = seq
+        await outbox_event.wait()
+
+
+async def receive_upload_acks(websocket):
+    async for message in websocket:
+        try:
+            payload = json.loads(message)
+        except ValueError:
+            continue
+        if (isinstance(payload, dict) and payload.get("type") == "ack"
+                and payload.get("status") in ("saved", "rejected")):
+            if payload["status"] == "rejected":
+                # Главный сервер не примет этот файл и при повторе — убираем его из очереди
+                logger.warning("Файл отклонён главным сервером", extra={"seq": payload.get("seq"),
+                                                                         "error": payload.get("error")})
+            state_db.execute("DELETE FROM outbox WHERE seq = ?", (payload.get("seq"),))
+            state_db.commit()
+
+
+async def upload_to_main():
+    uri = f"{MAIN_WS_URL}/ws/receive"
+    attempt = 0
+    while True:
+        try:
+            async with websockets.connect(uri, compression=None, extensions=DEFLATE_EXTENSIONS) as websocket:
+                attempt = 0
+                sender = asyncio.create_task(send_outbox(websocket))
+                try:
+                    await receive_upload_acks(websocket)
+                finally:
+                    sender.cancel()
+        except Exception as e:
+            logger.warning("Ошибка отправки файлов на главный сервер", extra={"error": str(e), "attempt": attempt})
+        await asyncio.sleep(reconnect_delay(attempt))
+        attempt += 1
+
 
 @app.on_event("startup")
 async def startup_event():
     asyncio.create_task(register_with_main())
+    asyncio.create_task(upload_to_main())
 
 @app.get("/")
 async def read_root():
     return {"message": "Это вторичное FastAPI приложение, подключенное к главному серверу."}
 
+
+@app.get("/checklists")
+async def get_received_checklists():
+    rows = state_db.execute("SELECT checklist FROM inbox ORDER BY id").fetchall()
+    return [json.loads(checklist) for (checklist,) in rows]
+
+
+# Файл ставится в локальный outbox и будет отправлен на главный сервер, как только есть связь
+@app.post("/files")
+async def add_file(filename: str = Body(...), content: str = Body(...)):
+    cursor = state_db.execute(
+        "INSERT INTO outbox (filename, content, created_at) VALUES (?, ?, ?)",
+        (filename, content, datetime.now().isoformat())
+    )
+    state_db.commit()
+    outbox_event.set()
+    return {"seq": cursor.lastrowid}
+
+
+@app.get("/connection")
+async def get_connection_stats():
+    return connection_stats
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="192.168.20.2", port=8001, reload=True)
\ No newline at end of file
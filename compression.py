@@ -0,0 +1,52 @@
+import gzip
+import os
+import re
+
+from bson import Binary
+from dotenv import load_dotenv
+
+try:
+    import zstandard
+except ImportError:  # zstd необязателен, без него используется gzip
+    zstandard = None
+
+load_dotenv()
+# Алгоритм сжатия содержимого логов в MongoDB: zstd, gzip или none
+LOG_COMPRESSION = os.getenv("LOG_COMPRESSION", "gzip")
+# Логи меньше порога хранятся текстом (их проще искать, а выигрыш от сжатия мал)
+LOG_COMPRESSION_MIN_BYTES = int(os.getenv("LOG_COMPRESSION_MIN_BYTES", 4096))
+# Сколько уникальных слов сжатого лога сохранять для полнотекстового поиска
+LOG_SEARCH_TERMS_MAX = int(os.getenv("LOG_SEARCH_TERMS_MAX", 5000))
+
+if LOG_COMPRESSION == "zstd" and zstandard is None:
+    LOG_COMPRESSION = "gzip"
+
+
+def search_terms(text: str) -> str:
+    # Уникальные слова лога (без учёта регистра) — по ним текстовый индекс ищет в сжатом содержимом
+    terms = dict.fromkeys(word.lower() for word in re.findall(r"\w+", text))
+    return " ".join(list(terms)[:LOG_SEARCH_TERMS_MAX])
+
+
+def compress_log_content(text: str) -> dict:
+    # Возвращает поля для документа лога: content, encoding (если сжато) и search_terms для сжатого лога
+    raw = text.encode("utf-8")
+    if LOG_COMPRESSION == "none" or len(raw) < LOG_COMPRESSION_MIN_BYTES:
+        return {"content": text, "encoding": None, "search_terms": None}
+    if LOG_COMPRESSION == "zstd":
+        content, encoding = Binary(zstandard.ZstdCompressor().compress(raw)), "zstd"
+    else:
+        content, encoding = Binary(gzip.compress(raw)), "gzip"
+    return {"content": content, "encoding": encoding, "search_terms": search_terms(text)}
+
+
+def decompress_log_content(document: dict) -> str:
+    content = document.get("content")
+    encoding = document.get("encoding")
+    if encoding == "gzip":
+        return gzip.decompress(content).decode("utf-8")
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Лог сжат zstd, но пакет zstandard не установлен")
+        return zstandard.ZstdDecompressor().decompress(content).decode("utf-8")
+    return content
@@ -1,27 +1,264 @@
 import os
 from dotenv import load_dotenv
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import IndexModel, ASCENDING, DESCENDING, TEXT, WriteConcern
+from pymongo.errors import OperationFailure
+
+from log import get_logger
+from metrics import mongo_command_metrics
 
 load_dotenv()
+logger = get_logger("database")
 # URL для подключения к MongoDB (можно менять, если у вас иные настройки)
 MONGO_DETAILS = os.getenv("MONGO_URL", "mongodb://localhost:27017")
 
-# Инициализируем асинхронного клиента
-client = AsyncIOMotorClient(MONGO_DETAILS)
+# Пул соединений и таймауты (мс). Сжатие трафика: zlib есть всегда, zstd/snappy — при установленных пакетах
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", 100)),
+    "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", 0)),
+    "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 60000)),
+    "waitQueueTimeoutMS": int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000)),
+    "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+    "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+    "socketTimeoutMS": int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 30000)),
+    "compressors": os.getenv("MONGO_COMPRESSORS", "zlib"),
+    "appname": os.getenv("MONGO_APP_NAME", "checklist"),
+}
+# Тяжёлые чтения (список чеклистов, принятые файлы, сводка /history, экспорт) идут через отдельный клиент
+# со своим пулом, чтобы не занимать соединения ingest-пайплайна и отправки чеклистов,
+# и по умолчанию читают со вторичных узлов реплики (на standalone — с единственного узла).
+# Только что сохранённый чеклист может появиться в списке с задержкой репликации;
+# MONGO_HEAVY_READ_PREFERENCE=primary это отключает.
+MONGO_READ_MAX_POOL_SIZE = int(os.getenv("MONGO_READ_MAX_POOL_SIZE", 20))
+MONGO_HEAVY_READ_PREFERENCE = os.getenv("MONGO_HEAVY_READ_PREFERENCE", "secondaryPreferred")
+
+# Клиенты создаются при импорте (Motor подключается лениво), а проверяются и закрываются
+# вместе с приложением: connect_database/close_database в startup/shutdown main.py и в db_init.py
+client = AsyncIOMotorClient(MONGO_DETAILS, event_listeners=[mongo_command_metrics], **MONGO_CLIENT_OPTIONS)
+read_client = AsyncIOMotorClient(
+    MONGO_DETAILS, event_listeners=[mongo_command_metrics],
+    **{**MONGO_CLIENT_OPTIONS, "maxPoolSize": MONGO_READ_MAX_POOL_SIZE, "minPoolSize": 0},
+    readPreference=MONGO_HEAVY_READ_PREFERENCE,
+)
+
+# Выбираем базу данных (MONGO_DB позволяет запускать бенчмарки на отдельной базе, см. benchmark.py)
+MONGO_DB = os.getenv("MONGO_DB", "my_database")
+database = client[MONGO_DB]
+read_database = read_client[MONGO_DB]
+
+# Гарантии записи по коллекциям: чеклисты, пароли и очередь отправки — majority с журналом
+# (потеря недопустима); принятые файлы, сводки, реестр и черновики — w=1 (их можно переслать
+# или пересчитать, а ingest упирается в задержку записи)
+MONGO_DURABLE_WRITE_CONCERN = os.getenv("MONGO_DURABLE_WRITE_CONCERN", "majority")
+DURABLE_WRITES = WriteConcern(
+    w=int(MONGO_DURABLE_WRITE_CONCERN) if MONGO_DURABLE_WRITE_CONCERN.isdigit() else MONGO_DURABLE_WRITE_CONCERN,
+    j=True)
+FAST_WRITES = WriteConcern(w=int(os.getenv("MONGO_FAST_WRITE_CONCERN", 1)))
+
+
+async def connect_database():
+    # Проверяем доступность MongoDB при старте, а не на первом запросе
+    await client.admin.command("ping")
+    logger.info("MongoDB доступна", extra={"db": MONGO_DB, "read_preference": MONGO_HEAVY_READ_PREFERENCE,
+                                           "max_pool_size": MONGO_CLIENT_OPTIONS["maxPoolSize"]})
 
-# Выбираем базу данных (назовём её, например, "my_database")
-database = client.my_database
 
-# Получаем коллекцию (например, "locations")
-locations_collection = database.get_collection("locations")
+def close_database():
+    client.close()
+    read_client.close()
+
+
+# Каталог локаций: документ на локацию (_id = loc_id) и документ на объект (_id = cr_code), см. location_catalog.py
+locations_collection = database.get_collection("locations", write_concern=DURABLE_WRITES)
+location_objects_collection = database.get_collection("location_objects", write_concern=DURABLE_WRITES)
 
 # Коллекция для сохранённых чеклистов
-checklists_collection = database.get_collection("checklists")
+checklists_collection = database.get_collection("checklists", write_concern=DURABLE_WRITES)
+checklists_read_collection = read_database.get_collection("checklists")
 
 # работяги
 users_collection = database.get_collection("users")
 
 # одноразовые пароли
-passwords_collection = database.get_collection("passwords")
-logs_collection = database.get_collection("logs")
-checklists_received_collection = database.get_collection("checklists_received")
+passwords_collection = database.get_collection("passwords", write_concern=DURABLE_WRITES)
+# заранее сгенерированные свободные коды (см. passwords.py); срок жизни выданного пароля — PASSWORD_TTL_SECONDS
+password_pool_collection = database.get_collection("password_pool", write_concern=FAST_WRITES)
+PASSWORD_TTL_SECONDS = int(os.getenv("PASSWORD_TTL_SECONDS", 30 * 24 * 60 * 60))
+
+# принятые от серверов файлы (пишет ingest.py)
+logs_collection = database.get_collection("logs", write_concern=FAST_WRITES)
+checklists_received_collection = database.get_collection("checklists_received", write_concern=FAST_WRITES)
+logs_read_collection = read_database.get_collection("logs")
+checklists_received_read_collection = read_database.get_collection("checklists_received")
+# сводка по принятым результатам по дням/пользователям/локациям (см. rollups.py)
+received_rollups_collection = database.get_collection("received_rollups", write_concern=FAST_WRITES)
+received_rollups_read_collection = read_database.get_collection("received_rollups")
+
+# большие файлы, загруженные по частям: незавершённые загрузки и файлы в GridFS.
+# Чанки пишутся прямо в коллекцию чанков GridFS (см. uploads.py), документ файла появляется на finish
+RECEIVED_FILES_BUCKET = "received_files"
+uploads_collection = database.get_collection("uploads", write_concern=FAST_WRITES)
+received_files_bucket = AsyncIOMotorGridFSBucket(database, bucket_name=RECEIVED_FILES_BUCKET)
+received_files_files_collection = database.get_collection(f"{RECEIVED_FILES_BUCKET}.files")
+received_files_chunks_collection = database.get_collection(f"{RECEIVED_FILES_BUCKET}.chunks",
+                                                           write_concern=FAST_WRITES)
+UPLOAD_TTL_SECONDS = int(os.getenv("UPLOAD_TTL_SECONDS", 7 * 24 * 60 * 60))
+
+# общий реестр подключённых серверов и сообщения между воркерами (REGISTRY_BACKEND=mongo, см. registry.py)
+registry_servers_collection = database.get_collection("registry_servers", write_concern=FAST_WRITES)
+registry_messages_collection = database.get_collection("registry_messages", write_concern=DURABLE_WRITES)
+REGISTRY_TTL_SECONDS = int(os.getenv("REGISTRY_TTL_SECONDS", 30))
+
+# постоянная очередь чеклистов для серверов и счётчики порядковых номеров (см. outbox.py)
+outbox_collection = database.get_collection("outbox", write_concern=DURABLE_WRITES)
+counters_collection = database.get_collection("counters", write_concern=DURABLE_WRITES)
+
+# черновики чеклистов из мастера создания (см. drafts.py)
+drafts_collection = database.get_collection("drafts", write_concern=FAST_WRITES)
+DRAFT_TTL_SECONDS = int(os.getenv("DRAFT_TTL_SECONDS", 24 * 60 * 60))
+
+# расписания повторяющихся чеклистов и их запуски (см. scheduler.py)
+schedules_collection = database.get_collection("schedules", write_concern=DURABLE_WRITES)
+schedule_runs_collection = database.get_collection("schedule_runs", write_concern=DURABLE_WRITES)
+
+
+# Декларативный реестр индексов: имя коллекции -> список индексов.
+# Применяется при старте приложения (create_indexes), новые индексы добавляются только сюда.
+INDEXES = {
+    "locations": [
+        IndexModel([("name", ASCENDING)], name="name", unique=True),
+    ],
+    "location_objects": [
+        # объекты локации в исходном порядке (select_objects); cr_code — это _id
+        IndexModel([("loc_id", ASCENDING), ("position", ASCENDING)], name="loc_id_position"),
+        # автодополнение кода объекта в пределах локации (queries.autocomplete_objects)
+        IndexModel([("loc_id", ASCENDING), ("_id", ASCENDING)], name="loc_id_cr_code"),
+        # удаление объектов, пропавших из локации при повторном импорте
+        IndexModel([("loc_id", ASCENDING), ("import_id", ASCENDING)], name="loc_id_import_id"),
+    ],
+    "checklists": [
+        # keyset-пагинация /checklists по (created_at, _id)
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)], name="created_at_id"),
+        # фильтры списка чеклистов (queries.checklist_filters) с той же сортировкой
+        IndexModel([("user", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], name="user_created_at_id"),
+        IndexModel([("locations", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+                   name="locations_created_at_id"),
+        IndexModel([("cr_codes", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+                   name="cr_codes_created_at_id"),
+    ],
+    "passwords": [
+        # поиск пароля по чеклисту (get_checklists, edit_checklist, save_checklist)
+        IndexModel([("checklist_id", ASCENDING)], name="checklist_id", unique=True),
+        IndexModel([("user", ASCENDING)], name="user"),
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+        # выданные коды уникальны; пароли без expires_at (созданные до этого индекса или импортированные) не участвуют
+        IndexModel([("password", ASCENDING)], name="password_unique", unique=True,
+                   partialFilterExpression={"expires_at": {"$exists": True}}),
+        # истёкшие пароли удаляются MongoDB автоматически
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username"),
+    ],
+    # _id принятых файлов (имя файла без расширения) индексируется MongoDB автоматически
+    "checklists_received": [
+        IndexModel([("received_at", DESCENDING)], name="received_at"),
+    ],
+    "received_rollups": [
+        # дашборд /history читает сводку за последние дни по каждому разрезу
+        IndexModel([("dimension", ASCENDING), ("day", ASCENDING)], name="dimension_day"),
+    ],
+    "logs": [
+        IndexModel([("received_at", DESCENDING)], name="received_at"),
+        # полнотекстовый поиск: несжатые логи — по content, сжатые — по search_terms (см. compression.py);
+        # язык none — без стемминга, чтобы коды и идентификаторы искались как есть
+        IndexModel([("content", TEXT), ("search_terms", TEXT)], name="content_text", default_language="none"),
+    ],
+    "uploads": [
+        # брошенные загрузки удаляются через UPLOAD_TTL_SECONDS
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=UPLOAD_TTL_SECONDS),
+    ],
+    f"{RECEIVED_FILES_BUCKET}.chunks": [
+        # стандартный индекс GridFS (то же имя, что создаёт драйвер)
+        IndexModel([("files_id", ASCENDING), ("n", ASCENDING)], name="files_id_1_n_1", unique=True),
+        # чанки брошенных загрузок; у чанков завершённых файлов pending_at снимается, TTL их не трогает
+        IndexModel([("pending_at", ASCENDING)], name="pending_at_ttl", expireAfterSeconds=UPLOAD_TTL_SECONDS),
+    ],
+    "registry_servers": [
+        # записи серверов воркера, переставшего продлевать heartbeat_at, удаляются автоматически
+        IndexModel([("heartbeat_at", ASCENDING)], name="heartbeat_at_ttl", expireAfterSeconds=REGISTRY_TTL_SECONDS),
+        IndexModel([("worker_id", ASCENDING)], name="worker_id"),
+    ],
+    "registry_messages": [
+        IndexModel([("worker_id", ASCENDING), ("status", ASCENDING), ("created_at", ASCENDING)],
+                   name="worker_id_status_created_at"),
+        IndexModel([("delivery_id", ASCENDING)], name="delivery_id", unique=True),
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=24 * 60 * 60),
+    ],
+    "outbox": [
+        # досылка неподтверждённых чеклистов серверу по порядку
+        IndexModel([("server_key", ASCENDING), ("status", ASCENDING), ("seq", ASCENDING)],
+                   name="server_key_status_seq"),
+        # доставленные записи хранятся неделю (у pending нет delivered_at, TTL их не трогает)
+        IndexModel([("delivered_at", ASCENDING)], name="delivered_at_ttl", expireAfterSeconds=7 * 24 * 60 * 60),
+    ],
+    "drafts": [
+        # брошенные черновики удаляются MongoDB автоматически
+        IndexModel([("updated_at", ASCENDING)], name="updated_at_ttl", expireAfterSeconds=DRAFT_TTL_SECONDS),
+    ],
+    "schedules": [
+        # выборка расписаний, у которых подошёл срок
+        IndexModel([("enabled", ASCENDING), ("next_run_at", ASCENDING)], name="enabled_next_run_at"),
+        IndexModel([("user", ASCENDING)], name="user"),
+    ],
+    "schedule_runs": [
+        # незавершённые запуски разбираются по времени запуска
+        IndexModel([("status", ASCENDING), ("run_at", ASCENDING)], name="status_run_at"),
+        IndexModel([("schedule_id", ASCENDING), ("run_at", DESCENDING)], name="schedule_id_run_at"),
+        # завершённые запуски хранятся месяц (у pending нет finished_at, TTL их не трогает)
+        IndexModel([("finished_at", ASCENDING)], name="finished_at_ttl", expireAfterSeconds=30 * 24 * 60 * 60),
+    ],
+}
+
+# Коды ошибок MongoDB: индекс с таким именем/ключами уже есть, но с другими параметрами
+INDEX_CONFLICT_CODES = (85, 86)
+
+
+async def create_indexes():
+    for collection_name, indexes in INDEXES.items():
+        collection = database.get_collection(collection_name)
+        for index in indexes:
+            try:
+                await collection.create_indexes([index])
+            except OperationFailure as e:
+                if e.code not in INDEX_CONFLICT_CODES:
+                    logger.warning("Не удалось создать индекс", extra={"index": index.document["name"],
+                                                                     "collection": collection_name, "error": str(e)})
+                    continue
+                # Параметры индекса изменились в реестре —
+                # удаляем старый индекс с тем же именем или ключом и пересоздаём
+                name = index.document["name"]
+                key = list(index.document["key"].items())
+                existing = await collection.index_information()
+                for existing_name, info in existing.items():
+                    if existing_name == name or info["key"] == key:
+                        await collection.drop_index(existing_name)
+                await collection.create_indexes([index])
+
+
+async def get_index_usage():
+    # Статистика использования индексов ($indexStats) по всем коллекциям реестра
+    report = {}
+    for collection_name in INDEXES:
+        collection = database.get_collection(collection_name)
+        stats = await collection.aggregate([{"$indexStats": {}}]).to_list(length=None)
+        report[collection_name] = [
+            {
+                "name": item["name"],
+                "key": dict(item["key"]),
+                "ops": item["accesses"]["ops"],
+                "since": item["accesses"]["since"],
+            }
+            for item in stats
+        ]
+    return report
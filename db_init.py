@@ -1,36 +1,147 @@
-import json
+import sys
 import asyncio
-from motor.motor_asyncio import AsyncIOMotorClient
+import argparse
 
-MONGO_DETAILS = "mongodb://localhost:27017"
+from pymongo import UpdateOne
 
-async def init_db():
-    client = AsyncIOMotorClient(MONGO_DETAILS)
-    db = client.my_database
-    locations_collection = db.locations
-    users_collection = db.users
-    passwords_collection = db.passwords  # коллекция для хранения паролей
+import bulk_io
+from rollups import results_rollup
+from queries import backfill_checklist_search_fields
+from database import (connect_database, close_database, locations_collection, location_objects_collection,
+                      users_collection, passwords_collection)
 
-    # Инициализация локаций
-    with open("data.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-    await locations_collection.delete_many({})
-    await locations_collection.insert_one(data)
+DEFAULT_USERS = [
+    {"username": "Шухраджон Аббасович", "full_name": "Пользователь Один"},
+    {"username": "Камнев Иван", "full_name": "Пользователь Два"},
+    {"username": "Сантьяго Мазерати", "full_name": "Пользователь Три"}
+]
+
+
+def location_records(path: str):
+    # data.json (объект {локация: данные}) или NDJSON (по локации на строку), оба читаются потоково
+    if path.endswith(".ndjson") or path.endswith(".jsonl"):
+        return bulk_io.iter_ndjson(bulk_io.iter_file_chunks(path))
+    return bulk_io.aiter_sync(bulk_io.iter_legacy_locations(path))
+
+
+async def init_db(args):
+    if args.reset:
+        # Старое поведение: полностью очистить справочники и пароли перед загрузкой
+        await locations_collection.delete_many({})
+        await location_objects_collection.delete_many({})
+        await users_collection.delete_many({})
+        await passwords_collection.delete_many({})
+
+    # Старый документ локаций переносится здесь, а не при старте приложения:
+    # несколько воркеров uvicorn иначе переносили бы его одновременно
+    migrated = await bulk_io.migrate_legacy_locations()
+    if migrated:
+        print("Migrated locations:", migrated)
+
+    # Инициализация локаций: существующие обновляются, новые добавляются
+    stats = await bulk_io.import_locations(location_records(args.file))
+    print("Imported locations:", stats["locations"], "objects:", stats["objects"])
 
     # Инициализация пользователей
-    await users_collection.delete_many({})
-    default_users = [
-        {"username": "Шухраджон Аббасович", "full_name": "Пользователь Один"},
-        {"username": "Камнев Иван", "full_name": "Пользователь Два"},
-        {"username": "Сантьяго Мазерати", "full_name": "Пользователь Три"}
-    ]
-    result = await users_collection.insert_many(default_users)
-    print("Inserted default users:", result.inserted_ids)
+    result = await users_collection.bulk_write([
+        UpdateOne({"username": user["username"]}, {"$setOnInsert": user}, upsert=True)
+        for user in DEFAULT_USERS
+    ], ordered=False)
+    print("Inserted default users:", list(result.upserted_ids.values()))
+
+
+async def import_locations(args):
+    stats = await bulk_io.import_locations(location_records(args.file))
+    print("Imported locations:", stats["locations"], "objects:", stats["objects"])
+
+
+async def migrate_locations(args):
+    migrated = await bulk_io.migrate_legacy_locations()
+    print("Migrated locations:", migrated)
+
+
+async def rebuild_rollups(args):
+    count = await results_rollup.rebuild()
+    print("Rebuilt rollups from received files:", count)
+
+
+async def backfill_search_fields(args):
+    count = await backfill_checklist_search_fields()
+    print("Backfilled checklist search fields:", count)
+
+
+async def import_checklists(args):
+    stats = await bulk_io.import_checklists(bulk_io.iter_ndjson(bulk_io.iter_file_chunks(args.file)))
+    print("Imported checklists:", stats["checklists"], "passwords:", stats["passwords"])
+
+
+async def export(lines, path: str):
+    output = sys.stdout.buffer if path == "-" else open(path, "wb")
+    try:
+        async for line in lines:
+            output.write(line)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+
+
+async def export_locations(args):
+    await export(bulk_io.export_locations(), args.file)
+
+
+async def export_checklists(args):
+    await export(bulk_io.export_checklists(), args.file)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Инициализация базы и массовый импорт/экспорт в NDJSON")
+    commands = parser.add_subparsers(dest="command")
+
+    init = commands.add_parser("init", help="загрузить локации и пользователей по умолчанию")
+    init.add_argument("file", nargs="?", default="data.json")
+    init.add_argument("--reset", action="store_true", help="очистить локации, пользователей и пароли перед загрузкой")
+    init.set_defaults(handler=init_db)
+
+    command = commands.add_parser("import-locations", help="data.json или NDJSON с локациями")
+    command.add_argument("file")
+    command.set_defaults(handler=import_locations)
+
+    command = commands.add_parser("migrate-locations", help="перенести старый документ локаций в отдельные коллекции")
+    command.set_defaults(handler=migrate_locations)
+
+    command = commands.add_parser("rebuild-rollups", help="пересчитать сводку /history по всем принятым файлам")
+    command.set_defaults(handler=rebuild_rollups)
+
+    command = commands.add_parser("backfill-search-fields",
+                                  help="заполнить поля поиска (user, locations, cr_codes) у старых чеклистов")
+    command.set_defaults(handler=backfill_search_fields)
+
+    command = commands.add_parser("import-checklists", help="NDJSON с чеклистами")
+    command.add_argument("file")
+    command.set_defaults(handler=import_checklists)
+
+    command = commands.add_parser("export-locations", help="выгрузить локации в NDJSON ('-' — stdout)")
+    command.add_argument("file", nargs="?", default="-")
+    command.set_defaults(handler=export_locations)
+
+    command = commands.add_parser("export-checklists", help="выгрузить чеклисты в NDJSON ('-' — stdout)")
+    command.add_argument("file", nargs="?", default="-")
+    command.set_defaults(handler=export_checklists)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        # Без аргументов — как раньше, инициализация из data.json
+        args = parser.parse_args(["init"])
+    return args
+
 
-    # Очищаем коллекцию с паролями (если нужно)
-    await passwords_collection.delete_many({})
+async def main(args):
+    try:
+        await connect_database()
+        await args.handler(args)
+    finally:
+        close_database()
 
-    client.close()
 
 if __name__ == "__main__":
-    asyncio.run(init_db())
\ No newline at end of file
+    asyncio.run(main(parse_args()))
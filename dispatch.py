@@ -0,0 +1,234 @@
+import asyncio
+import json
+import secrets
+import time
+from collections import OrderedDict
+
+from log import get_logger
+
+logger = get_logger("dispatch")
+
+# Максимальная длина очереди отправки на один сервер; при переполнении новые отправки отклоняются
+SEND_QUEUE_SIZE = 100
+# Сколько ждать подтверждения доставки от сервера и сколько раз повторять отправку
+ACK_TIMEOUT_SECONDS = 10
+MAX_SEND_ATTEMPTS = 3
+# Сколько последних статусов доставки хранить для админки
+DELIVERIES_HISTORY_SIZE = 10000
+# Heartbeat: главный сервер шлёт {"type": "ping", "seq": n} и ждёт {"type": "pong", "seq": n};
+# сервер, от которого ничего не приходило SERVER_IDLE_TIMEOUT_SECONDS, отключается
+SERVER_PING_INTERVAL_SECONDS = 10
+SERVER_IDLE_TIMEOUT_SECONDS = 30
+# Сглаживание среднего RTT (экспоненциальное скользящее среднее)
+RTT_EWMA_ALPHA = 0.2
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class ServerConnection:
+    def __init__(self, name: str, ip: str, ws, key: str = None):
+        self.id = secrets.token_hex(8)
+        # Постоянный ключ сервера (между переподключениями), по нему хранится outbox
+        self.key = key or name
+        self.name = name
+        self.ip = ip
+        self.ws = ws
+        self.queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.pending_acks = {}
+        self.sender_task = None
+        self.heartbeat_task = None
+        self.connected_at = time.time()
+        self.last_seen = time.monotonic()
+        self.ping_seq = 0
+        self.pings_in_flight = {}
+        self.rtt_last = None
+        self.rtt_avg = None
+        self.rtt_min = None
+        self.rtt_max = None
+
+    def public_info(self) -> dict:
+        return {"id": self.id, "key": self.key, "name": self.name, "ip": self.ip}
+
+    def stats(self) -> dict:
+        return {
+            "id": self.id,
+            "connected_at": self.connected_at,
+            "idle_seconds": time.monotonic() - self.last_seen,
+            "queue_size": self.queue.qsize(),
+            "rtt_last_ms": self.rtt_last,
+            "rtt_avg_ms": self.rtt_avg,
+            "rtt_min_ms": self.rtt_min,
+            "rtt_max_ms": self.rtt_max,
+        }
+
+
+class Dispatcher:
+    """Рассылка чеклистов на подключённые серверы.
+
+    У каждого сервера своя ограниченная очередь и своя задача-отправитель, поэтому
+    HTTP-обработчик только ставит сообщение в очередь и сразу отвечает, а медленный
+    сервер не задерживает остальных. Сервер подтверждает доставку сообщением
+    {"type": "ack", "delivery_id": ...}; без подтверждения отправка повторяется.
+    """
+
+    def __init__(self):
+        self.servers = {}
+        self.servers_by_ip = {}
+        self.deliveries = OrderedDict()
+        # Вызываются при каждом изменении статуса доставки (общий реестр registry.py, outbox.py)
+        self.status_listeners = []
+
+    # ---- реестр серверов ----
+
+    def register(self, name: str, ip: str, ws, key: str = None) -> ServerConnection:
+        server = ServerConnection(name, ip, ws, key)
+        self.servers[server.id] = server
+        self.servers_by_ip[ip] = server
+        server.sender_task = asyncio.create_task(self._sender(server))
+        server.heartbeat_task = asyncio.create_task(self._heartbeat(server))
+        return server
+
+    async def unregister(self, server: ServerConnection):
+        self.servers.pop(server.id, None)
+        if self.servers_by_ip.get(server.ip) is server:
+            del self.servers_by_ip[server.ip]
+        for task in (server.sender_task, server.heartbeat_task):
+            if task and task is not asyncio.current_task():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        # Всё, что не успели доставить, помечаем как неудачное
+        for future in server.pending_acks.values():
+            if not future.done():
+                future.cancel()
+        while not server.queue.empty():
+            delivery_id, _, _ = server.queue.get_nowait()
+            self._set_status(delivery_id, "failed", error="server disconnected")
+
+    def get_server(self, server_ip: str = None, server_id: str = None):
+        if server_id:
+            return self.servers.get(server_id)
+        return self.servers_by_ip.get(server_ip)
+
+    # ---- отправка ----
+
+    def enqueue(self, server: ServerConnection, checklist: dict, delivery_id: str = None, seq: int = None) -> str:
+        delivery_id = delivery_id or secrets.token_hex(8)
+        try:
+            server.queue.put_nowait((delivery_id, checklist, seq))
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Очередь отправки на сервер {server.name} переполнена")
+        self._track(server, delivery_id)
+        return delivery_id
+
+    async def enqueue_wait(self, server: ServerConnection, checklist: dict, delivery_id: str, seq: int = None):
+        # Как enqueue, но при заполненной очереди ждёт места (используется при досылке outbox)
+        await server.queue.put((delivery_id, checklist, seq))
+        self._track(server, delivery_id)
+
+    def _track(self, server: ServerConnection, delivery_id: str):
+        self.deliveries[delivery_id] = {
+            "delivery_id": delivery_id,
+            "server_id": server.id,
+            "server_ip": server.ip,
+            "status": "queued",
+            "attempts": 0,
+            "error": None,
+            "updated_at": time.time(),
+        }
+        while len(self.deliveries) > DELIVERIES_HISTORY_SIZE:
+            self.deliveries.popitem(last=False)
+
+    def touch(self, server: ServerConnection):
+        # Любое сообщение от сервера подтверждает, что соединение живо
+        server.last_seen = time.monotonic()
+
+    def pong(self, server: ServerConnection, seq: int):
+        sent_at = server.pings_in_flight.pop(seq, None)
+        if sent_at is None:
+            return
+        rtt = (time.monotonic() - sent_at) * 1000
+        server.rtt_last = rtt
+        server.rtt_min = rtt if server.rtt_min is None else min(server.rtt_min, rtt)
+        server.rtt_max = rtt if server.rtt_max is None else max(server.rtt_max, rtt)
+        if server.rtt_avg is None:
+            server.rtt_avg = rtt
+        else:
+            server.rtt_avg += RTT_EWMA_ALPHA * (rtt - server.rtt_avg)
+
+    def server_stats(self) -> list:
+        return [server.stats() for server in self.servers.values()]
+
+    def ack(self, server: ServerConnection, delivery_id: str):
+        future = server.pending_acks.get(delivery_id)
+        if future and not future.done():
+            future.set_result(True)
+
+    def get_delivery(self, delivery_id: str):
+        return self.deliveries.get(delivery_id)
+
+    def _set_status(self, delivery_id: str, status: str, error: str = None):
+        delivery = self.deliveries.get(delivery_id)
+        if delivery is None:
+            return
+        delivery["status"] = status
+        delivery["error"] = error
+        delivery["updated_at"] = time.time()
+        for listener in self.status_listeners:
+            listener(delivery)
+
+    async def _heartbeat(self, server: ServerConnection):
+        while True:
+            await asyncio.sleep(SERVER_PING_INTERVAL_SECONDS)
+            if time.monotonic() - server.last_seen > SERVER_IDLE_TIMEOUT_SECONDS:
+                # Соединение зависло: закрываем, обработчик /ws/servers/register снимет сервер с регистрации
+                logger.warning("Сервер не отвечает, отключаем", extra={"server": server.name, "ip": server.ip})
+                try:
+                    await server.ws.close(code=1001)
+                except Exception:
+                    pass
+                return
+            server.ping_seq += 1
+            server.pings_in_flight = {seq: sent for seq, sent in server.pings_in_flight.items()
+                                      if time.monotonic() - sent < SERVER_IDLE_TIMEOUT_SECONDS}
+            server.pings_in_flight[server.ping_seq] = time.monotonic()
+            try:
+                await server.ws.send_text(json.dumps({"type": "ping", "seq": server.ping_seq}))
+            except Exception:
+                return
+
+    async def _sender(self, server: ServerConnection):
+        loop = asyncio.get_running_loop()
+        while True:
+            delivery_id, checklist, seq = await server.queue.get()
+            # seq — номер сообщения в outbox сервера, по нему получатель отбрасывает повторы
+            message = json.dumps({"type": "checklist", "delivery_id": delivery_id, "seq": seq,
+                                  "checklist": checklist})
+            for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+                delivery = self.deliveries.get(delivery_id)
+                if delivery is not None:
+                    delivery["attempts"] = attempt
+                future = loop.create_future()
+                server.pending_acks[delivery_id] = future
+                try:
+                    await server.ws.send_text(message)
+                    self._set_status(delivery_id, "sent")
+                    await asyncio.wait_for(future, ACK_TIMEOUT_SECONDS)
+                    self._set_status(delivery_id, "acked")
+                    break
+                except asyncio.TimeoutError:
+                    self._set_status(delivery_id, "sent", error="ack timeout")
+                except Exception as e:
+                    self._set_status(delivery_id, "failed", error=str(e))
+                    break
+                finally:
+                    server.pending_acks.pop(delivery_id, None)
+            else:
+                self._set_status(delivery_id, "failed", error="no ack after retries")
+
+
+dispatcher = Dispatcher()
@@ -0,0 +1,127 @@
+import os
+import secrets
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from database import drafts_collection, DRAFT_TTL_SECONDS
+from registry import REGISTRY_BACKEND
+
+load_dotenv()
+# Сколько черновиков держать в памяти (TTL неактивного черновика — DRAFT_TTL_SECONDS в database.py)
+DRAFTS_MAX_SIZE = int(os.getenv("DRAFTS_MAX_SIZE", 1000))
+# Несколько воркеров (REGISTRY_BACKEND=mongo): шаг мастера может попасть на другой воркер,
+# поэтому черновик берётся из MongoDB при каждом обращении
+DRAFTS_SHARED = REGISTRY_BACKEND == "mongo"
+# Дублировать черновики в MongoDB, чтобы они переживали перезапуск; при нескольких воркерах включено всегда
+DRAFTS_PERSIST = os.getenv("DRAFTS_PERSIST", "1" if DRAFTS_SHARED else "0") == "1"
+if DRAFTS_SHARED and not DRAFTS_PERSIST:
+    raise RuntimeError("DRAFTS_PERSIST=0 is not supported with REGISTRY_BACKEND=mongo: drafts must be shared")
+
+
+class Draft:
+    def __init__(self, draft_id: str, checklist: list, checklist_id: str = None):
+        self.id = draft_id
+        self.checklist = checklist
+        self.checklist_id = checklist_id
+        self.touched_at = time.monotonic()
+
+
+class DraftStore:
+    """Черновики чеклистов, создаваемых в мастере.
+
+    Вместо передачи всего чеклиста в query-строке между страницами мастера
+    передаётся короткий id черновика. Черновики хранятся в памяти с вытеснением
+    по LRU и TTL; при DRAFTS_PERSIST=1 изменения дублируются в MongoDB точечными
+    обновлениями (меняется только затронутая локация). При shared (несколько воркеров)
+    копия в памяти не используется для чтения: она могла устареть после шага мастера на другом воркере.
+    """
+
+    def __init__(self, collection, max_size: int, ttl: int, persist: bool, shared: bool = False):
+        self.collection = collection
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist = persist
+        self.shared = shared
+        self._drafts = OrderedDict()
+
+    def _expired(self, draft: Draft) -> bool:
+        return time.monotonic() - draft.touched_at > self.ttl
+
+    def _remember(self, draft: Draft):
+        draft.touched_at = time.monotonic()
+        self._drafts[draft.id] = draft
+        self._drafts.move_to_end(draft.id)
+        while len(self._drafts) > self.max_size:
+            self._drafts.popitem(last=False)
+
+    async def create(self, checklist: list = None, checklist_id: str = None) -> Draft:
+        draft = Draft(secrets.token_urlsafe(8), checklist or [], checklist_id)
+        self._remember(draft)
+        if self.persist:
+            await self.collection.insert_one({
+                "_id": draft.id,
+                "checklist": draft.checklist,
+                "checklist_id": draft.checklist_id,
+                "updated_at": datetime.now(),
+            })
+        return draft
+
+    async def get(self, draft_id: str):
+        if not draft_id:
+            return None
+        draft = None if self.shared else self._drafts.get(draft_id)
+        if draft is not None and self._expired(draft):
+            self._drafts.pop(draft_id, None)
+            draft = None
+        if draft is None and self.persist:
+            doc = await self.collection.find_one({"_id": draft_id})
+            if doc:
+                draft = Draft(draft_id, doc.get("checklist", []), doc.get("checklist_id"))
+        if draft is not None:
+            self._remember(draft)
+        return draft
+
+    async def add_location(self, draft: Draft, item: dict):
+        draft.checklist.append(item)
+        self._remember(draft)
+        if self.persist:
+            await self.collection.update_one(
+                {"_id": draft.id},
+                {"$push": {"checklist": item}, "$set": {"updated_at": datetime.now()}}
+            )
+
+    async def replace_location(self, draft: Draft, index: int, item: dict):
+        draft.checklist[index] = item
+        self._remember(draft)
+        if self.persist:
+            await self.collection.update_one(
+                {"_id": draft.id},
+                {"$set": {f"checklist.{index}": item, "updated_at": datetime.now()}}
+            )
+
+    async def remove_location(self, draft: Draft, index: int):
+        draft.checklist.pop(index)
+        self._remember(draft)
+        if self.persist:
+            # Удаляем элемент по позиции на стороне MongoDB, не переписывая весь массив с клиента
+            await self.collection.update_one(
+                {"_id": draft.id},
+                [{"$set": {
+                    "checklist": {"$concatArrays": [
+                        {"$slice": ["$checklist", index]},
+                        {"$slice": ["$checklist", index + 1, {"$max": [{"$size": "$checklist"}, 1]}]},
+                    ]},
+                    "updated_at": datetime.now(),
+                }}]
+            )
+
+    async def delete(self, draft: Draft):
+        self._drafts.pop(draft.id, None)
+        if self.persist:
+            await self.collection.delete_one({"_id": draft.id})
+
+
+draft_store = DraftStore(drafts_collection, DRAFTS_MAX_SIZE, DRAFT_TTL_SECONDS, DRAFTS_PERSIST, DRAFTS_SHARED)
@@ -0,0 +1,210 @@
+import asyncio
+import time
+from datetime import datetime
+
+from gridfs.errors import NoFile
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from database import received_files_bucket
+from log import get_logger
+
+logger = get_logger("ingest")
+
+# Пачка сбрасывается в MongoDB при достижении размера или по истечении интервала
+INGEST_BATCH_SIZE = 500
+INGEST_FLUSH_INTERVAL_SECONDS = 0.5
+# Ограничение очереди: при переполнении загрузчики ждут (backpressure на /ws/receive)
+INGEST_QUEUE_SIZE = 10000
+# Метка остановки в очереди: _run дописывает собранную пачку и завершается
+STOP = object()
+
+
+class IngestMetrics:
+    def __init__(self):
+        self.started_at = time.time()
+        self.received = 0
+        self.persisted = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.batches = 0
+        self.last_batch_size = 0
+        self.last_flush_seconds = 0.0
+
+    def as_dict(self, queue_size: int) -> dict:
+        uptime = max(time.time() - self.started_at, 1e-9)
+        return {
+            "received": self.received,
+            "persisted": self.persisted,
+            "duplicates": self.duplicates,
+            "errors": self.errors,
+            "batches": self.batches,
+            "queue_size": queue_size,
+            "last_batch_size": self.last_batch_size,
+            "last_flush_seconds": self.last_flush_seconds,
+            "persisted_per_second": self.persisted / uptime,
+        }
+
+
+class IngestPipeline:
+    """Буферизованная запись файлов, принятых на /ws/receive.
+
+    Файлы копятся в очереди и сохраняются пачками через bulk_write (по размеру
+    пачки или по таймеру). Документ файла заменяется целиком, повторы одного и того же
+    файла внутри пачки схлопываются (побеждает последний). Если новая версия файла
+    заменила загруженную по частям, старый файл удаляется из GridFS. Каждый submit возвращает
+    future, который завершается, когда файл записан, — по нему отправляется подтверждение загрузчику.
+    Слушатели inserted_listeners получают (коллекция, [(file_id, поля)]) для файлов,
+    записанных впервые (повторная отправка того же файла их не вызывает).
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, queue_size: int, files_bucket):
+        self.batch_size = batch_size
+        self.files_bucket = files_bucket
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.metrics = IngestMetrics()
+        self.inserted_listeners = []
+        self._task = None
+
+    async def submit(self, collection, file_id: str, fields: dict) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((collection, file_id, fields, future))
+        self.metrics.received += 1
+        return future
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Не отменяем задачу: отмена посреди сбора или записи пачки потеряла бы уже вынутые
+        # из очереди файлы, и их подтверждения зависли бы. Метка STOP встаёт в конец очереди,
+        # и _run завершается, записав всё, что было до неё
+        if self._task:
+            await self.queue.put(STOP)
+            await self._task
+            self._task = None
+        # Дописываем то, что успели поставить после метки
+        batch = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not STOP:
+                batch.append(item)
+        if batch:
+            await self._flush(batch)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is STOP:
+                return
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                # Задача записи не должна умирать: иначе очередь заполнится и загрузчики встанут навсегда
+                logger.exception("Ошибка записи пачки принятых файлов")
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError(repr(e)))
+
+    async def _flush(self, batch: list):
+        started = time.perf_counter()
+        # Группируем по коллекциям и схлопываем повторы одного _id
+        by_collection = {}
+        superseded = []
+        for collection, file_id, fields, future in batch:
+            items = by_collection.setdefault(collection.name, (collection, {}))[1]
+            if file_id in items:
+                self.metrics.duplicates += 1
+                previous, futures = items[file_id]
+                if previous.get("gridfs_id") not in (None, fields.get("gridfs_id")):
+                    superseded.append(previous["gridfs_id"])
+                items[file_id] = (dict(fields), futures + [future])
+            else:
+                items[file_id] = (dict(fields), [future])
+
+        for collection, items in by_collection.values():
+            now = datetime.now()
+            file_ids = list(items)
+            requests = [
+                ReplaceOne({"_id": file_id}, {**items[file_id][0], "received_at": now}, upsert=True)
+                for file_id in file_ids
+            ]
+            failed_ids = {}
+            upserted = {}
+            stored_files = {}
+            try:
+                # Ссылки на GridFS у заменяемых документов — чтобы удалить старые файлы после записи
+                async for document in collection.find({"_id": {"$in": file_ids}, "gridfs_id": {"$exists": True}},
+                                                      {"gridfs_id": 1}):
+                    stored_files[document["_id"]] = document["gridfs_id"]
+                result = await collection.bulk_write(requests, ordered=False)
+                upserted = result.upserted_ids
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    failed_ids[file_ids[error["index"]]] = error.get("errmsg", "write error")
+                upserted = {item["index"]: item["_id"] for item in e.details.get("upserted", [])}
+            except Exception as e:
+                # Не только ошибки сервера: документ может не кодироваться в BSON (например, целое больше int64).
+                # Пачка помечается ошибкой, цикл _run продолжает работать
+                logger.warning("Не удалось записать пачку", extra={"collection": collection.name, "error": repr(e)})
+                failed_ids = {file_id: repr(e) for file_id in items}
+
+            for file_id, gridfs_id in stored_files.items():
+                if file_id not in failed_ids and items[file_id][0].get("gridfs_id") != gridfs_id:
+                    superseded.append(gridfs_id)
+
+            inserted = [(file_ids[index], items[file_ids[index]][0]) for index in upserted]
+            for listener in self.inserted_listeners:
+                if not inserted:
+                    break
+                try:
+                    await listener(collection, inserted)
+                except Exception:
+                    logger.exception("Ошибка обработчика принятых файлов")
+
+            for file_id, (_, futures) in items.items():
+                error = failed_ids.get(file_id)
+                if error is None:
+                    self.metrics.persisted += 1
+                else:
+                    self.metrics.errors += 1
+                for future in futures:
+                    if future.done():
+                        continue
+                    if error is None:
+                        future.set_result(file_id)
+                    else:
+                        future.set_exception(RuntimeError(error))
+
+        for gridfs_id in superseded:
+            try:
+                await self.files_bucket.delete(gridfs_id)
+            except NoFile:
+                pass
+            except Exception:
+                logger.exception("Не удалось удалить заменённый файл из GridFS")
+
+        self.metrics.batches += 1
+        self.metrics.last_batch_size = len(batch)
+        self.metrics.last_flush_seconds = time.perf_counter() - started
+
+
+ingest_pipeline = IngestPipeline(INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL_SECONDS, INGEST_QUEUE_SIZE,
+                                 received_files_bucket)
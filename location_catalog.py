@@ -0,0 +1,185 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from database import locations_collection, location_objects_collection, counters_collection
+from log import get_logger
+
+logger = get_logger("location_catalog")
+
+# Как часто перечитывать каталог, если change stream недоступен (standalone MongoDB без реплики)
+CATALOG_TTL_SECONDS = 60
+# Без change stream другие воркеры узнают об импорте по счётчику версии каталога в counters,
+# который проверяется раз в CATALOG_VERSION_POLL_SECONDS
+CATALOG_VERSION_POLL_SECONDS = 2
+CATALOG_VERSION_ID = "location_catalog"
+# Пауза перед повторной подпиской на change stream после ошибки
+CHANGE_STREAM_RETRY_SECONDS = 5
+# Коды ошибок MongoDB, с которыми сервер отвергает сам watch(): change stream поддерживается
+# только на replica set (40573), старые версии не знают стадию $changeStream (40324)
+CHANGE_STREAM_UNSUPPORTED_CODES = (40573, 40324)
+# Для скольких локаций держать список объектов в памяти
+OBJECTS_CACHE_SIZE = 200
+
+
+# Схема хранения: документ на локацию {_id: loc_id, name, type, ...} в locations
+# и документ на объект {_id: cr_code, loc_id, position, name, ...} в location_objects.
+
+def location_document(record: dict):
+    # Запись вида {"name", "loc_id", ..., "object_list": [...]} -> (документ локации, объекты)
+    record = dict(record)
+    objects = record.pop("object_list", [])
+    if "loc_id" not in record:
+        raise ValueError(f"Location {record.get('name')} has no loc_id")
+    record["_id"] = record.pop("loc_id")
+    return record, objects
+
+
+def object_document(loc_id, position: int, obj: dict) -> dict:
+    obj = dict(obj)
+    obj["_id"] = obj.pop("cr_code")
+    obj["loc_id"] = loc_id
+    obj["position"] = position
+    return obj
+
+
+def location_from_document(document: dict):
+    # -> (имя, данные локации без списка объектов)
+    location_data = {key: value for key, value in document.items() if key not in ("_id", "name")}
+    location_data["loc_id"] = document["_id"]
+    return document["name"], location_data
+
+
+def object_from_document(document: dict) -> dict:
+    obj = {key: value for key, value in document.items()
+           if key not in ("_id", "loc_id", "position", "import_id")}
+    obj["cr_code"] = document["_id"]
+    return obj
+
+
+class LocationCatalog:
+    """Каталог локаций в памяти процесса.
+
+    В памяти держится только список локаций (по имени и loc_id); объекты локации
+    запрашиваются из location_objects по индексу loc_id и кэшируются для последних
+    OBJECTS_CACHE_SIZE локаций. Изменения обеих коллекций приходят из change stream
+    MongoDB; если он недоступен, каталог перечитывается раз в CATALOG_TTL_SECONDS и сразу
+    после изменения счётчика версии (mark_changed вызывается после каждого импорта).
+    """
+
+    def __init__(self, collection, objects_collection, counters):
+        self.collection = collection
+        self.objects_collection = objects_collection
+        self.counters = counters
+        self.shared_version = None
+        self.by_name = {}
+        self.by_loc_id = {}
+        self.location_names = []
+        self.version = 0
+        self.loaded_at = 0.0
+        self._objects = OrderedDict()
+        self._task = None
+
+    async def load(self):
+        by_name = {}
+        by_loc_id = {}
+        async for document in self.collection.find({"name": {"$exists": True}}).sort("_id", 1):
+            name, location_data = location_from_document(document)
+            by_name[name] = location_data
+            by_loc_id[location_data["loc_id"]] = name
+        # Подменяем ссылки целиком, чтобы читатели не видели каталог в промежуточном состоянии
+        self.by_name = by_name
+        self.by_loc_id = by_loc_id
+        self.location_names = list(by_name.keys())
+        self._objects = OrderedDict()
+        self.version += 1
+        self.loaded_at = time.monotonic()
+
+    def get_location(self, name: str):
+        return self.by_name.get(name)
+
+    async def get_objects(self, name: str):
+        # Объекты локации в исходном порядке или None, если локации нет
+        location_data = self.by_name.get(name)
+        if location_data is None:
+            return None
+        loc_id = location_data["loc_id"]
+        objects = self._objects.get(loc_id)
+        if objects is not None:
+            self._objects.move_to_end(loc_id)
+            return objects
+        version = self.version
+        cursor = self.objects_collection.find({"loc_id": loc_id}).sort("position", 1)
+        objects = [object_from_document(document) async for document in cursor]
+        # Пока шёл запрос, каталог мог обновиться — тогда не кэшируем устаревший список
+        if version == self.version:
+            self._objects[loc_id] = objects
+            if len(self._objects) > OBJECTS_CACHE_SIZE:
+                self._objects.popitem(last=False)
+        return objects
+
+    async def start(self):
+        await self.load()
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self):
+        collections = [self.collection.name, self.objects_collection.name]
+        pipeline = [{"$match": {"ns.coll": {"$in": collections}}}]
+        while True:
+            try:
+                async with self.collection.database.watch(pipeline) as stream:
+                    # Между загрузкой и подпиской каталог мог измениться
+                    await self.load()
+                    async for _ in stream:
+                        # Импорт порождает много событий подряд — перечитываем каталог один раз на пачку
+                        while await stream.try_next() is not None:
+                            pass
+                        await self.load()
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAM_UNSUPPORTED_CODES:
+                    # Change stream не поддерживается (нет replica set) — переходим на перечитывание по TTL
+                    await self._poll()
+                    return
+                # Ошибка уже работающего потока (ChangeStreamHistoryLost, просроченный resume token и т.п.):
+                # подписываемся заново, после подписки каталог перечитывается целиком
+                logger.warning("Change stream каталога локаций перезапускается",
+                               extra={"error": str(e), "code": e.code})
+                await asyncio.sleep(CHANGE_STREAM_RETRY_SECONDS)
+            except PyMongoError as e:
+                logger.warning("Change stream каталога локаций прерван", extra={"error": str(e)})
+                await asyncio.sleep(CHANGE_STREAM_RETRY_SECONDS)
+
+    async def mark_changed(self):
+        # Сообщает остальным воркерам, что каталог изменился (нужно только без change stream)
+        await self.counters.update_one({"_id": CATALOG_VERSION_ID}, {"$inc": {"version": 1}}, upsert=True)
+
+    async def _shared_version(self):
+        document = await self.counters.find_one({"_id": CATALOG_VERSION_ID})
+        return document["version"] if document else 0
+
+    async def _poll(self):
+        self.shared_version = await self._shared_version()
+        while True:
+            await asyncio.sleep(CATALOG_VERSION_POLL_SECONDS)
+            try:
+                shared_version = await self._shared_version()
+                if (shared_version != self.shared_version
+                        or time.monotonic() - self.loaded_at >= CATALOG_TTL_SECONDS):
+                    self.shared_version = shared_version
+                    await self.load()
+            except PyMongoError as e:
+                logger.warning("Не удалось обновить каталог локаций", extra={"error": str(e)})
+
+
+location_catalog = LocationCatalog(locations_collection, location_objects_collection, counters_collection)
@@ -1,30 +1,58 @@
 import os
-import string
-import random
+import asyncio
+import hashlib
+import time
 from dotenv import load_dotenv
 import uvicorn
 import json
 import urllib.parse
 from datetime import datetime, timedelta
+from collections import OrderedDict
 
 from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, Request, Form, Body
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, RedirectResponse, PlainTextResponse, StreamingResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.encoders import jsonable_encoder
 import jwt
-from pydantic import BaseModel
+import orjson
+from pydantic import BaseModel, ValidationError
 
-from database import (locations_collection,
-                      checklists_collection,
+from database import (checklists_collection,
                       users_collection,
                       passwords_collection,
                       logs_collection,
-                      checklists_received_collection)
+                      checklists_received_collection,
+                      received_files_bucket,
+                      create_indexes,
+                      get_index_usage,
+                      connect_database,
+                      close_database)
+from location_catalog import location_catalog
+from drafts import draft_store
+from dispatch import dispatcher, QueueFullError
+from broadcast import broadcast_hub
+from registry import server_registry
+from outbox import outbox
+from rendering import templates, card_cache
+from queries import fetch_checklists_page, checklist_filters, checklist_search_fields
+from api import router as api_router
+from ingest import ingest_pipeline
+from rollups import results_rollup
+from passwords import password_service
+from scheduler import scheduler
+from models import Checklist, LocationEntry, ChecklistObjects, ReceivedFile
+from uploads import chunked_uploads, UploadError
+from compression import compress_log_content, decompress_log_content
+from log import setup_logging, get_logger
+from tasks import spawn
+from metrics import metrics_middleware, register_gauges, render_metrics, RECEIVED_FILES
 from bson import ObjectId
 
 load_dotenv()  # Загружаем переменные из файла .env
+setup_logging()
+logger = get_logger("main")
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 60))
@@ -32,25 +60,46 @@ ADMIN_USERNAME = os.getenv("ADMIN_USERNAME")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
 
 app = FastAPI()
-templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+app.include_router(api_router)
+
+
+@app.on_event("startup")
+async def startup_event():
+    templates.preload()
+    await connect_database()
+    await create_indexes()
+    await location_catalog.start()
+    await password_service.start()
+    await results_rollup.start(ingest_pipeline)
+    await ingest_pipeline.start()
+    register_gauges(dispatcher, broadcast_hub, ingest_pipeline)
+    # Изменения общего списка серверов (в т.ч. с других воркеров) рассылаются браузерам
+    server_registry.on_joined = broadcast_hub.server_joined
+    server_registry.on_left = broadcast_hub.server_left
+    await server_registry.start(dispatcher)
+    await outbox.start(dispatcher)
+    # Повторяющиеся чеклисты создаются и отправляются серверам по расписанию (scheduler.py)
+    await scheduler.start(enqueue_for_server, server_registry)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await scheduler.stop()
+    await location_catalog.stop()
+    await ingest_pipeline.stop()
+    await server_registry.stop()
+    await password_service.stop()
+    close_database()
+
 
 # Простое in‑memory хранилище пользователей (для теста)
 fake_users_db = {}
 
-# Глобальные переменные для регистрации внешних серверов
-# Каждый сервер сохраняется как {"name": ..., "ip": ..., "ws": ...}
-registered_servers = []
-update_clients = set()  # WebSocket‑соединения браузеров для рассылки обновлений
-
-
-async def broadcast_server_list():
-    sanitized_servers = [{"name": s["name"], "ip": s["ip"]} for s in registered_servers]
-    for client in list(update_clients):
-        try:
-            await client.send_json(sanitized_servers)
-        except Exception:
-            update_clients.remove(client)
+# Подключённые к этому воркеру серверы и их очереди отправки хранятся в dispatcher (dispatch.py),
+# общий для всех воркеров список серверов — в server_registry (registry.py),
+# рассылка изменений списка браузерам — в broadcast_hub (broadcast.py)
 
 
 class User(BaseModel):
@@ -73,42 +122,94 @@ def get_password_hash(password):
     return password
 
 
+# Кэш проверенных токенов: sha256(токен) -> payload. Подпись проверяется один раз,
+# дальше для токена достаточно сверить exp; размер ограничен (LRU).
+TOKEN_CACHE_SIZE = 1024
+verified_tokens = OrderedDict()
+
+
+def verify_token(token: str) -> dict:
+    key = hashlib.sha256(token.encode()).digest()
+    payload = verified_tokens.get(key)
+    if payload is not None:
+        if payload.get("exp") is not None and payload["exp"] <= time.time():
+            del verified_tokens[key]
+            raise jwt.ExpiredSignatureError("Signature has expired")
+        verified_tokens.move_to_end(key)
+        return payload
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    verified_tokens[key] = payload
+    if len(verified_tokens) > TOKEN_CACHE_SIZE:
+        verified_tokens.popitem(last=False)
+    return payload
+
+
 def get_current_user_from_cookie(request: Request):
-    token = request.cookies.get("access_token")
-    if not token:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        if username is None or username != ADMIN_USERNAME:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
-        return username
-    except jwt.PyJWTError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    # auth_middleware уже проверил токен и положил payload в request.state
+    payload = getattr(request.state, "token_payload", None)
+    if payload is None:
+        token = request.cookies.get("access_token")
+        if not token:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
+        try:
+            payload = verify_token(token)
+        except jwt.PyJWTError:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    username = payload.get("sub")
+    if username is None or username != ADMIN_USERNAME:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    return username
 
 
 @app.middleware("http")
 async def auth_middleware(request: Request, call_next):
-    allowed_paths = ["/login", "/register", "/static", "/favicon.ico"]
+    # /metrics открыт для сборщика Prometheus: в метриках только счётчики и шаблоны маршрутов
+    allowed_paths = ["/login", "/register", "/static", "/favicon.ico", "/api/v1/token", "/metrics"]
     if any(request.url.path.startswith(path) for path in allowed_paths):
         return await call_next(request)
+    is_api = request.url.path.startswith("/api/")
     token = request.cookies.get("access_token")
+    # API принимает токен и в заголовке Authorization: Bearer <token>
+    authorization = request.headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[7:]
     if not token:
+        if is_api:
+            return JSONResponse({"detail": "Not authenticated"}, status_code=status.HTTP_401_UNAUTHORIZED)
         return RedirectResponse(url="/login")
     try:
-        jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        request.state.token_payload = verify_token(token)
     except Exception:
+        if is_api:
+            return JSONResponse({"detail": "Invalid token"}, status_code=status.HTTP_401_UNAUTHORIZED)
         return RedirectResponse(url="/login")
     return await call_next(request)
 
 
+# Подключается после auth_middleware, поэтому оборачивает его и учитывает все запросы
+app.middleware("http")(metrics_middleware)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    body, content_type = render_metrics()
+    return PlainTextResponse(body, media_type=content_type)
+
+
 # ----------------------------
 # Эндпоинты для работы с базой (локации, регистрация, логин)
 # ----------------------------
 @app.get("/locations")
 async def get_locations():
-    location_doc = await locations_collection.find_one({})
-    return jsonable_encoder(location_doc, custom_encoder={ObjectId: str})
+    # Только список локаций; объекты локации — /api/v1/locations/{name}
+    return jsonable_encoder(location_catalog.by_name)
+
+
+# Отчёт об использовании индексов MongoDB (для контроля, что запросы попадают в индексы)
+@app.get("/indexes/usage")
+async def get_indexes_usage():
+    report = await get_index_usage()
+    return jsonable_encoder(report)
 
 
 @app.get("/register", response_class=HTMLResponse)
@@ -136,6 +237,14 @@ def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
     return response
 
 
+# Токен для JSON API (/api/v1/...) без cookie: для автоматизации и полевых устройств.
+@app.post("/api/v1/token")
+def api_token(form_data: OAuth2PasswordRequestForm = Depends()):
+    if form_data.username != ADMIN_USERNAME or form_data.password != ADMIN_PASSWORD:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    return {"access_token": create_access_token({"sub": form_data.username}), "token_type": "bearer"}
+
+
 @app.get("/", response_class=HTMLResponse)
 def main_page(request: Request):
     try:
@@ -145,6 +254,12 @@ def main_page(request: Request):
     return templates.TemplateResponse("index.html", {"request": request, "username": username})
 
 
+# Состояние соединений с серверами: RTT, простой, длина очереди отправки
+@app.get("/servers/stats")
+async def get_servers_stats():
+    return await server_registry.server_stats()
+
+
 @app.get("/servers")
 def get_servers(request: Request):
     try:
@@ -160,37 +275,61 @@ def get_servers(request: Request):
 @app.websocket("/ws/servers/register")
 async def ws_server_register(websocket: WebSocket):
     await websocket.accept()
-    server_info = None
+    server = None
+    replay_task = None
     try:
         data = await websocket.receive_json()
         server_name = data.get("name", "Unnamed")
         server_ip = websocket.client.host
         # Сохраняем ws‑соединение вместе с данными о сервере
-        server_info = {"name": server_name, "ip": server_ip, "ws": websocket}
-        registered_servers.append(server_info)
-        await broadcast_server_list()
+        server = dispatcher.register(server_name, server_ip, websocket, data.get("key"))
+        await server_registry.add(server.public_info())
+        # Досылаем чеклисты, накопленные в outbox, пока сервер был отключён
+        replay_task = asyncio.create_task(outbox.replay(server, dispatcher))
         while True:
-            await websocket.receive_text()
-    except WebSocketDisconnect:
+            message = await websocket.receive_text()
+            dispatcher.touch(server)
+            # Сервер отвечает на наши ping (pong) и присылает подтверждения доставки чеклистов
+            try:
+                payload = json.loads(message)
+            except ValueError:
+                continue
+            if not isinstance(payload, dict):
+                continue
+            if payload.get("type") == "pong":
+                dispatcher.pong(server, payload.get("seq"))
+            elif payload.get("type") == "ping":
+                await websocket.send_json({"type": "pong", "seq": payload.get("seq")})
+            elif payload.get("type") == "ack":
+                if payload.get("status") == "rejected":
+                    # Сервер не смог разобрать чеклист; доставка завершается, чтобы не досылать его снова
+                    logger.warning("Чеклист отклонён сервером", extra={"server": server.key,
+                                                                        "delivery_id": payload.get("delivery_id"),
+                                                                        "error": payload.get("error")})
+                dispatcher.ack(server, payload.get("delivery_id"))
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError — соединение уже закрыто heartbeat по таймауту
         pass
     finally:
-        if server_info and server_info in registered_servers:
-            registered_servers.remove(server_info)
-            await broadcast_server_list()
+        if replay_task:
+            replay_task.cancel()
+        if server:
+            await dispatcher.unregister(server)
+            await server_registry.remove(server.public_info())
 
 
 @app.websocket("/ws/servers/updates")
 async def ws_server_updates(websocket: WebSocket):
     await websocket.accept()
-    update_clients.add(websocket)
-    await websocket.send_json([{"name": s["name"], "ip": s["ip"]} for s in registered_servers])
+    broadcast_hub.add(websocket, server_registry.list_servers())
     try:
         while True:
             await websocket.receive_text()
-    except WebSocketDisconnect:
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError — соединение уже закрыто хабом (медленный клиент)
         pass
     finally:
-        update_clients.remove(websocket)
+        await broadcast_hub.remove(websocket)
 
 
 @app.websocket("/ws")
@@ -204,65 +343,197 @@ async def websocket_endpoint(websocket: WebSocket):
         pass
 
 
+async def ack_when_saved(websocket: WebSocket, file_id: str, saved, seq: int = None):
+    # Подтверждение загрузчику отправляется только после записи пачки в MongoDB;
+    # seq из сообщения возвращается, чтобы загрузчик удалил файл из своего outbox
+    try:
+        await saved
+        await websocket.send_json({"type": "ack", "file_id": file_id, "seq": seq, "status": "saved"})
+    except Exception as e:
+        try:
+            await websocket.send_json({"type": "ack", "file_id": file_id, "seq": seq, "status": "error",
+                                       "error": str(e)})
+        except Exception:
+            pass
+
+
+def received_collection_for(file_ext: str):
+    # Определяем коллекцию по типу файла
+    if file_ext == "json":
+        return checklists_received_collection
+    if file_ext == "txt":
+        return logs_collection
+    return None
+
+
+# Протокол /ws/receive:
+#  - маленький файл одним текстовым сообщением {"filename": ..., "content": ...};
+#  - большой файл по частям: {"type": "upload_start", "filename": ..., "size": ..., "upload_id": <для продолжения>},
+#    затем бинарные сообщения с чанками и {"type": "upload_finish", "sha256": ...}.
+#    Сами данные хранятся в GridFS, в коллекции файла — ссылка gridfs_id.
 @app.websocket("/ws/receive")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    print("✅ Cоединение на подключение")
+    logger.info("Подключение на /ws/receive", extra={"client": websocket.client.host if websocket.client else None})
+    upload = None  # состояние текущей загрузки по частям
 
     try:
         while True:
-            message = await websocket.receive_text()
-            data = json.loads(message)
-
-            if "filename" in data and "content" in data:
-                file_name = data["filename"]
-                file_id, file_ext = file_name.split(".")
-                content = data["content"]
-
-                # Определяем тип файла
-                if file_ext == "json":
-                    collection = checklists_received_collection
-                    content = json.loads(content)  # Преобразуем JSON-строку в объект
-                elif file_id == "txt":
-                    collection = logs_collection
-                else:
-                    print(f"⚠️ Неподдерживаемый формат: {file_id}")
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            if message.get("bytes") is not None:
+                if upload is None:
+                    await websocket.send_json({"type": "error", "error": "upload_start expected"})
+                    continue
+                try:
+                    await chunked_uploads.append(upload, message["bytes"])
+                except UploadError as e:
+                    await websocket.send_json({"type": "error", "upload_id": upload["upload_id"], "error": str(e),
+                                               "offset": upload["offset"]})
+                continue
+
+            try:
+                data = orjson.loads(message["text"])
+            except orjson.JSONDecodeError:
+                await websocket.send_json({"type": "error", "error": "invalid JSON"})
+                continue
+            if not isinstance(data, dict):
+                await websocket.send_json({"type": "error", "error": "JSON object expected"})
+                continue
+
+            if data.get("type") == "upload_start":
+                if upload is not None:
+                    # Одна загрузка на соединение: новую можно начать только после upload_finish
+                    await websocket.send_json({"type": "error", "upload_id": upload["upload_id"],
+                                               "error": "upload already in progress"})
                     continue
+                if not isinstance(data.get("filename"), str) or not data["filename"]:
+                    await websocket.send_json({"type": "ack", "file_id": None, "seq": data.get("seq"),
+                                               "status": "rejected", "error": "filename is required"})
+                    continue
+                file_ext = data["filename"].rpartition(".")[2]
+                if received_collection_for(file_ext) is None:
+                    await websocket.send_json({"type": "error", "error": f"unsupported format: {data['filename']}"})
+                    continue
+                try:
+                    upload = await chunked_uploads.start(data["filename"], data.get("size"), data.get("upload_id"))
+                except UploadError as e:
+                    await websocket.send_json({"type": "error", "error": str(e)})
+                    continue
+                await websocket.send_json({"type": "upload_ready", "upload_id": upload["upload_id"],
+                                           "offset": upload["offset"]})
 
-                # Вставка в MongoDB (заменяет, если ID уже существует)
-                await collection.update_one(
-                    {"_id": file_id},
-                    {"$set": {"content": content}},
-                    upsert=True  # если документа нет, то создается новый
-                )
+            elif data.get("type") == "upload_finish":
+                if upload is None:
+                    await websocket.send_json({"type": "error", "error": "upload_start expected"})
+                    continue
+                file_id, _, file_ext = upload["filename"].rpartition(".")
+                collection = received_collection_for(file_ext)
+                try:
+                    stored = await chunked_uploads.finish(upload, data.get("sha256"),
+                                                          metadata={"file_id": file_id, "collection": collection.name})
+                except UploadError as e:
+                    await websocket.send_json({"type": "error", "upload_id": upload["upload_id"], "error": str(e)})
+                    continue
+                upload = None
+                RECEIVED_FILES.labels(collection.name).inc()
+                saved = await ingest_pipeline.submit(collection, file_id, stored)
+                spawn(ack_when_saved(websocket, file_id, saved), "ack_when_saved")
+
+            elif "filename" in data and "content" in data:
+                try:
+                    received = ReceivedFile.model_validate(data)
+                    file_id, _, file_ext = received.filename.rpartition(".")
+                    collection = received_collection_for(file_ext)
+                    if collection is None:
+                        raise ValueError(f"unsupported format: {received.filename}")
+                    if collection is checklists_received_collection:
+                        fields = {"content": orjson.loads(received.content)}
+                    else:
+                        fields = compress_log_content(received.content)
+                except ValueError as e:
+                    # Файл не примется и при повторной отправке — rejected, чтобы загрузчик его не пересылал
+                    logger.warning("Файл отклонён", extra={"filename": data.get("filename"), "error": str(e)})
+                    await websocket.send_json({"type": "ack", "file_id": None, "seq": data.get("seq"),
+                                               "status": "rejected", "error": str(e)})
+                    continue
 
-                print(f"📁 Файл {file_id} сохранен в коллекции {collection.name}")
+                # Файл ставится в очередь и записывается пачкой (заменяет, если ID уже существует)
+                RECEIVED_FILES.labels(collection.name).inc()
+                saved = await ingest_pipeline.submit(collection, file_id, fields)
+                spawn(ack_when_saved(websocket, file_id, saved, received.seq), "ack_when_saved")
 
-    except Exception as e:
-        print(f"⚠️ Ошибка: {e}")
+    except WebSocketDisconnect:
+        pass
+    except Exception:
+        logger.exception("Ошибка на /ws/receive")
     finally:
-        await websocket.close()
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+
+
+# Содержимое принятого лога: сжатые логи распаковываются, загруженные по частям отдаются из GridFS потоком.
+@app.get("/logs/{file_id}")
+async def get_log(file_id: str):
+    document = await logs_collection.find_one({"_id": file_id})
+    if not document:
+        raise HTTPException(status_code=404, detail="Log not found")
+    if "gridfs_id" in document:
+        grid_out = await received_files_bucket.open_download_stream(document["gridfs_id"])
+
+        async def stream():
+            while chunk := await grid_out.readchunk():
+                yield chunk
+
+        return StreamingResponse(stream(), media_type="text/plain; charset=utf-8")
+    return PlainTextResponse(decompress_log_content(document))
+
+
+# Дашборд принятых результатов: готовая сводка из received_rollups за последние days дней.
+@app.get("/history", response_class=HTMLResponse)
+async def history(request: Request, days: int = 30):
+    days = min(max(days, 1), 366)
+    return templates.TemplateResponse("history.html", {
+        "request": request,
+        "days": days,
+        "summary": await results_rollup.summary(days),
+    })
+
+
+@app.get("/ingest/metrics")
+async def get_ingest_metrics():
+    return ingest_pipeline.metrics.as_dict(ingest_pipeline.queue.qsize())
 
 
 # ----------------------------
 # Эндпоинты для работы с чеклистами
 # ----------------------------
 
-# Единый маршрут для создания/редактирования чеклиста.
+# Состояние мастера хранится в черновике (drafts.py), между страницами передаётся только его id.
 # Параметр selected_user передаётся, чтобы не выбирать его повторно при переходах.
+def wizard_url(path: str, draft_id: str, selected_user: str = None, **params) -> str:
+    query = {"draft": draft_id, **{k: v for k, v in params.items() if v is not None}}
+    if selected_user:
+        query["selected_user"] = selected_user
+    return f"{path}?{urllib.parse.urlencode(query)}"
+
+
+# Единый маршрут для создания/редактирования чеклиста.
+# Без draft (или с истёкшим черновиком) создаётся новый черновик и делается редирект на него.
 @app.get("/create_checklist", response_class=HTMLResponse)
 async def create_checklist_page(
         request: Request,
-        data: str = None,
-        checklist_id: str = None,
+        draft: str = None,
         selected_user: str = None
 ):
-    checklist = []
-    if data:
-        try:
-            checklist = json.loads(urllib.parse.unquote(data))
-        except Exception:
-            checklist = []
+    current_draft = await draft_store.get(draft)
+    if current_draft is None:
+        current_draft = await draft_store.create()
+        return RedirectResponse(url=wizard_url("/create_checklist", current_draft.id, selected_user), status_code=302)
     # Получаем список пользователей
     users = []
     cursor = users_collection.find({})
@@ -271,9 +542,8 @@ async def create_checklist_page(
         users.append(user)
     return templates.TemplateResponse("create_checklist.html", {
         "request": request,
-        "checklist": checklist,
-        "data": data or "",
-        "checklist_id": checklist_id or "",
+        "checklist": current_draft.checklist,
+        "draft": current_draft.id,
         "users": users,
         "selected_user": selected_user or ""
     })
@@ -281,51 +551,41 @@ async def create_checklist_page(
 
 # Страница выбора локации (с добавлением selected_user).
 @app.get("/select_location", response_class=HTMLResponse)
-async def select_location(request: Request, data: str = None, checklist_id: str = None, selected_user: str = None):
-    doc = await locations_collection.find_one({})
-    if doc:
-        doc.pop("_id", None)
-        locations = list(doc.keys())
-    else:
-        locations = []
+async def select_location(request: Request, draft: str, selected_user: str = None):
+    locations = location_catalog.location_names
     return templates.TemplateResponse("select_location.html", {
         "request": request,
         "locations": locations,
-        "data": data or "",
-        "checklist_id": checklist_id or "",
+        "draft": draft,
         "selected_user": selected_user or ""
     })
 
 
 # Страница выбора объектов для выбранной локации (selected_user передаётся дальше).
+# При редактировании (index) предвыбранные объекты берутся из черновика.
 @app.get("/select_objects", response_class=HTMLResponse)
-async def select_objects(request: Request, location: str, data: str = None, preselected: str = None, index: str = None,
-                         checklist_id: str = None, selected_user: str = None):
-    doc = await locations_collection.find_one({})
-    if doc:
-        doc.pop("_id", None)
-        location_data = doc.get(location)
-    else:
-        location_data = None
-    if not location_data:
+async def select_objects(request: Request, location: str, draft: str, index: int = None,
+                         selected_user: str = None):
+    objects = await location_catalog.get_objects(location)
+    if objects is None:
         return HTMLResponse(f"Локация {location} не найдена", status_code=404)
-    objects = location_data.get("object_list", [])
+    current_draft = await draft_store.get(draft)
+    if current_draft is None:
+        return RedirectResponse(url="/create_checklist", status_code=302)
     preselected_list = []
-    if preselected:
-        try:
-            preselected_list = json.loads(preselected)
-        except Exception:
-            preselected_list = []
-    preselected_codes = [item.get("cr_code") for item in preselected_list]
+    if index is not None and 0 <= index < len(current_draft.checklist):
+        preselected_list = current_draft.checklist[index].get("objects", [])
+    else:
+        index = None
+    preselected_codes = {item.get("cr_code") for item in preselected_list}
     return templates.TemplateResponse("select_objects.html", {
         "request": request,
         "location": location,
         "objects": objects,
-        "data": data or "",
+        "draft": current_draft.id,
         "preselected": preselected_list,
         "preselected_codes": preselected_codes,
         "index": index,
-        "checklist_id": checklist_id,
         "selected_user": selected_user or ""
     })
 
@@ -336,194 +596,256 @@ async def add_location(
         request: Request,
         location: str = Form(...),
         selected_objects: str = Form(...),
-        data: str = Form("[]"),
+        draft: str = Form(...),
         index: str = Form(None),
-        checklist_id: str = Form(None),
         selected_user: str = Form(None)
 ):
+    current_draft = await draft_store.get(draft)
+    if current_draft is None:
+        return RedirectResponse(url="/create_checklist", status_code=302)
     try:
-        current_checklist = json.loads(data)
-    except Exception:
-        current_checklist = []
+        new_item = LocationEntry(location=location,
+                                 objects=ChecklistObjects.validate_json(selected_objects)).model_dump()
+    except ValidationError as e:
+        return HTMLResponse(f"Некорректный список объектов: {e.error_count()} ошибок", status_code=400)
     try:
-        selected_objs = json.loads(selected_objects)
-    except Exception:
-        selected_objs = []
-    new_item = {"location": location, "objects": selected_objs}
-    if index is not None:
-        try:
-            idx = int(index)
-            if 0 <= idx < len(current_checklist):
-                current_checklist[idx] = new_item
-            else:
-                current_checklist.append(new_item)
-        except ValueError:
-            current_checklist.append(new_item)
-    else:
-        current_checklist.append(new_item)
-    new_data = urllib.parse.quote(json.dumps(current_checklist))
-    if checklist_id is not None and checklist_id.strip() != "":
-        redirect_url = f"/create_checklist?data={new_data}&checklist_id={checklist_id}"
+        idx = int(index) if index is not None else None
+    except ValueError:
+        idx = None
+    if idx is not None and 0 <= idx < len(current_draft.checklist):
+        await draft_store.replace_location(current_draft, idx, new_item)
     else:
-        redirect_url = f"/create_checklist?data={new_data}"
-    if selected_user:
-        redirect_url += f"&selected_user={selected_user}"
-    return RedirectResponse(url=redirect_url, status_code=302)
+        await draft_store.add_location(current_draft, new_item)
+    return RedirectResponse(url=wizard_url("/create_checklist", current_draft.id, selected_user), status_code=302)
 
 
 # Удаление локации из чеклиста по индексу.
 @app.get("/delete_location", response_class=HTMLResponse)
-def delete_location(request: Request, index: int, data: str, checklist_id: str = None, selected_user: str = None):
-    try:
-        current_checklist = json.loads(urllib.parse.unquote(data))
-    except Exception:
-        current_checklist = []
-    if 0 <= index < len(current_checklist):
-        current_checklist.pop(index)
-    new_data = urllib.parse.quote(json.dumps(current_checklist))
-    if checklist_id is not None and checklist_id.strip() != "":
-        redirect_url = f"/create_checklist?data={new_data}&checklist_id={checklist_id}"
-    else:
-        redirect_url = f"/create_checklist?data={new_data}"
-    if selected_user:
-        redirect_url += f"&selected_user={selected_user}"
-    return RedirectResponse(url=redirect_url, status_code=302)
+async def delete_location(request: Request, index: int, draft: str, selected_user: str = None):
+    current_draft = await draft_store.get(draft)
+    if current_draft is None:
+        return RedirectResponse(url="/create_checklist", status_code=302)
+    if 0 <= index < len(current_draft.checklist):
+        await draft_store.remove_location(current_draft, index)
+    return RedirectResponse(url=wizard_url("/create_checklist", current_draft.id, selected_user), status_code=302)
 
 
 # Редактирование локации: переход на выбор объектов с предвыбранными значениями.
 @app.get("/edit_location", response_class=HTMLResponse)
-def edit_location(request: Request, index: int, data: str, checklist_id: str = None, selected_user: str = None):
-    try:
-        current_checklist = json.loads(urllib.parse.unquote(data))
-    except Exception:
-        current_checklist = []
-    if 0 <= index < len(current_checklist):
-        item = current_checklist[index]
-        location = item.get("location")
-        preselected = urllib.parse.quote(json.dumps(item.get("objects", [])))
-        if checklist_id is not None and checklist_id.strip() != "":
-            redirect_url = (f"/select_objects?location={urllib.parse.quote(location)}"
-                            f"&data={urllib.parse.quote(data)}&preselected={preselected}"
-                            f"&index={index}&checklist_id={checklist_id}")
-        else:
-            redirect_url = (f"/select_objects?location={urllib.parse.quote(location)}"
-                            f"&data={urllib.parse.quote(data)}&preselected={preselected}&index={index}")
-        if selected_user:
-            redirect_url += f"&selected_user={selected_user}"
-        return RedirectResponse(url=redirect_url, status_code=302)
-    return RedirectResponse(url=f"/create_checklist?data={urllib.parse.quote(data)}", status_code=302)
+async def edit_location(request: Request, index: int, draft: str, selected_user: str = None):
+    current_draft = await draft_store.get(draft)
+    if current_draft is None:
+        return RedirectResponse(url="/create_checklist", status_code=302)
+    if 0 <= index < len(current_draft.checklist):
+        location = current_draft.checklist[index].get("location")
+        return RedirectResponse(
+            url=wizard_url("/select_objects", current_draft.id, selected_user, location=location, index=index),
+            status_code=302
+        )
+    return RedirectResponse(url=wizard_url("/create_checklist", current_draft.id, selected_user), status_code=302)
 
 
-# Сохранение чеклиста: обновление, если передан checklist_id, или создание нового.
+# Сохранение чеклиста: обновление, если черновик создан из существующего чеклиста, или создание нового.
 @app.post("/save_checklist")
 async def save_checklist(
         request: Request,
-        data: str = Form("[]"),
-        checklist_id: str = Form(None),
+        draft: str = Form(...),
         selected_user: str = Form(...),
 ):
     if not selected_user:
         return HTMLResponse("Ошибка: необходимо выбрать пользователя", status_code=400)
-    try:
-        checklist = json.loads(data)
-    except Exception:
-        checklist = []
-    if not checklist:
+    current_draft = await draft_store.get(draft)
+    if current_draft is None or not current_draft.checklist:
         return RedirectResponse(url="/create_checklist", status_code=302)
+    checklist = current_draft.checklist
+    checklist_id = current_draft.checklist_id
 
-    if checklist_id is not None and checklist_id.strip() != "":
+    if checklist_id:
         await checklists_collection.update_one(
             {"_id": ObjectId(checklist_id)},
-            {"$set": {"checklist": checklist, "created_at": datetime.now()}}
-        )
-        await passwords_collection.update_one(
-            {"checklist_id": checklist_id},
-            {"$set": {"user": selected_user}}
+            {"$set": {"checklist": checklist, "created_at": datetime.now(),
+                      **checklist_search_fields(checklist, selected_user)}}
         )
+        # Пароль мог истечь и быть удалён TTL-индексом — тогда выдаётся новый
+        await password_service.reissue(checklist_id, selected_user)
+        card_cache.invalidate(checklist_id)
     else:
         document = {
             "checklist": checklist,
-            "created_at": datetime.now()
-        }
-        result = await checklists_collection.insert_one(document)
-        new_checklist_id = str(result.inserted_id)
-        generated_password = ''.join(random.choices(string.digits, k=8))
-        password_doc = {
-            "checklist_id": new_checklist_id,
-            "user": selected_user,
-            "password": generated_password,
-            "created_at": datetime.now()
+            "created_at": datetime.now(),
+            **checklist_search_fields(checklist, selected_user)
         }
-        await passwords_collection.insert_one(password_doc)
+        # Чеклист и одноразовый пароль записываются вместе (см. passwords.PasswordService)
+        await password_service.create_checklist(checklists_collection, document, selected_user)
+    await draft_store.delete(current_draft)
     return RedirectResponse(url="/checklists", status_code=302)
 
 
-# Просмотр сохранённых чеклистов.
+# Просмотр сохранённых чеклистов (постранично, см. queries.fetch_checklists_page)
+# с фильтрами по пользователю, локации, коду объекта и датам создания.
 @app.get("/checklists", response_class=HTMLResponse)
-async def get_checklists(request: Request):
-    checklists = []
-    async for document in checklists_collection.find({}):
-        checklist_id = str(document["_id"])
-        document["id"] = checklist_id
-        document.pop("_id", None)
-        if "created_at" in document and isinstance(document["created_at"], datetime):
-            document["created_at"] = document["created_at"].strftime("%d-%m-%y %H:%M")
-        password_doc = await passwords_collection.find_one({"checklist_id": checklist_id})
-        if password_doc:
-            document["user"] = password_doc.get("user", "")
-            document["password"] = password_doc.get("password", "")
-        else:
-            document["user"] = ""
-            document["password"] = ""
-        checklists.append(document)
-    return templates.TemplateResponse("checklists.html", {"request": request, "checklists": checklists})
+async def get_checklists(
+        request: Request,
+        cursor: str = None,
+        user: str = None,
+        location: str = None,
+        cr_code: str = None,
+        date_from: str = None,
+        date_to: str = None
+):
+    search = {"user": user, "location": location, "cr_code": cr_code, "date_from": date_from, "date_to": date_to}
+    search = {key: value for key, value in search.items() if value}
+    try:
+        checklists, next_cursor = await fetch_checklists_page(cursor, filters=checklist_filters(**search))
+    except ValueError:
+        return RedirectResponse(url="/checklists", status_code=302)
+
+    # Карточки рендерятся по отдельности и берутся из кэша, если чеклист не менялся
+    cards = []
+    for checklist in checklists:
+        cards.append(await card_cache.render(checklist))
+    return templates.TemplateResponse("checklists.html", {
+        "request": request,
+        "cards": cards,
+        "next_cursor": next_cursor,
+        "is_first_page": cursor is None,
+        "search": search,
+        "search_query": urllib.parse.urlencode(search),
+        "users": await users_collection.distinct("username"),
+        "locations": location_catalog.location_names,
+    })
 
 
 # Удаление чеклиста.
 @app.post("/delete_checklist")
 async def delete_checklist(request: Request, checklist_id: str = Form(...)):
     await checklists_collection.delete_one({"_id": ObjectId(checklist_id)})
+    card_cache.invalidate(checklist_id)
     return RedirectResponse(url="/checklists", status_code=302)
 
 
-# Редактирование чеклиста: перенаправляем на create_checklist с данными.
+# Редактирование чеклиста: создаём черновик из сохранённого чеклиста и открываем его в мастере.
 @app.get("/edit_checklist", response_class=HTMLResponse)
 async def edit_checklist(request: Request, checklist_id: str, selected_user: str = None):
     document = await checklists_collection.find_one({"_id": ObjectId(checklist_id)})
     if not document:
         return HTMLResponse("Чеклист не найден", status_code=404)
-    data = urllib.parse.quote(json.dumps(document.get("checklist", [])))
-    password_doc = await passwords_collection.find_one({"checklist_id": checklist_id})
-    if password_doc:
-        selected_user = password_doc.get("user")
-    else:
-        selected_user = ""
+    current_draft = await draft_store.create(document.get("checklist", []), checklist_id)
+    selected_user = document.get("user")
+    if not selected_user:
+        # Чеклисты без поля user (до заполнения полей поиска) — берём пользователя из пароля
+        password_doc = await passwords_collection.find_one({"checklist_id": checklist_id})
+        selected_user = password_doc.get("user", "") if password_doc else ""
     return RedirectResponse(
-        url=f"/create_checklist?data={data}&checklist_id={checklist_id}&selected_user={selected_user}",
+        url=wizard_url("/create_checklist", current_draft.id, selected_user),
         status_code=302
     )
 
 
-# Новый эндпоинт для отправки чеклиста на внешний сервер по WebSocket.
+# Отправка чеклиста одному серверу. Чеклист сначала сохраняется в outbox сервера, затем ставится
+# в очередь напрямую (сервер подключён к этому воркеру), через общий реестр (к другому воркеру)
+# или ждёт подключения сервера (указан только server_key). checklist — уже в формате провода (Checklist.to_wire).
+# Повтор с тем же delivery_id не создаёт новой доставки: запись outbox и её seq те же, получатель отбросит повтор.
+async def enqueue_for_server(checklist: dict, server_ip: str = None, server_key: str = None,
+                             delivery_id: str = None) -> str:
+    if server_ip:
+        server_info = server_registry.find_by_ip(server_ip)
+        if server_info is None:
+            raise LookupError(server_ip)
+        server_key = server_info["key"]
+    else:
+        server_info = server_registry.find_by_key(server_key)
+    entry = await outbox.append(server_key, checklist, delivery_id)
+    if server_info is None or entry["status"] != "pending":
+        return entry["_id"]
+    local_server = dispatcher.get_server(server_id=server_info["id"])
+    if local_server:
+        try:
+            dispatcher.enqueue(local_server, checklist, entry["_id"], entry["seq"])
+        except QueueFullError:
+            # Запись с заданным delivery_id оставляем: её досылает outbox или повторный вызов
+            if delivery_id is None:
+                await outbox.discard(entry)
+            raise
+    else:
+        await server_registry.route(server_info, checklist, entry["_id"], entry["seq"])
+    return entry["_id"]
+
+
+# Отправка чеклиста на внешний сервер по WebSocket (по server_ip подключённого сервера
+# или по server_key — тогда сервер может быть отключён и получит чеклист при подключении).
+# Статус доставки доступен по /deliveries/{delivery_id}.
 @app.post("/send_checklist")
 async def send_checklist(
-        checklist: dict = Body(...),
-        server_ip: str = Body(...),
+        checklist: Checklist = Body(...),
+        server_ip: str = Body(None),
+        server_key: str = Body(None),
         current_user: str = Depends(get_current_user_from_cookie)
 ):
-    target_server = None
-    for s in registered_servers:
-        if s["ip"] == server_ip:
-            target_server = s
-            break
-    if not target_server:
-        raise HTTPException(status_code=404, detail="Server not found or not connected")
+    if not server_ip and not server_key:
+        raise HTTPException(status_code=400, detail="server_ip or server_key is required")
     try:
-        await target_server["ws"].send_text(json.dumps(checklist))
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to send checklist: {str(e)}")
-    return {"detail": "Checklist sent successfully"}
+        delivery_id = await enqueue_for_server(checklist.to_wire(), server_ip, server_key)
+    except LookupError:
+        raise HTTPException(status_code=404, detail="Server not found or not connected")
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {"detail": "Checklist queued for sending", "delivery_id": delivery_id}
+
+
+# Массовая отправка: каждый из чеклистов на каждый из серверов (пустой server_ips — на все подключённые).
+@app.post("/send_checklists")
+async def send_checklists(
+        checklists: list[Checklist] = Body(...),
+        server_ips: list[str] = Body([]),
+        current_user: str = Depends(get_current_user_from_cookie)
+):
+    if not server_ips:
+        server_ips = [server["ip"] for server in server_registry.list_servers()]
+    missing = [ip for ip in server_ips if server_registry.find_by_ip(ip) is None]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Servers not connected: {', '.join(missing)}")
+    wire_checklists = [checklist.to_wire() for checklist in checklists]
+    # Серверы обрабатываются параллельно; внутри одного сервера чеклисты ставятся по очереди,
+    # чтобы seq в outbox шёл в порядке запроса
+    results = await asyncio.gather(
+        *(enqueue_for_server_many(wire_checklists, server_ip) for server_ip in server_ips),
+        return_exceptions=True
+    )
+    deliveries = []
+    for server_ip, result in zip(server_ips, results):
+        if isinstance(result, BaseException):
+            logger.error("Не удалось поставить чеклисты в очередь", exc_info=result,
+                         extra={"server_ip": server_ip})
+            deliveries.extend({"server_ip": server_ip, "delivery_id": None, "status": "rejected",
+                               "error": str(result)} for _ in wire_checklists)
+        else:
+            deliveries.extend(result)
+    return {"deliveries": deliveries}
+
+
+async def enqueue_for_server_many(checklists: list[dict], server_ip: str) -> list[dict]:
+    deliveries = []
+    for checklist in checklists:
+        try:
+            delivery_id = await enqueue_for_server(checklist, server_ip=server_ip)
+            deliveries.append({"server_ip": server_ip, "delivery_id": delivery_id, "status": "queued"})
+        except (LookupError, QueueFullError) as e:
+            deliveries.append({"server_ip": server_ip, "delivery_id": None, "status": "rejected",
+                               "error": str(e)})
+    return deliveries
+
+
+@app.get("/deliveries/{delivery_id}")
+async def get_delivery(delivery_id: str):
+    delivery = (dispatcher.get_delivery(delivery_id)
+                or await server_registry.get_delivery(delivery_id)
+                or await outbox.get_delivery(delivery_id))
+    if not delivery:
+        raise HTTPException(status_code=404, detail="Delivery not found")
+    return jsonable_encoder(delivery)
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # permessage-deflate сжимает чеклисты и файлы, передаваемые по WebSocket
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True, ws="websockets", ws_per_message_deflate=True)
@@ -0,0 +1,104 @@
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from pymongo import monitoring
+from starlette.routing import Match
+
+# Метрики в формате Prometheus, отдаются на /metrics.
+# Метки ограничены шаблонами маршрутов и именами коллекций, чтобы число рядов не росло с данными.
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Время HTTP-запроса до отправки всего тела ответа", ["method", "route", "status"])
+MONGO_COMMAND_SECONDS = Histogram(
+    "mongo_command_duration_seconds", "Время выполнения команды MongoDB", ["command", "collection"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+MONGO_COMMAND_ERRORS = Counter(
+    "mongo_command_errors_total", "Команды MongoDB, завершившиеся ошибкой", ["command", "collection"])
+RECEIVED_FILES = Counter(
+    "received_files_total", "Файлы, принятые на /ws/receive", ["kind"])
+
+SERVERS_CONNECTED = Gauge("ws_servers_connected", "Серверы, подключённые к этому воркеру")
+UPDATE_CLIENTS = Gauge("ws_update_clients", "Браузеры, подписанные на /ws/servers/updates")
+DISPATCH_QUEUE_DEPTH = Gauge("dispatch_queue_depth", "Чеклисты в очередях отправки серверам")
+DISPATCH_PENDING_ACKS = Gauge("dispatch_pending_acks", "Отправленные чеклисты, ждущие подтверждения")
+INGEST_QUEUE_DEPTH = Gauge("ingest_queue_depth", "Файлы в очереди ingest-пайплайна")
+INGEST_PERSISTED = Gauge("ingest_persisted_files", "Файлы, записанные ingest-пайплайном с запуска")
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Время каждой команды Motor/PyMongo по имени команды и коллекции.
+
+    Подключается к клиенту через event_listeners, поэтому учитываются все вызовы
+    коллекций без обёрток на местах вызова.
+    """
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        self._collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_SECONDS.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_SECONDS.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_ERRORS.labels(event.command_name, collection).inc()
+
+
+mongo_command_metrics = MongoCommandMetrics()
+
+
+def route_template(app, scope) -> str:
+    # Шаблон маршрута (/logs/{file_id}), а не фактический путь
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "unknown")
+    return "unmatched"
+
+
+async def metrics_middleware(request, call_next):
+    # Время считается до отправки последнего байта тела: потоковые ответы и шаблоны
+    # (AsyncTemplates отдаёт страницу потоком) рендерятся уже после возврата call_next
+    started = time.perf_counter()
+
+    def observe(status: int):
+        HTTP_REQUEST_SECONDS.labels(request.method, route_template(request.app, request.scope), status) \
+            .observe(time.perf_counter() - started)
+
+    try:
+        response = await call_next(request)
+    except Exception:
+        observe(500)
+        raise
+    body = response.body_iterator
+
+    async def timed_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            observe(response.status_code)
+
+    response.body_iterator = timed_body()
+    return response
+
+
+def register_gauges(dispatcher, broadcast_hub, ingest_pipeline):
+    # Значения снимаются в момент запроса /metrics
+    SERVERS_CONNECTED.set_function(lambda: len(dispatcher.servers))
+    UPDATE_CLIENTS.set_function(lambda: len(broadcast_hub.clients))
+    DISPATCH_QUEUE_DEPTH.set_function(lambda: sum(s.queue.qsize() for s in list(dispatcher.servers.values())))
+    DISPATCH_PENDING_ACKS.set_function(lambda: sum(len(s.pending_acks) for s in list(dispatcher.servers.values())))
+    INGEST_QUEUE_DEPTH.set_function(ingest_pipeline.queue.qsize)
+    INGEST_PERSISTED.set_function(lambda: ingest_pipeline.metrics.persisted)
+
+
+def render_metrics():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,92 @@
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+
+# Схема чеклиста. Данные проверяются один раз на входе (формы мастера, /send_checklist, импорт,
+# /ws/receive), дальше код работает с уже проверенными значениями.
+
+
+class ChecklistObject(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    cr_code: str = Field(min_length=1)
+    name: str = ""
+
+
+class LocationEntry(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    location: str = Field(min_length=1)
+    objects: list[ChecklistObject] = []
+
+
+class Checklist(BaseModel):
+    """Чеклист в том виде, в каком он уходит на полевой сервер.
+
+    На провод он идёт в компактном формате (to_wire): позиции ссылаются на объекты
+    по cr_code, а имена объектов передаются один раз в словаре objects:
+
+        {"format": "compact", "id": ..., "user": ..., "password": ..., "created_at": ...,
+         "locations": [[локация, [cr_code, ...]], ...], "objects": {cr_code: имя}}
+    """
+    model_config = ConfigDict(extra="ignore")
+
+    id: str | None = None
+    checklist: list[LocationEntry]
+    created_at: str | None = None
+    user: str = ""
+    password: str = ""
+
+    def to_wire(self) -> dict:
+        names = {}
+        locations = []
+        for entry in self.checklist:
+            codes = []
+            for obj in entry.objects:
+                names[obj.cr_code] = obj.name
+                codes.append(obj.cr_code)
+            locations.append([entry.location, codes])
+        return {"format": "compact", "id": self.id, "user": self.user, "password": self.password,
+                "created_at": self.created_at, "locations": locations, "objects": names}
+
+    @classmethod
+    def from_wire(cls, data: dict) -> "Checklist":
+        # Принимает и компактный формат, и полный (от главного сервера предыдущей версии)
+        if data.get("format") != "compact":
+            return cls.model_validate(data)
+        names = data.get("objects") or {}
+        return cls(
+            id=data.get("id"),
+            user=data.get("user") or "",
+            password=data.get("password") or "",
+            created_at=data.get("created_at"),
+            checklist=[
+                LocationEntry(location=location,
+                              objects=[ChecklistObject(cr_code=code, name=names.get(code, "")) for code in codes])
+                for location, codes in data.get("locations") or []
+            ],
+        )
+
+
+# Списки позиций и объектов, приходящие JSON-строкой из форм мастера и в NDJSON-импорте
+LocationEntries = TypeAdapter(list[LocationEntry])
+ChecklistObjects = TypeAdapter(list[ChecklistObject])
+
+
+class ReceivedFile(BaseModel):
+    """Небольшой файл, присланный полевым сервером одним сообщением на /ws/receive."""
+    filename: str = Field(min_length=3)
+    content: str
+    seq: int | None = None
+
+
+class ScheduleCreate(BaseModel):
+    """Новое расписание (POST /api/v1/schedules): чеклист-шаблон, пользователь и правило запуска."""
+    checklist_id: str
+    user: str = Field(min_length=1)
+    rule: str = Field(min_length=1)
+    # Пусто — все серверы, подключённые в момент запуска
+    server_keys: list[str] = []
+    name: str = ""
+
+
+class ScheduleUpdate(BaseModel):
+    enabled: bool
@@ -0,0 +1,90 @@
+import secrets
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database import outbox_collection, counters_collection
+from tasks import spawn
+
+
+class Outbox:
+    """Постоянная очередь чеклистов для каждого сервера (по его ключу).
+
+    Каждый чеклист сначала записывается в outbox с порядковым номером seq,
+    а уже потом отправляется. Пока сервер не подтвердил доставку, запись остаётся
+    в статусе pending и при следующем подключении сервера досылается по порядку seq.
+    Получатель отбрасывает повторы по seq, поэтому повторная досылка безопасна.
+    """
+
+    def __init__(self, collection, counters):
+        self.collection = collection
+        self.counters = counters
+
+    async def start(self, dispatcher):
+        dispatcher.status_listeners.append(self._on_delivery_status)
+
+    async def append(self, server_key: str, checklist: dict, entry_id: str = None) -> dict:
+        # С заданным entry_id повторный вызов возвращает уже записанную запись (тот же seq),
+        # поэтому повтор отправки не создаёт второй доставки
+        if entry_id:
+            existing = await self.collection.find_one({"_id": entry_id})
+            if existing:
+                return existing
+        counter = await self.counters.find_one_and_update(
+            {"_id": f"outbox:{server_key}"},
+            {"$inc": {"seq": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        entry = {
+            "_id": entry_id or secrets.token_hex(8),
+            "server_key": server_key,
+            "seq": counter["seq"],
+            "checklist": checklist,
+            "status": "pending",
+            "created_at": datetime.now(),
+        }
+        try:
+            await self.collection.insert_one(entry)
+        except DuplicateKeyError:
+            if not entry_id:
+                raise
+            return await self.collection.find_one({"_id": entry_id})
+        return entry
+
+    async def discard(self, entry: dict):
+        await self.collection.delete_one({"_id": entry["_id"]})
+
+    async def replay(self, server, dispatcher):
+        # Досылаем всё неподтверждённое по порядку; то, что уже в очереди этого соединения, пропускаем
+        cursor = self.collection.find({"server_key": server.key, "status": "pending"}).sort("seq", 1)
+        async for entry in cursor:
+            delivery = dispatcher.get_delivery(entry["_id"])
+            if delivery and delivery["server_id"] == server.id and delivery["status"] in ("queued", "sent"):
+                continue
+            await dispatcher.enqueue_wait(server, entry["checklist"], entry["_id"], entry["seq"])
+
+    async def get_delivery(self, delivery_id: str):
+        entry = await self.collection.find_one({"_id": delivery_id}, {"checklist": 0})
+        if entry is None:
+            return None
+        return {
+            "delivery_id": entry["_id"],
+            "server_key": entry["server_key"],
+            "seq": entry["seq"],
+            # pending — ждёт подключения сервера, acked — доставлен
+            "status": "acked" if entry["status"] == "delivered" else entry["status"],
+            "error": None,
+        }
+
+    def _on_delivery_status(self, delivery: dict):
+        if delivery["status"] == "acked":
+            # Если запись не удалась, запись останется pending и будет дослана повторно (получатель отбросит по seq)
+            spawn(self.collection.update_one(
+                {"_id": delivery["delivery_id"], "status": "pending"},
+                {"$set": {"status": "delivered", "delivered_at": datetime.now()}}
+            ), "outbox: отметка доставки")
+
+
+outbox = Outbox(outbox_collection, counters_collection)
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import secrets
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+
+from database import client, passwords_collection, password_pool_collection, PASSWORD_TTL_SECONDS
+from log import get_logger
+
+load_dotenv()
+logger = get_logger("passwords")
+PASSWORD_LENGTH = 8
+# Пул свободных кодов пополняется пачкой PASSWORD_POOL_BATCH, когда в нём остаётся меньше PASSWORD_POOL_MIN
+PASSWORD_POOL_MIN = int(os.getenv("PASSWORD_POOL_MIN", 1000))
+PASSWORD_POOL_BATCH = int(os.getenv("PASSWORD_POOL_BATCH", 5000))
+# Сколько раз пробовать другой код при совпадении с уже выданным
+PASSWORD_MAX_ATTEMPTS = 5
+# Код ошибки MongoDB "транзакции не поддерживаются" (standalone без реплики)
+ILLEGAL_OPERATION = 20
+
+
+def generate_code() -> str:
+    return "".join(secrets.choice("0123456789") for _ in range(PASSWORD_LENGTH))
+
+
+def is_code_collision(error: DuplicateKeyError) -> bool:
+    # Совпал именно код (индекс password_unique), а не, например, checklist_id или _id чеклиста
+    return "password" in ((error.details or {}).get("keyPattern") or {})
+
+
+class PasswordService:
+    """Одноразовые пароли чеклистов.
+
+    Коды генерируются через secrets и заранее складываются в пул (password_pool),
+    поэтому создание чеклиста только забирает готовый код. Уникальность выданных кодов
+    гарантирует уникальный индекс passwords.password: при совпадении берётся следующий код.
+    Выданный пароль живёт PASSWORD_TTL_SECONDS и удаляется TTL-индексом по expires_at;
+    владелец чеклиста хранится в самом чеклисте (поле user), поэтому от пароля не зависит.
+    Чеклист и пароль записываются в одной транзакции; на standalone MongoDB без реплики
+    транзакции недоступны, и при ошибке записи пароля чеклист удаляется.
+    """
+
+    def __init__(self, client, collection, pool_collection, ttl: int):
+        self.client = client
+        self.collection = collection
+        self.pool = pool_collection
+        self.ttl = ttl
+        self.transactions = True
+        self.pool_size = 0
+        self._refill = asyncio.Event()
+        self._task = None
+
+    async def start(self):
+        self.pool_size = await self.pool.estimated_document_count()
+        self._task = asyncio.create_task(self._run())
+        self._refill.set()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await self._refill.wait()
+            self._refill.clear()
+            try:
+                self.pool_size = await self.pool.estimated_document_count()
+                if self.pool_size < PASSWORD_POOL_MIN:
+                    await self.fill(PASSWORD_POOL_BATCH)
+            except PyMongoError as e:
+                logger.warning("Не удалось пополнить пул паролей", extra={"error": str(e)})
+                await asyncio.sleep(5)
+                self._refill.set()
+
+    async def fill(self, count: int) -> int:
+        # Генерируем пачку, отбрасываем уже выданные коды и вставляем остальные (повторы в пуле пропускаются)
+        codes = list({generate_code() for _ in range(count)})
+        issued = await self.collection.distinct("password", {"password": {"$in": codes},
+                                                             "expires_at": {"$exists": True}})
+        issued = set(issued)
+        now = datetime.now()
+        documents = [{"_id": code, "created_at": now} for code in codes if code not in issued]
+        inserted = len(documents)
+        try:
+            await self.pool.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            inserted = e.details.get("nInserted", 0)
+        self.pool_size += inserted
+        return inserted
+
+    async def take_code(self) -> str:
+        document = await self.pool.find_one_and_delete({})
+        self.pool_size -= 1
+        if self.pool_size < PASSWORD_POOL_MIN:
+            self._refill.set()
+        if document is None:
+            # Пул пуст (например, сразу после старта) — не ждём пополнения
+            return generate_code()
+        return document["_id"]
+
+    async def create_checklist(self, checklists, document: dict, user: str):
+        """Записывает чеклист и выданный ему пароль; возвращает (id чеклиста, пароль)."""
+        document.setdefault("_id", ObjectId())
+        checklist_id = str(document["_id"])
+        for _ in range(PASSWORD_MAX_ATTEMPTS):
+            now = datetime.now()
+            password_doc = {
+                "checklist_id": checklist_id,
+                "user": user,
+                "password": await self.take_code(),
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=self.ttl),
+            }
+            try:
+                await self._insert(checklists, document, password_doc)
+                return checklist_id, password_doc["password"]
+            except DuplicateKeyError as e:
+                if not is_code_collision(e):
+                    raise
+        raise RuntimeError("Не удалось подобрать уникальный пароль")
+
+    async def reissue(self, checklist_id: str, user: str) -> str:
+        """Пароль отредактированного чеклиста: действующий переходит к user и продлевается,
+        истёкший (удалённый TTL-индексом) выдаётся заново."""
+        for _ in range(PASSWORD_MAX_ATTEMPTS):
+            now = datetime.now()
+            expires_at = now + timedelta(seconds=self.ttl)
+            password_doc = await self.collection.find_one_and_update(
+                {"checklist_id": checklist_id},
+                {"$set": {"user": user, "expires_at": expires_at}},
+                projection={"password": 1},
+            )
+            if password_doc:
+                return password_doc["password"]
+            code = await self.take_code()
+            try:
+                await self.collection.insert_one({"checklist_id": checklist_id, "user": user, "password": code,
+                                                  "created_at": now, "expires_at": expires_at})
+                return code
+            except DuplicateKeyError:
+                # Либо код уже выдан, либо пароль параллельно создан другим запросом — в обоих случаях повторяем
+                continue
+        raise RuntimeError("Не удалось подобрать уникальный пароль")
+
+    async def _insert(self, checklists, document: dict, password_doc: dict):
+        if self.transactions:
+            async def write(session):
+                await checklists.insert_one(document, session=session)
+                await self.collection.insert_one(password_doc, session=session)
+
+            try:
+                async with await self.client.start_session() as session:
+                    await session.with_transaction(write)
+                return
+            except OperationFailure as e:
+                if e.code != ILLEGAL_OPERATION:
+                    raise
+                logger.warning("Транзакции MongoDB недоступны, чеклист и пароль пишутся по очереди")
+                self.transactions = False
+        await checklists.insert_one(document)
+        try:
+            await self.collection.insert_one(password_doc)
+        except PyMongoError:
+            # Без пароля чеклист не сохраняется
+            await checklists.delete_one({"_id": document["_id"]})
+            raise
+
+
+password_service = PasswordService(client, passwords_collection, password_pool_collection, PASSWORD_TTL_SECONDS)
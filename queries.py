@@ -0,0 +1,199 @@
+import re
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from database import (checklists_collection, checklists_read_collection, passwords_collection,
+                      location_objects_collection)
+from location_catalog import object_from_document
+
+# Чеклисты выводятся страницами, курсор — пара (created_at, _id) последнего чеклиста на странице.
+# Пользователь и пароль подтягиваются одним $lookup вместо запроса на каждый чеклист.
+CHECKLISTS_PAGE_SIZE = 30
+RECEIVED_PAGE_SIZE = 50
+AUTOCOMPLETE_LIMIT = 20
+
+
+def encode_cursor(created_at: datetime, document_id) -> str:
+    return f"{created_at.isoformat()}_{document_id}"
+
+
+def decode_cursor(cursor: str):
+    # В isoformat нет "_", поэтому id (в т.ч. имя файла с "_") — всё после первого "_"
+    created_at, checklist_id = cursor.split("_", 1)
+    return datetime.fromisoformat(created_at), checklist_id
+
+
+def keyset_match(cursor: str, field: str, parse_id=ObjectId) -> dict:
+    # Условие "строго после курсора" для сортировки по (field, _id) по убыванию
+    try:
+        value, last_id = decode_cursor(cursor)
+        last_id = parse_id(last_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return {"$or": [
+        {field: {"$lt": value}},
+        {field: value, "_id": {"$lt": last_id}},
+    ]}
+
+
+def date_range_match(field: str, date_from: str = None, date_to: str = None) -> dict:
+    # Даты в формате YYYY-MM-DD, date_to включительно; ValueError — некорректная дата
+    condition = {}
+    if date_from:
+        condition["$gte"] = datetime.fromisoformat(date_from)
+    if date_to:
+        condition["$lt"] = datetime.fromisoformat(date_to) + timedelta(days=1)
+    return {field: condition} if condition else {}
+
+
+# ---- поиск чеклистов ----
+# Для фильтрации в документе чеклиста дублируются пользователь, имена локаций и коды объектов;
+# по каждому полю есть индекс вместе с (created_at, _id), так что фильтр не ломает keyset-пагинацию.
+
+def checklist_search_fields(checklist: list, user: str = None) -> dict:
+    fields = {
+        "locations": sorted({item.get("location") for item in checklist if item.get("location")}),
+        "cr_codes": sorted({obj.get("cr_code") for item in checklist for obj in item.get("objects", [])
+                            if obj.get("cr_code")}),
+    }
+    if user is not None:
+        fields["user"] = user
+    return fields
+
+
+def checklist_filters(user: str = None, location: str = None, cr_code: str = None,
+                      date_from: str = None, date_to: str = None) -> dict:
+    filters = date_range_match("created_at", date_from, date_to)
+    if user:
+        filters["user"] = user
+    if location:
+        filters["locations"] = location
+    if cr_code:
+        filters["cr_codes"] = cr_code
+    return filters
+
+
+async def backfill_checklist_search_fields() -> int:
+    # Заполняет поля поиска у чеклистов, сохранённых до их появления (одна агрегация на сервере).
+    # Разовая миграция (db_init.py backfill-search-fields): фильтр по отсутствию поля не индексируется
+    missing = await checklists_collection.count_documents({"cr_codes": {"$exists": False}})
+    if not missing:
+        return 0
+    await checklists_collection.aggregate([
+        {"$match": {"cr_codes": {"$exists": False}}},
+        {"$lookup": {
+            "from": passwords_collection.name,
+            "let": {"checklist_id": {"$toString": "$_id"}},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$checklist_id", "$$checklist_id"]}}},
+                {"$project": {"_id": 0, "user": 1}},
+                {"$limit": 1},
+            ],
+            "as": "password_doc",
+        }},
+        {"$project": {
+            "user": {"$ifNull": [{"$first": "$password_doc.user"}, ""]},
+            "locations": {"$setUnion": [{"$ifNull": ["$checklist.location", []]}, []]},
+            "cr_codes": {"$setUnion": [{"$reduce": {
+                "input": {"$ifNull": ["$checklist.objects.cr_code", []]},
+                "initialValue": [],
+                "in": {"$concatArrays": ["$$value", "$$this"]},
+            }}, []]},
+        }},
+        {"$merge": {"into": checklists_collection.name, "on": "_id",
+                    "whenMatched": "merge", "whenNotMatched": "discard"}},
+    ]).to_list(length=None)
+    return missing
+
+
+async def fetch_checklists_page(cursor: str = None, limit: int = CHECKLISTS_PAGE_SIZE, filters: dict = None):
+    # Возвращает (чеклисты, курсор следующей страницы); ValueError — некорректный курсор
+    match = dict(filters or {})
+    if cursor:
+        match.update(keyset_match(cursor, "created_at"))
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"created_at": -1, "_id": -1}},
+        {"$limit": limit + 1},
+        {"$project": {"checklist": 1, "created_at": 1, "user": 1}},
+        {"$lookup": {
+            "from": passwords_collection.name,
+            "let": {"checklist_id": {"$toString": "$_id"}},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$checklist_id", "$$checklist_id"]}}},
+                {"$project": {"_id": 0, "user": 1, "password": 1}},
+                {"$limit": 1},
+            ],
+            "as": "password_doc",
+        }},
+    ]
+    documents = await checklists_read_collection.aggregate(pipeline).to_list(length=limit + 1)
+
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        last = documents[-1]
+        next_cursor = encode_cursor(last["created_at"], last["_id"])
+
+    checklists = []
+    for document in documents:
+        password_doc = document["password_doc"][0] if document.get("password_doc") else {}
+        checklists.append({
+            "id": str(document["_id"]),
+            "checklist": document.get("checklist", []),
+            "created_at": document.get("created_at"),
+            # Владелец — из чеклиста: пароль со временем удаляется TTL-индексом
+            "user": document.get("user") or password_doc.get("user", ""),
+            "password": password_doc.get("password", ""),
+        })
+    return checklists, next_cursor
+
+
+# ---- принятые файлы ----
+
+async def fetch_received_page(collection, q: str = None, date_from: str = None, date_to: str = None,
+                              cursor: str = None, limit: int = RECEIVED_PAGE_SIZE):
+    """Страница принятых файлов (новые сначала) и курсор следующей страницы.
+
+    Для логов q — полнотекстовый поиск по индексу content_text, для остальных — префикс имени файла.
+    """
+    match = date_range_match("received_at", date_from, date_to)
+    if q:
+        if collection.name == "logs":
+            match["$text"] = {"$search": q}
+        else:
+            match["_id"] = {"$regex": "^" + re.escape(q)}
+    if cursor:
+        match.update(keyset_match(cursor, "received_at", parse_id=str))
+    documents = await collection.find(match, {"content": 0, "search_terms": 0}) \
+        .sort([("received_at", -1), ("_id", -1)]).limit(limit + 1).to_list(length=limit + 1)
+
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        last = documents[-1]
+        next_cursor = encode_cursor(last["received_at"], last["_id"])
+    items = [{
+        "id": document["_id"],
+        "received_at": document.get("received_at"),
+        "encoding": document.get("encoding"),
+        "length": document.get("length"),
+    } for document in documents]
+    return items, next_cursor
+
+
+# ---- автодополнение кодов объектов ----
+
+async def autocomplete_objects(prefix: str, loc_id=None, after: str = None, limit: int = AUTOCOMPLETE_LIMIT):
+    # Коды объектов по префиксу: якорный regex по _id (= cr_code) идёт по индексу _id диапазоном
+    match = {"_id": {"$regex": "^" + re.escape(prefix)}}
+    if after:
+        match["_id"]["$gt"] = after
+    if loc_id is not None:
+        match["loc_id"] = loc_id
+    documents = await location_objects_collection.find(match).sort("_id", 1).limit(limit + 1) \
+        .to_list(length=limit + 1)
+    next_after = documents[limit - 1]["_id"] if len(documents) > limit else None
+    return [{**object_from_document(document), "loc_id": document["loc_id"]}
+            for document in documents[:limit]], next_after
@@ -0,0 +1,249 @@
+import asyncio
+import os
+import socket
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from database import registry_servers_collection, registry_messages_collection, REGISTRY_TTL_SECONDS
+from log import get_logger
+from tasks import spawn
+
+load_dotenv()
+logger = get_logger("registry")
+# local — список серверов только в памяти процесса (один воркер);
+# mongo — общий реестр в MongoDB для нескольких воркеров/узлов
+REGISTRY_BACKEND = os.getenv("REGISTRY_BACKEND", "local")
+# Как часто воркер продлевает записи своих серверов и забирает адресованные ему сообщения
+REGISTRY_HEARTBEAT_SECONDS = 5
+REGISTRY_POLL_SECONDS = 1
+
+
+class LocalRegistry:
+    """Реестр подключённых серверов внутри одного процесса.
+
+    Все серверы держит текущий воркер, поэтому маршрутизация не нужна.
+    on_joined/on_left вызываются при изменении списка (подписывается broadcast_hub).
+    """
+
+    def __init__(self):
+        self.servers = {}
+        self.dispatcher = None
+        self.on_joined = None
+        self.on_left = None
+
+    async def start(self, dispatcher):
+        self.dispatcher = dispatcher
+
+    async def stop(self):
+        pass
+
+    async def add(self, server: dict):
+        self.servers[server["id"]] = server
+        self.on_joined(self._public(server))
+
+    async def remove(self, server: dict):
+        if self.servers.pop(server["id"], None) is not None:
+            self.on_left(self._public(server))
+
+    @staticmethod
+    def _public(server: dict) -> dict:
+        return {"id": server["id"], "key": server["key"], "name": server["name"], "ip": server["ip"]}
+
+    def list_servers(self) -> list:
+        return [self._public(s) for s in self.servers.values()]
+
+    def find_by_ip(self, server_ip: str):
+        for server in self.servers.values():
+            if server["ip"] == server_ip:
+                return server
+        return None
+
+    def find_by_key(self, server_key: str):
+        for server in self.servers.values():
+            if server["key"] == server_key:
+                return server
+        return None
+
+    async def server_stats(self) -> list:
+        return self.dispatcher.server_stats()
+
+    async def route(self, server: dict, checklist: dict, delivery_id: str, seq: int = None):
+        raise LookupError(f"Сервер {server['ip']} не подключён к этому воркеру")
+
+    async def get_delivery(self, delivery_id: str):
+        return None
+
+
+class MongoRegistry(LocalRegistry):
+    """Общий реестр серверов в MongoDB для запуска в несколько воркеров.
+
+    Каждый воркер пишет в registry_servers свои WebSocket-подключения и продлевает
+    heartbeat_at; записи упавшего воркера удаляет TTL-индекс. Чеклист для сервера,
+    подключённого к другому воркеру, кладётся в registry_messages, откуда его
+    забирает нужный воркер и ставит в свою очередь dispatcher; статус доставки
+    пишется обратно в тот же документ.
+    """
+
+    def __init__(self, servers_collection, messages_collection):
+        super().__init__()
+        self.servers_collection = servers_collection
+        self.messages_collection = messages_collection
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.local_ids = set()
+        self.routed_ids = set()
+        self._tasks = []
+
+    async def start(self, dispatcher):
+        await super().start(dispatcher)
+        dispatcher.status_listeners.append(self._on_delivery_status)
+        await self.servers_collection.delete_many({"worker_id": self.worker_id})
+        await self._sync_servers()
+        self._tasks = [
+            asyncio.create_task(self._heartbeat_loop()),
+            asyncio.create_task(self._poll_loop()),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.servers_collection.delete_many({"worker_id": self.worker_id})
+
+    async def add(self, server: dict):
+        self.local_ids.add(server["id"])
+        await self.servers_collection.insert_one({
+            "_id": server["id"],
+            "key": server["key"],
+            "name": server["name"],
+            "ip": server["ip"],
+            "worker_id": self.worker_id,
+            "heartbeat_at": datetime.now(),
+        })
+        await super().add({**server, "worker_id": self.worker_id})
+
+    async def remove(self, server: dict):
+        self.local_ids.discard(server["id"])
+        await self.servers_collection.delete_one({"_id": server["id"]})
+        await super().remove(server)
+
+    async def route(self, server: dict, checklist: dict, delivery_id: str, seq: int = None):
+        message = {
+            "delivery_id": delivery_id,
+            "seq": seq,
+            "server_id": server["id"],
+            "server_ip": server["ip"],
+            "worker_id": server["worker_id"],
+            "checklist": checklist,
+            "status": "routed",
+            "attempts": 0,
+            "error": None,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now(),
+        }
+        try:
+            await self.messages_collection.insert_one(message)
+        except DuplicateKeyError:
+            # Повтор той же доставки (уникальный delivery_id) — сообщение уже передано воркеру сервера
+            pass
+
+    async def get_delivery(self, delivery_id: str):
+        doc = await self.messages_collection.find_one({"delivery_id": delivery_id}, {"checklist": 0})
+        if doc is None:
+            return None
+        doc.pop("_id", None)
+        return doc
+
+    def _on_delivery_status(self, delivery: dict):
+        if delivery["delivery_id"] in self.routed_ids:
+            if delivery["status"] in ("acked", "failed"):
+                self.routed_ids.discard(delivery["delivery_id"])
+            spawn(self.messages_collection.update_one(
+                {"delivery_id": delivery["delivery_id"]},
+                {"$set": {"status": delivery["status"], "attempts": delivery["attempts"],
+                          "error": delivery["error"], "updated_at": datetime.now()}}
+            ), "registry: статус доставки")
+
+    async def server_stats(self) -> list:
+        # Статистика соединений других воркеров берётся из их последнего heartbeat
+        local_stats = {stats["id"]: stats for stats in self.dispatcher.server_stats()}
+        result = []
+        async for doc in self.servers_collection.find({}, {"stats": 1}):
+            result.append(local_stats.get(doc["_id"]) or doc.get("stats") or {"id": doc["_id"]})
+        return result
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(REGISTRY_HEARTBEAT_SECONDS)
+            now = datetime.now()
+            requests = [
+                UpdateOne({"_id": stats["id"]}, {"$set": {"heartbeat_at": now, "stats": stats}})
+                for stats in self.dispatcher.server_stats()
+            ]
+            try:
+                if requests:
+                    await self.servers_collection.bulk_write(requests, ordered=False)
+            except PyMongoError as e:
+                logger.warning("Не удалось продлить записи реестра серверов", extra={"error": str(e)})
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(REGISTRY_POLL_SECONDS)
+            try:
+                await self._sync_servers()
+                await self._take_messages()
+            except PyMongoError as e:
+                logger.warning("Ошибка синхронизации реестра серверов", extra={"error": str(e)})
+
+    async def _sync_servers(self):
+        # Серверы других воркеров: сравниваем с известным списком и рассылаем изменения
+        fresh_after = datetime.now() - timedelta(seconds=REGISTRY_TTL_SECONDS)
+        current = {}
+        async for doc in self.servers_collection.find({"heartbeat_at": {"$gte": fresh_after}}):
+            current[doc["_id"]] = {"id": doc["_id"], "key": doc["key"], "name": doc["name"], "ip": doc["ip"],
+                                   "worker_id": doc["worker_id"]}
+        for server_id, server in list(self.servers.items()):
+            if server_id not in current and server_id not in self.local_ids:
+                await super().remove(server)
+        for server_id, server in current.items():
+            if server_id not in self.servers:
+                await super().add(server)
+
+    async def _take_messages(self):
+        while True:
+            # Атомарно забираем по одному сообщению, адресованному серверам этого воркера
+            message = await self.messages_collection.find_one_and_update(
+                {"worker_id": self.worker_id, "status": "routed"},
+                {"$set": {"status": "queued", "updated_at": datetime.now()}},
+                sort=[("created_at", 1)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if message is None:
+                return
+            delivery_id = message["delivery_id"]
+            local_server = self.dispatcher.servers.get(message["server_id"])
+            if local_server is None:
+                await self.messages_collection.update_one(
+                    {"_id": message["_id"]},
+                    {"$set": {"status": "failed", "error": "server disconnected"}}
+                )
+                continue
+            self.routed_ids.add(delivery_id)
+            try:
+                self.dispatcher.enqueue(local_server, message["checklist"], delivery_id=delivery_id,
+                                        seq=message.get("seq"))
+            except Exception as e:
+                self.routed_ids.discard(delivery_id)
+                await self.messages_collection.update_one(
+                    {"_id": message["_id"]},
+                    {"$set": {"status": "failed", "error": str(e)}}
+                )
+
+
+if REGISTRY_BACKEND == "mongo":
+    server_registry = MongoRegistry(registry_servers_collection, registry_messages_collection)
+else:
+    server_registry = LocalRegistry()
@@ -0,0 +1,77 @@
+import hashlib
+from collections import OrderedDict
+from datetime import datetime
+
+import orjson
+
+from fastapi.responses import StreamingResponse
+from jinja2 import Environment, FileSystemLoader
+
+# Сколько отрендеренных карточек чеклистов держать в памяти
+CARD_CACHE_SIZE = 5000
+
+
+class AsyncTemplates:
+    """Шаблоны Jinja2 в асинхронном режиме.
+
+    Все шаблоны компилируются при старте (preload), страница отдаётся потоком
+    (generate_async), поэтому рендеринг не блокирует event loop целиком, а браузер
+    начинает получать HTML до окончания рендеринга. Интерфейс TemplateResponse
+    совпадает с Jinja2Templates.
+    """
+
+    def __init__(self, directory: str):
+        self.env = Environment(loader=FileSystemLoader(directory), autoescape=True, enable_async=True)
+
+    def preload(self):
+        for name in self.env.list_templates(extensions=["html"]):
+            self.env.get_template(name)
+
+    def TemplateResponse(self, name: str, context: dict, status_code: int = 200):
+        template = self.env.get_template(name)
+        return StreamingResponse(template.generate_async(context), status_code=status_code,
+                                 media_type="text/html; charset=utf-8")
+
+    async def render(self, name: str, context: dict) -> str:
+        return await self.env.get_template(name).render_async(context)
+
+
+class ChecklistCardCache:
+    """Кэш HTML карточек чеклистов для /checklists.
+
+    Ключ — id чеклиста, его created_at (исходный datetime), пользователь, пароль и хэш
+    содержимого (импорт может заменить позиции, не меняя created_at), поэтому устаревшая
+    карточка не будет показана даже без явной инвалидации — в том числе на воркере,
+    где чеклист не сохраняли. invalidate действует
+    только на свой воркер и лишь освобождает память сразу; корректность от неё не зависит.
+    """
+
+    def __init__(self, templates: AsyncTemplates, max_size: int):
+        self.templates = templates
+        self.max_size = max_size
+        self._cards = OrderedDict()
+
+    async def render(self, checklist: dict) -> str:
+        created_at = checklist["created_at"]
+        body = hashlib.sha1(orjson.dumps(checklist.get("checklist", []))).digest()
+        key = (checklist["id"], created_at, checklist.get("user"), checklist.get("password"), body)
+        card = self._cards.get(key)
+        if card is not None:
+            self._cards.move_to_end(key)
+            return card
+        # Дата форматируется только для показа, в ключе остаётся полная точность
+        if isinstance(created_at, datetime):
+            checklist = {**checklist, "created_at": created_at.strftime("%d-%m-%y %H:%M")}
+        card = await self.templates.render("_checklist_card.html", {"checklist": checklist})
+        self._cards[key] = card
+        if len(self._cards) > self.max_size:
+            self._cards.popitem(last=False)
+        return card
+
+    def invalidate(self, checklist_id: str):
+        for key in [key for key in self._cards if key[0] == checklist_id]:
+            del self._cards[key]
+
+
+templates = AsyncTemplates(directory="templates")
+card_cache = ChecklistCardCache(templates, CARD_CACHE_SIZE)
@@ -0,0 +1,131 @@
+from collections import Counter
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+
+from database import (checklists_received_collection, checklists_read_collection, received_rollups_collection,
+                      received_rollups_read_collection)
+
+# Разрезы сводки по принятым результатам
+DIMENSIONS = ("day", "user", "location")
+
+
+def extract_result(content) -> dict:
+    """Из принятого JSON-результата достаёт пользователя, id чеклиста и число объектов по локациям.
+
+    Результат — либо список позиций чеклиста [{"location", "objects"}], либо объект
+    с полями checklist (список позиций), user и checklist_id.
+    """
+    if isinstance(content, list):
+        content = {"checklist": content}
+    if not isinstance(content, dict):
+        return {"user": None, "checklist_id": None, "locations": {}}
+    locations = Counter()
+    for item in content.get("checklist") or []:
+        if isinstance(item, dict) and item.get("location"):
+            locations[item["location"]] += len(item.get("objects") or [])
+    return {"user": content.get("user"), "checklist_id": content.get("checklist_id"), "locations": locations}
+
+
+class ResultsRollup:
+    """Сводка по принятым результатам чеклистов: по дням, пользователям и локациям.
+
+    Счётчики обновляются инкрементально ($inc) на каждую пачку ingest-пайплайна,
+    только для впервые записанных файлов, поэтому дашборд читает несколько сотен
+    готовых документов вместо сканирования checklists_received. Документ сводки —
+    {dimension, key, day, files, objects}; для разреза day ключ совпадает с днём.
+    """
+
+    def __init__(self, collection, read_collection, received_collection, checklists):
+        self.collection = collection
+        self.read_collection = read_collection
+        self.received_collection = received_collection
+        self.checklists = checklists
+
+    async def start(self, ingest_pipeline):
+        ingest_pipeline.inserted_listeners.append(self._on_inserted)
+
+    async def _on_inserted(self, collection, inserted: list):
+        if collection.name != self.received_collection.name:
+            return
+        day = datetime.now().strftime("%Y-%m-%d")
+        await self.apply([(day, fields.get("content")) for _, fields in inserted])
+
+    async def apply(self, results: list):
+        # results — [(день, содержимое файла)]; загруженные по частям (без content) не учитываются
+        extracted = [(day, extract_result(content)) for day, content in results if content is not None]
+        if not extracted:
+            return
+        # Пользователя, не указанного в результате, берём из чеклиста — одним запросом на пачку
+        # (не из пароля: пароль удаляется TTL-индексом раньше, чем приходят поздние результаты)
+        missing = set()
+        for _, result in extracted:
+            if not result["user"] and result["checklist_id"]:
+                try:
+                    missing.add(ObjectId(result["checklist_id"]))
+                except (InvalidId, TypeError):
+                    pass
+        users = {}
+        if missing:
+            async for checklist in self.checklists.find({"_id": {"$in": list(missing)}}, {"user": 1}):
+                users[str(checklist["_id"])] = checklist.get("user")
+
+        files, objects = Counter(), Counter()
+        for day, result in extracted:
+            user = result["user"] or users.get(result["checklist_id"]) or "—"
+            total = sum(result["locations"].values())
+            for key in (("day", day), ("user", user)):
+                files[key + (day,)] += 1
+                objects[key + (day,)] += total
+            for location, count in result["locations"].items():
+                files[("location", location, day)] += 1
+                objects[("location", location, day)] += count
+
+        requests = [
+            UpdateOne(
+                {"_id": f"{dimension}|{key}|{day}"},
+                {"$inc": {"files": files[(dimension, key, day)], "objects": objects[(dimension, key, day)]},
+                 "$setOnInsert": {"dimension": dimension, "key": key, "day": day}},
+                upsert=True,
+            )
+            for dimension, key, day in files
+        ]
+        await self.collection.bulk_write(requests, ordered=False)
+
+    async def summary(self, days: int = 30) -> dict:
+        # {разрез: [{key, files, objects}]} за последние days дней; day — по дням, остальные — по убыванию files
+        since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+        pipeline = [
+            {"$match": {"dimension": {"$in": list(DIMENSIONS)}, "day": {"$gte": since}}},
+            {"$group": {"_id": {"dimension": "$dimension", "key": "$key"},
+                        "files": {"$sum": "$files"}, "objects": {"$sum": "$objects"}}},
+        ]
+        summary = {dimension: [] for dimension in DIMENSIONS}
+        async for row in self.read_collection.aggregate(pipeline):
+            summary[row["_id"]["dimension"]].append(
+                {"key": row["_id"]["key"], "files": row["files"], "objects": row["objects"]})
+        summary["day"].sort(key=lambda row: row["key"])
+        for dimension in ("user", "location"):
+            summary[dimension].sort(key=lambda row: row["files"], reverse=True)
+        return summary
+
+    async def rebuild(self, batch_size: int = 1000) -> int:
+        # Пересчёт с нуля по всем принятым файлам (db_init.py rebuild-rollups), в обычной работе не нужен
+        await self.collection.delete_many({})
+        count = 0
+        batch = []
+        async for document in self.received_collection.find({}, {"content": 1, "received_at": 1}):
+            received_at = document.get("received_at") or datetime.now()
+            batch.append((received_at.strftime("%Y-%m-%d"), document.get("content")))
+            if len(batch) >= batch_size:
+                await self.apply(batch)
+                count += len(batch)
+                batch = []
+        await self.apply(batch)
+        return count + len(batch)
+
+
+results_rollup = ResultsRollup(received_rollups_collection, received_rollups_read_collection,
+                               checklists_received_collection, checklists_read_collection)
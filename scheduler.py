@@ -0,0 +1,426 @@
+import asyncio
+import hashlib
+import os
+import secrets
+from collections import deque
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from dotenv import load_dotenv
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+from database import (schedules_collection, schedule_runs_collection, checklists_collection, users_collection,
+                      passwords_collection)
+from models import Checklist
+from passwords import password_service
+from queries import checklist_search_fields
+from log import get_logger
+
+load_dotenv()
+logger = get_logger("scheduler")
+# Как часто планировщик проверяет расписания (новое расписание будит его сразу)
+SCHEDULER_INTERVAL_SECONDS = int(os.getenv("SCHEDULER_INTERVAL_SECONDS", 30))
+# Сколько расписаний и запусков разбирается за один проход
+SCHEDULER_BATCH = int(os.getenv("SCHEDULER_BATCH", 100))
+# Сколько пропущенных запусков одного расписания досоздаётся после простоя (более старые пропускаются)
+SCHEDULER_CATCH_UP_LIMIT = int(os.getenv("SCHEDULER_CATCH_UP_LIMIT", 10))
+# Запуск, взятый воркером, не берут другие воркеры SCHEDULER_LEASE_SECONDS; после падения воркера его подхватят
+SCHEDULER_LEASE_SECONDS = 60
+SCHEDULER_MAX_ATTEMPTS = 5
+# Код ошибки MongoDB "дубликат ключа"
+DUPLICATE_KEY = 11000
+
+RULE_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+}
+# Границы полей правила: минута, час, день месяца, месяц, день недели (0 и 7 — воскресенье)
+RULE_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+# Дальше этого горизонта следующий запуск не ищется (правило вроде "0 0 30 2 *" не сработает никогда)
+RULE_HORIZON_DAYS = 5 * 366
+
+
+def parse_rule_field(part: str, low: int, high: int) -> set:
+    values = set()
+    for item in part.split(","):
+        body, has_step, step = item.partition("/")
+        try:
+            step = int(step) if has_step else 1
+            if body == "*":
+                first, last = low, high
+            elif "-" in body:
+                first, last = (int(value) for value in body.split("-", 1))
+            else:
+                first = int(body)
+                last = high if has_step else first
+        except ValueError:
+            raise ValueError(f"Invalid rule field: {part}") from None
+        if step < 1 or not low <= first <= last <= high:
+            raise ValueError(f"Invalid rule field: {part}")
+        values.update(range(first, last + 1, step))
+    return values
+
+
+class Rule:
+    """Cron-подобное правило "минута час день_месяца месяц день_недели".
+
+    Поддерживаются *, числа, диапазоны (1-5), списки (1,3,5), шаги (*/15, 8-18/2)
+    и сокращения @hourly, @daily, @weekly, @monthly. Как в cron, если заданы и день месяца,
+    и день недели, подходит любой из них. Время — локальное время сервера.
+    """
+
+    def __init__(self, text: str):
+        self.text = text.strip()
+        parts = RULE_ALIASES.get(self.text, self.text).split()
+        if len(parts) != 5:
+            raise ValueError(f"Invalid rule: {text!r}, expected 5 fields")
+        fields = [parse_rule_field(part, low, high) for part, (low, high) in zip(parts, RULE_FIELDS)]
+        self.minutes = sorted(fields[0])
+        self.hours = sorted(fields[1])
+        self.days = fields[2]
+        self.months = fields[3]
+        self.weekdays = {day % 7 for day in fields[4]}
+        # Как в cron, поле, начинающееся с "*" (включая "*/2"), отключает правило "день месяца ИЛИ день недели"
+        self.any_day = parts[2].startswith("*")
+        self.any_weekday = parts[4].startswith("*")
+        if self.next_after(datetime(2000, 1, 1)) is None:
+            raise ValueError(f"Rule never fires: {text!r}")
+
+    def day_matches(self, day: datetime) -> bool:
+        if day.month not in self.months:
+            return False
+        weekday = (day.weekday() + 1) % 7
+        if self.any_day or self.any_weekday:
+            # "*" и "*/n" в одном из полей — оба поля должны совпасть (у "*" совпадает любой день)
+            return day.day in self.days and weekday in self.weekdays
+        return day.day in self.days or weekday in self.weekdays
+
+    def next_after(self, moment: datetime):
+        # Ближайший запуск строго после moment (с точностью до минуты) или None
+        start = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        midnight = start.replace(hour=0, minute=0)
+        for offset in range(RULE_HORIZON_DAYS):
+            day = midnight + timedelta(days=offset)
+            if not self.day_matches(day):
+                continue
+            for hour in self.hours:
+                if offset == 0 and hour < start.hour:
+                    continue
+                for minute in self.minutes:
+                    candidate = day.replace(hour=hour, minute=minute)
+                    if candidate >= start:
+                        return candidate
+        return None
+
+
+def schedule_public(schedule: dict) -> dict:
+    # Для API: без копии чеклиста, id строкой
+    return {
+        "id": str(schedule["_id"]),
+        "name": schedule.get("name", ""),
+        "template_id": schedule.get("template_id"),
+        "user": schedule["user"],
+        "rule": schedule["rule"],
+        "server_keys": schedule.get("server_keys", []),
+        "enabled": schedule.get("enabled", False),
+        "next_run_at": schedule.get("next_run_at"),
+        "last_run_at": schedule.get("last_run_at"),
+        "created_at": schedule.get("created_at"),
+    }
+
+
+def run_public(run: dict) -> dict:
+    return {key: value for key, value in run.items() if key not in ("checklist", "claim")}
+
+
+def delivery_id_for(run_id: str, server_key: str) -> str:
+    # Один и тот же запуск на один сервер — всегда одна и та же доставка (запись outbox)
+    return hashlib.sha256(f"{run_id}|{server_key}".encode()).hexdigest()[:16]
+
+
+def parse_schedule_id(schedule_id: str) -> ObjectId:
+    try:
+        return ObjectId(schedule_id)
+    except InvalidId:
+        raise ValueError(f"Invalid schedule id: {schedule_id}")
+
+
+class Scheduler:
+    """Повторяющиеся чеклисты: расписание создаёт чеклист для пользователя и отправляет его серверам.
+
+    Расписание хранит копию чеклиста-шаблона (дальнейшие правки шаблона на него не влияют),
+    пользователя, правило (Rule), ключи серверов (пусто — все подключённые на момент запуска)
+    и время следующего запуска next_run_at. Фоновая задача работает в два шага, оба пачками:
+
+    1. Подошедшие расписания превращаются в записи запусков schedule_runs с _id
+       "<id расписания>|<время запуска>". Повторная запись того же запуска (другим воркером
+       или после рестарта) отбрасывается уникальным _id, поэтому запуски, пропущенные
+       за время простоя, досоздаются ровно один раз (не больше SCHEDULER_CATCH_UP_LIMIT).
+    2. Незавершённые запуски забираются на время SCHEDULER_LEASE_SECONDS: создаётся чеклист
+       с заранее выбранным id и паролем (passwords.PasswordService), затем он ставится в outbox
+       каждого сервера через send (main.enqueue_for_server). id доставки выводится из id запуска
+       и ключа сервера, поэтому повтор после сбоя не создаёт вторую доставку. Если серверов
+       не задано и ни один не подключён, запуск ждёт в pending со статусом waiting=no_servers.
+    """
+
+    def __init__(self, collection, runs_collection, checklists, users, passwords, passwords_service):
+        self.collection = collection
+        self.runs = runs_collection
+        self.checklists = checklists
+        self.users = users
+        self.passwords = passwords
+        self.password_service = passwords_service
+        self.send = None
+        self.registry = None
+        self._wake = asyncio.Event()
+        self._task = None
+
+    async def start(self, send, registry):
+        self.send = send
+        self.registry = registry
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # ---- управление расписаниями ----
+
+    async def create(self, template_id: str, user: str, rule: str, server_keys: list = (), name: str = "") -> dict:
+        parsed = Rule(rule)
+        try:
+            template = await self.checklists.find_one({"_id": ObjectId(template_id)}, {"checklist": 1})
+        except InvalidId:
+            raise ValueError(f"Invalid checklist id: {template_id}")
+        if template is None:
+            raise LookupError(f"Checklist not found: {template_id}")
+        if await self.users.find_one({"username": user}, {"_id": 1}) is None:
+            raise LookupError(f"User not found: {user}")
+        now = datetime.now()
+        schedule = {
+            "_id": ObjectId(),
+            "name": name,
+            "template_id": template_id,
+            "checklist": template.get("checklist", []),
+            "user": user,
+            "rule": parsed.text,
+            "server_keys": list(server_keys),
+            "enabled": True,
+            "next_run_at": parsed.next_after(now),
+            "last_run_at": None,
+            "created_at": now,
+        }
+        await self.collection.insert_one(schedule)
+        self._wake.set()
+        return schedule
+
+    async def list_schedules(self, user: str = None) -> list:
+        query = {"user": user} if user else {}
+        return await self.collection.find(query, {"checklist": 0}).sort("created_at", -1).to_list(length=None)
+
+    async def set_enabled(self, schedule_id: str, enabled: bool):
+        _id = parse_schedule_id(schedule_id)
+        update = {"enabled": enabled}
+        if enabled:
+            # После паузы расписание продолжается с текущего момента, пропущенное за паузу не досоздаётся
+            schedule = await self.collection.find_one({"_id": _id}, {"rule": 1})
+            if schedule is None:
+                return None
+            update["next_run_at"] = Rule(schedule["rule"]).next_after(datetime.now())
+        result = await self.collection.find_one_and_update({"_id": _id}, {"$set": update},
+                                                           projection={"checklist": 0},
+                                                           return_document=ReturnDocument.AFTER)
+        self._wake.set()
+        return result
+
+    async def delete(self, schedule_id: str) -> bool:
+        # Уже созданные запуски доводятся до конца, новые не появятся
+        result = await self.collection.delete_one({"_id": parse_schedule_id(schedule_id)})
+        return result.deleted_count > 0
+
+    async def list_runs(self, schedule_id: str, limit: int = 50) -> list:
+        parse_schedule_id(schedule_id)
+        cursor = self.runs.find({"schedule_id": schedule_id}).sort("run_at", -1).limit(limit)
+        return [run_public(run) async for run in cursor]
+
+    # ---- фоновая задача ----
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.plan_due() >= SCHEDULER_BATCH:
+                    pass
+                while await self.process_runs() >= SCHEDULER_BATCH:
+                    pass
+            except PyMongoError as e:
+                logger.warning("Планировщик: ошибка MongoDB", extra={"error": str(e)})
+            try:
+                await asyncio.wait_for(self._wake.wait(), SCHEDULER_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def plan_due(self) -> int:
+        now = datetime.now()
+        schedules = await self.collection.find(
+            {"enabled": True, "next_run_at": {"$lte": now}}
+        ).sort("next_run_at", 1).limit(SCHEDULER_BATCH).to_list(length=None)
+
+        runs, updates = [], []
+        for schedule in schedules:
+            try:
+                rule = Rule(schedule["rule"])
+            except ValueError as e:
+                # Правило испорчено вручную в базе — выключаем расписание, чтобы не выбирать его снова
+                logger.warning("Некорректное правило расписания", extra={"schedule_id": str(schedule["_id"]),
+                                                                         "error": str(e)})
+                updates.append(UpdateOne({"_id": schedule["_id"]}, {"$set": {"enabled": False}}))
+                continue
+            due = deque(maxlen=SCHEDULER_CATCH_UP_LIMIT)
+            skipped = 0
+            run_at = schedule["next_run_at"]
+            while run_at is not None and run_at <= now:
+                if len(due) == due.maxlen:
+                    skipped += 1
+                due.append(run_at)
+                run_at = rule.next_after(run_at)
+            if skipped:
+                logger.warning("Старые пропущенные запуски расписания не досоздаются",
+                               extra={"schedule_id": str(schedule["_id"]), "skipped": skipped})
+            runs.extend(self._run_document(schedule, moment, now) for moment in due)
+            # Условие на next_run_at: если расписание уже сдвинул другой воркер, ничего не меняем
+            updates.append(UpdateOne(
+                {"_id": schedule["_id"], "next_run_at": schedule["next_run_at"]},
+                {"$set": {"next_run_at": run_at, "last_run_at": due[-1], "enabled": run_at is not None}},
+            ))
+
+        # Сначала записываем запуски, потом сдвигаем расписание: падение между шагами не теряет запуск
+        if runs:
+            try:
+                await self.runs.insert_many(runs, ordered=False)
+            except BulkWriteError as e:
+                if any(error["code"] != DUPLICATE_KEY for error in e.details.get("writeErrors", [])):
+                    raise
+        if updates:
+            await self.collection.bulk_write(updates, ordered=False)
+        if runs:
+            logger.info("Запланированы запуски", extra={"schedules": len(schedules), "runs": len(runs)})
+        return len(schedules)
+
+    @staticmethod
+    def _run_document(schedule: dict, run_at: datetime, now: datetime) -> dict:
+        schedule_id = str(schedule["_id"])
+        return {
+            "_id": f"{schedule_id}|{run_at:%Y-%m-%dT%H:%M}",
+            "schedule_id": schedule_id,
+            "run_at": run_at,
+            "user": schedule["user"],
+            "checklist": schedule["checklist"],
+            "server_keys": schedule.get("server_keys", []),
+            # id чеклиста выбирается заранее, чтобы повтор запуска не создал второй чеклист
+            "checklist_id": str(ObjectId()),
+            "deliveries": [],
+            "status": "pending",
+            "attempts": 0,
+            "locked_until": now,
+            "created_at": now,
+        }
+
+    async def process_runs(self) -> int:
+        now = datetime.now()
+        candidates = await self.runs.find(
+            {"status": "pending", "locked_until": {"$lte": now}}, {"_id": 1}
+        ).sort("run_at", 1).limit(SCHEDULER_BATCH).to_list(length=None)
+        if not candidates:
+            return 0
+        # Забираем пачку одним запросом: достаются только запуски, которые не успел взять другой воркер
+        claim = secrets.token_hex(8)
+        await self.runs.update_many(
+            {"_id": {"$in": [run["_id"] for run in candidates]}, "status": "pending", "locked_until": {"$lte": now}},
+            {"$set": {"claim": claim, "locked_until": now + timedelta(seconds=SCHEDULER_LEASE_SECONDS)},
+             "$inc": {"attempts": 1}},
+        )
+        runs = await self.runs.find({"claim": claim}).to_list(length=None)
+        await asyncio.gather(*(self._execute(run) for run in runs))
+        return len(candidates)
+
+    async def _execute(self, run: dict):
+        try:
+            password = await self._materialize(run)
+            wire = Checklist(id=run["checklist_id"], checklist=run["checklist"], created_at=run["run_at"].isoformat(),
+                             user=run["user"], password=password).to_wire()
+            sent = {delivery["server_key"] for delivery in run["deliveries"]}
+            server_keys = run["server_keys"] or [server["key"] for server in self.registry.list_servers()]
+            if not server_keys:
+                # Отправлять некому — не завершаем запуск и не тратим попытки, ждём подключения серверов
+                await self.runs.update_one(
+                    {"_id": run["_id"]},
+                    {"$set": {"waiting": "no_servers",
+                              "locked_until": datetime.now() + timedelta(seconds=SCHEDULER_INTERVAL_SECONDS)},
+                     "$inc": {"attempts": -1}, "$unset": {"claim": ""}},
+                )
+                return
+            for server_key in server_keys:
+                if server_key in sent:
+                    continue
+                delivery_id = await self.send(wire, server_key=server_key,
+                                              delivery_id=delivery_id_for(run["_id"], server_key))
+                await self.runs.update_one(
+                    {"_id": run["_id"]},
+                    {"$push": {"deliveries": {"server_key": server_key, "delivery_id": delivery_id}}},
+                )
+            await self.runs.update_one(
+                {"_id": run["_id"]},
+                {"$set": {"status": "done", "finished_at": datetime.now()},
+                 "$unset": {"claim": "", "error": "", "waiting": ""}},
+            )
+        except Exception as e:
+            failed = run["attempts"] >= SCHEDULER_MAX_ATTEMPTS
+            logger.warning("Запуск расписания не выполнен",
+                           extra={"run_id": run["_id"], "attempts": run["attempts"], "error": str(e)})
+            update = {"error": str(e)}
+            if failed:
+                update.update({"status": "failed", "finished_at": datetime.now()})
+            else:
+                # Повтор с нарастающей паузой
+                delay = timedelta(seconds=SCHEDULER_INTERVAL_SECONDS * run["attempts"])
+                update["locked_until"] = datetime.now() + delay
+            try:
+                await self.runs.update_one({"_id": run["_id"]}, {"$set": update, "$unset": {"claim": ""}})
+            except PyMongoError:
+                pass
+
+    async def _materialize(self, run: dict) -> str:
+        # Чеклист уже создан прошлой попыткой — берём его пароль
+        password_doc = await self.passwords.find_one({"checklist_id": run["checklist_id"]}, {"password": 1})
+        if password_doc:
+            return password_doc["password"]
+        document = {
+            "_id": ObjectId(run["checklist_id"]),
+            "checklist": run["checklist"],
+            "created_at": run["run_at"],
+            "schedule_id": run["schedule_id"],
+            **checklist_search_fields(run["checklist"], run["user"]),
+        }
+        try:
+            _, password = await self.password_service.create_checklist(self.checklists, document, run["user"])
+        except DuplicateKeyError:
+            # Параллельная попытка успела создать чеклист
+            password_doc = await self.passwords.find_one({"checklist_id": run["checklist_id"]}, {"password": 1})
+            if password_doc is None:
+                raise
+            return password_doc["password"]
+        return password
+
+
+scheduler = Scheduler(schedules_collection, schedule_runs_collection, checklists_collection, users_collection,
+                      passwords_collection, password_service)
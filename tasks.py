@@ -0,0 +1,27 @@
+import asyncio
+
+from log import get_logger
+
+logger = get_logger("tasks")
+
+# Фоновые задачи «запустил и забыл». Event loop держит на задачу только слабую ссылку,
+# поэтому без этого множества незавершённую задачу может собрать сборщик мусора
+_background_tasks = set()
+
+
+def spawn(coro, description: str) -> asyncio.Task:
+    """Запускает фоновую задачу, держит на неё ссылку до завершения и логирует её ошибку."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(lambda done: _log_failure(done, description))
+    return task
+
+
+def _log_failure(task: asyncio.Task, description: str):
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None:
+        logger.error("Фоновая задача завершилась с ошибкой", exc_info=error,
+                     extra={"task": description, "error": str(error)})
@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import pytest
+
+for module in ("motor", "dotenv", "prometheus_client", "starlette", "pydantic"):
+    pytest.importorskip(module)
+
+import bulk_io  # noqa: E402
+
+
+async def chunked(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def parse_ndjson(data: bytes, size: int) -> list:
+    async def collect():
+        return [record async for record in bulk_io.iter_ndjson(chunked(data, size))]
+    return asyncio.run(collect())
+
+
+RECORDS = [{"id": n, "name": "Установка " * n} for n in range(1, 8)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 10 ** 6])
+def test_iter_ndjson_chunk_boundaries(size):
+    data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in RECORDS).encode()
+    assert parse_ndjson(data, size) == RECORDS
+
+
+@pytest.mark.parametrize("size", [1, 5, 1024])
+def test_iter_ndjson_blank_lines_and_missing_final_newline(size):
+    data = b'\n{"a": 1}\r\n\n  \n{"a": 2}'
+    assert parse_ndjson(data, size) == [{"a": 1}, {"a": 2}]
+
+
+def test_iter_ndjson_empty():
+    assert parse_ndjson(b"", 4) == []
+
+
+LOCATIONS = {
+    "Ambar": {"loc_id": 1, "type": "location",
+              "object_list": [{"name": "Установка 1", "cr_code": "00000001"}]},
+    "Конюшня": {"loc_id": 22, "type": "location", "object_list": []},
+    "Склад": {"loc_id": 333, "type": "location",
+              "object_list": [{"name": "Установка 3", "cr_code": "00000003"},
+                              {"name": "Установка 4", "cr_code": "00000004"}]},
+}
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 16, 64 * 1024])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_iter_legacy_locations_chunk_boundaries(tmp_path, monkeypatch, size, indent):
+    path = tmp_path / "data.json"
+    path.write_text(json.dumps(LOCATIONS, ensure_ascii=False, indent=indent), encoding="utf-8")
+    monkeypatch.setattr(bulk_io, "READ_CHUNK_SIZE", size)
+    assert list(bulk_io.iter_legacy_locations(str(path))) == [
+        {"name": name, **data} for name, data in LOCATIONS.items()]
+
+
+def test_iter_legacy_locations_empty_object(tmp_path):
+    path = tmp_path / "data.json"
+    path.write_text(" {} ", encoding="utf-8")
+    assert list(bulk_io.iter_legacy_locations(str(path))) == []
+
+
+def test_iter_legacy_locations_rejects_non_object(tmp_path):
+    path = tmp_path / "data.json"
+    path.write_text("[]", encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(bulk_io.iter_legacy_locations(str(path)))
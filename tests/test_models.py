@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("pydantic")
+
+from models import Checklist  # noqa: E402
+
+
+CHECKLIST = {
+    "id": "42",
+    "user": "ivanov",
+    "password": "12345678",
+    "created_at": "2026-10-17T09:30:00",
+    "checklist": [
+        {"location": "Ambar", "objects": [{"name": "Установка 1", "cr_code": "00000001"},
+                                          {"name": "Установка 2", "cr_code": "00000002"}]},
+        {"location": "Конюшня", "objects": [{"name": "Установка 1", "cr_code": "00000001"}]},
+        {"location": "Пустая", "objects": []},
+    ],
+}
+
+
+def test_wire_round_trip():
+    checklist = Checklist.model_validate(CHECKLIST)
+    assert Checklist.from_wire(checklist.to_wire()) == checklist
+
+
+def test_wire_format_sends_each_name_once():
+    wire = Checklist.model_validate(CHECKLIST).to_wire()
+    assert wire["format"] == "compact"
+    assert wire["locations"] == [["Ambar", ["00000001", "00000002"]], ["Конюшня", ["00000001"]], ["Пустая", []]]
+    assert wire["objects"] == {"00000001": "Установка 1", "00000002": "Установка 2"}
+
+
+def test_from_wire_accepts_full_format():
+    assert Checklist.from_wire(CHECKLIST) == Checklist.model_validate(CHECKLIST)
+
+
+def test_from_wire_defaults_missing_fields():
+    checklist = Checklist.from_wire({"format": "compact", "locations": [["Ambar", ["00000003"]]]})
+    assert checklist.user == "" and checklist.password == ""
+    assert checklist.checklist[0].objects[0].cr_code == "00000003"
+    assert checklist.checklist[0].objects[0].name == ""
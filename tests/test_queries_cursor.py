@@ -0,0 +1,43 @@
+from datetime import datetime
+
+import pytest
+
+for module in ("motor", "dotenv", "prometheus_client", "starlette", "pydantic"):
+    pytest.importorskip(module)
+
+from bson import ObjectId  # noqa: E402
+
+from queries import decode_cursor, encode_cursor, keyset_match  # noqa: E402
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2026, 10, 17, 9, 30, 15, 123456)
+    document_id = ObjectId()
+    assert decode_cursor(encode_cursor(created_at, document_id)) == (created_at, str(document_id))
+
+
+def test_cursor_id_may_contain_underscores():
+    created_at = datetime(2026, 10, 17, 9, 30)
+    assert decode_cursor(encode_cursor(created_at, "log_2026_10_17")) == (created_at, "log_2026_10_17")
+
+
+def test_keyset_match():
+    created_at = datetime(2026, 10, 17, 9, 30)
+    document_id = ObjectId()
+    assert keyset_match(encode_cursor(created_at, document_id), "created_at") == {"$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "_id": {"$lt": document_id}},
+    ]}
+
+
+def test_keyset_match_custom_id_parser():
+    created_at = datetime(2026, 10, 17, 9, 30)
+    match = keyset_match(encode_cursor(created_at, "log_1"), "received_at", parse_id=str)
+    assert match["$or"][1] == {"received_at": created_at, "_id": {"$lt": "log_1"}}
+
+
+@pytest.mark.parametrize("cursor", ["", "garbage", "not-a-date_000000000000000000000000",
+                                    "2026-10-17T09:30:00_not-an-object-id"])
+def test_keyset_match_rejects_invalid_cursor(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        keyset_match(cursor, "created_at")
@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import pytest
+
+for module in ("motor", "dotenv", "prometheus_client", "starlette", "pydantic"):
+    pytest.importorskip(module)
+
+from scheduler import Rule, parse_rule_field  # noqa: E402
+
+
+def test_parse_rule_field():
+    assert parse_rule_field("*", 0, 6) == {0, 1, 2, 3, 4, 5, 6}
+    assert parse_rule_field("*/15", 0, 59) == {0, 15, 30, 45}
+    assert parse_rule_field("8-18/2", 0, 23) == {8, 10, 12, 14, 16, 18}
+    assert parse_rule_field("1,3,5", 0, 6) == {1, 3, 5}
+    assert parse_rule_field("10/20", 0, 59) == {10, 30, 50}
+
+
+@pytest.mark.parametrize("part", ["*/a", "x", "1-b", "*/0", "5-1", "60", ""])
+def test_parse_rule_field_rejects(part):
+    with pytest.raises(ValueError, match="Invalid rule field"):
+        parse_rule_field(part, 0, 59)
+
+
+@pytest.mark.parametrize("text", ["* * *", "0 0 30 2 *", "0 0 31 4,6,9,11 *"])
+def test_invalid_rules(text):
+    with pytest.raises(ValueError):
+        Rule(text)
+
+
+def test_aliases():
+    assert Rule("@daily").next_after(datetime(2026, 10, 17, 9, 30)) == datetime(2026, 10, 18)
+    assert Rule("@hourly").next_after(datetime(2026, 10, 17, 9, 30)) == datetime(2026, 10, 17, 10)
+
+
+def test_next_after_is_strict():
+    rule = Rule("30 9 * * *")
+    assert rule.next_after(datetime(2026, 10, 17, 9, 30)) == datetime(2026, 10, 18, 9, 30)
+    assert rule.next_after(datetime(2026, 10, 17, 9, 29, 59)) == datetime(2026, 10, 17, 9, 30)
+
+
+def test_step_in_day_field_restricts_days():
+    # "*/2" ограничивает дни месяца, а не включает правило "день месяца ИЛИ день недели"
+    rule = Rule("0 0 */2 * *")
+    assert rule.next_after(datetime(2026, 1, 1, 1)) == datetime(2026, 1, 3)
+    # С днём недели: оба поля должны совпасть — нечётное число и понедельник
+    rule = Rule("0 0 */2 * 1")
+    assert rule.next_after(datetime(2026, 1, 1)) == datetime(2026, 1, 5)
+    assert rule.next_after(datetime(2026, 1, 5)) == datetime(2026, 1, 19)
+
+
+def test_day_or_weekday():
+    # Заданы оба поля — подходит любой из них: 1-е число или понедельник
+    rule = Rule("0 0 1 * 1")
+    assert rule.next_after(datetime(2026, 1, 2)) == datetime(2026, 1, 5)
+    assert rule.next_after(datetime(2026, 1, 26)) == datetime(2026, 2, 1)
+
+
+def test_leap_day():
+    assert Rule("0 0 29 2 *").next_after(datetime(2026, 3, 1)) == datetime(2028, 2, 29)
+
+
+def test_sunday_as_seven():
+    assert Rule("0 0 * * 7").next_after(datetime(2026, 10, 17)) == datetime(2026, 10, 18)
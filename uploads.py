@@ -0,0 +1,129 @@
+import hashlib
+import secrets
+from datetime import datetime
+
+from bson import Binary, ObjectId
+from pymongo import ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+from database import uploads_collection, received_files_files_collection, received_files_chunks_collection
+
+# Одно бинарное сообщение не больше этого размера (держится в памяти целиком)
+UPLOAD_MAX_CHUNK_BYTES = 4 * 1024 * 1024
+# Размер чанка GridFS (как у драйвера по умолчанию); все чанки файла, кроме последнего, ровно такого размера
+GRIDFS_CHUNK_BYTES = 255 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class ChunkedUploads:
+    """Загрузка больших файлов по частям через /ws/receive.
+
+    Принятые данные сразу нарезаются на чанки GridFS и пишутся в коллекцию чанков бакета
+    с заранее выбранным files_id, поэтому файл целиком в памяти не держится и повторно
+    не копируется. Хвост меньше GRIDFS_CHUNK_BYTES и число принятых байт хранятся
+    в документе загрузки: после обрыва связи загрузку можно продолжить с того же upload_id.
+    На finish дописывается последний чанк, проверяется sha256 и создаётся документ файла —
+    до этого файл в GridFS не виден. Чанки брошенных загрузок удаляет TTL-индекс по pending_at.
+    """
+
+    def __init__(self, uploads, files, chunks):
+        self.uploads = uploads
+        self.files = files
+        self.chunks = chunks
+
+    @staticmethod
+    def _state(upload: dict) -> dict:
+        return {"upload_id": upload["_id"], "filename": upload["filename"], "size": upload.get("size"),
+                "files_id": upload["files_id"], "offset": upload["offset"], "next_n": upload["next_n"],
+                "tail": bytes(upload.get("tail") or b""), "created_at": upload["created_at"]}
+
+    async def start(self, filename: str, size: int = None, upload_id: str = None) -> dict:
+        # bool — подкласс int, но размером файла не является
+        if size is not None and (not isinstance(size, int) or isinstance(size, bool) or size < 0):
+            raise UploadError("size must be a non-negative integer")
+        if upload_id:
+            upload = await self.uploads.find_one({"_id": upload_id})
+            if upload is None:
+                raise UploadError(f"Загрузка {upload_id} не найдена")
+            if upload["filename"] != filename:
+                raise UploadError(f"Загрузка {upload_id} начата для файла {upload['filename']}")
+            return self._state(upload)
+        upload = {
+            "_id": secrets.token_hex(12),
+            "filename": filename,
+            "size": size,
+            "files_id": ObjectId(),
+            "offset": 0,
+            "next_n": 0,
+            "tail": Binary(b""),
+            "created_at": datetime.now(),
+        }
+        await self.uploads.insert_one(upload)
+        return self._state(upload)
+
+    def _chunk_request(self, state: dict, n: int, data: bytes) -> ReplaceOne:
+        # upsert по (files_id, n): повтор после обрыва перезаписывает тот же чанк
+        return ReplaceOne(
+            {"files_id": state["files_id"], "n": n},
+            {"files_id": state["files_id"], "n": n, "data": Binary(data), "pending_at": state["created_at"]},
+            upsert=True,
+        )
+
+    async def append(self, state: dict, data: bytes):
+        if len(data) > UPLOAD_MAX_CHUNK_BYTES:
+            raise UploadError(f"Чанк больше {UPLOAD_MAX_CHUNK_BYTES} байт")
+        buffer = state["tail"] + data
+        full = len(buffer) // GRIDFS_CHUNK_BYTES
+        if full:
+            await self.chunks.bulk_write([
+                self._chunk_request(state, state["next_n"] + i,
+                                    buffer[i * GRIDFS_CHUNK_BYTES:(i + 1) * GRIDFS_CHUNK_BYTES])
+                for i in range(full)
+            ], ordered=False)
+        tail = buffer[full * GRIDFS_CHUNK_BYTES:]
+        offset = state["offset"] + len(data)
+        # Условие на offset: ту же загрузку параллельно продолжает другое соединение
+        result = await self.uploads.update_one(
+            {"_id": state["upload_id"], "offset": state["offset"]},
+            {"$set": {"offset": offset, "next_n": state["next_n"] + full, "tail": Binary(tail)}},
+        )
+        if result.matched_count == 0:
+            raise UploadError("Загрузка продолжена другим соединением")
+        state.update({"offset": offset, "next_n": state["next_n"] + full, "tail": tail})
+
+    async def finish(self, state: dict, sha256: str = None, metadata: dict = None):
+        upload_id = state["upload_id"]
+        files_id = state["files_id"]
+        if state.get("size") is not None and state["offset"] != state["size"]:
+            raise UploadError(f"Принято {state['offset']} байт из {state['size']}")
+        if state["tail"]:
+            await self.chunks.bulk_write([self._chunk_request(state, state["next_n"], state["tail"])])
+        # Контрольная сумма считается чтением уже записанных чанков
+        hasher = hashlib.sha256()
+        async for chunk in self.chunks.find({"files_id": files_id}, {"data": 1}).sort("n", 1):
+            hasher.update(chunk["data"])
+        if sha256 and hasher.hexdigest() != sha256.lower():
+            await self.chunks.delete_many({"files_id": files_id})
+            await self.uploads.delete_one({"_id": upload_id})
+            raise UploadError("Контрольная сумма не совпадает")
+        try:
+            await self.files.insert_one({
+                "_id": files_id,
+                "length": state["offset"],
+                "chunkSize": GRIDFS_CHUNK_BYTES,
+                "uploadDate": datetime.now(),
+                "filename": state["filename"],
+                "metadata": metadata or {},
+            })
+        except DuplicateKeyError:
+            # Повтор finish после сбоя: документ файла уже создан
+            pass
+        await self.chunks.update_many({"files_id": files_id}, {"$unset": {"pending_at": ""}})
+        await self.uploads.delete_one({"_id": upload_id})
+        return {"gridfs_id": files_id, "length": state["offset"], "sha256": hasher.hexdigest()}
+
+
+chunked_uploads = ChunkedUploads(uploads_collection, received_files_files_collection, received_files_chunks_collection)